@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from openai import AsyncOpenAI
+
+import logger
+import qa
+from database import MongoDB
+
+# Bezhlavá HTTP služba se stejným tokem dotazu jako Streamlit UI (qa.answer_query včetně evidence spotřeby)
+MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "64"))
+MAX_QUEUE = int(os.getenv("API_MAX_QUEUE", "256"))
+QUEUE_TIMEOUT = float(os.getenv("API_QUEUE_TIMEOUT", "2.0"))
+CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", "1024"))
+CACHE_TTL = float(os.getenv("API_CACHE_TTL", "300"))
+DB_THREADS = int(os.getenv("API_DB_THREADS", "32"))
+MAX_N_RESULTS = 20
+
+
+DB = web.AppKey('db', object)
+OWNS_DB = web.AppKey('owns_db', bool)
+OPENAI = web.AppKey('openai', object)
+ADMISSION = web.AppKey('admission', object)
+CACHE = web.AppKey('cache', object)
+EXECUTOR = web.AppKey('executor', ThreadPoolExecutor)
+
+
+class Overloaded(Exception):
+    pass
+
+
+class TTLCache:
+    # LRU cache s expirací; používá se jen z event loopu, zámek proto není potřeba
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if expires < time.monotonic():
+            del self.items[key]
+            return None
+        self.items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.items[key] = (time.monotonic() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+class AdmissionControl:
+    # Omezí počet souběžně zpracovávaných dotazů; když je fronta plná nebo se na slot čeká
+    # příliš dlouho, dotaz se odmítne (503) místo toho, aby rostla latence všech ostatních.
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, max_queue=MAX_QUEUE, queue_timeout=QUEUE_TIMEOUT):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            raise Overloaded()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Overloaded()
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+
+def sources_of(documents):
+    return [doc['metadata']['source'] for doc in documents]
+
+
+async def retrieve(app, query, n_results):
+    # Vrací dokumenty i statistiku výběru (qa.retrieve_documents), z cache obojí
+    key = (query, n_results)
+    result = app[CACHE].get(key)
+    if result is not None:
+        logger.count('api_cache_hits')
+        return result
+
+    # pymongo je blokující, dotaz běží ve sdíleném poolu vláken nad jedním MongoClientem (pool spojení)
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(app[EXECUTOR], qa.retrieve_documents, app[DB], query, n_results)
+    app[CACHE].put(key, result)
+    return result
+
+
+def parse_query_request(body):
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text=json.dumps({"error": "body must be a JSON object"}),
+                                 content_type='application/json')
+    query = body.get('query')
+    if not isinstance(query, str) or not query.strip():
+        raise web.HTTPBadRequest(text=json.dumps({"error": "query must be a non-empty string"}),
+                                 content_type='application/json')
+    n_results = body.get('n_results', 1)
+    # bool je podtřída int, True by jinak prošlo jako 1
+    if not isinstance(n_results, int) or isinstance(n_results, bool) or not 1 <= n_results <= MAX_N_RESULTS:
+        raise web.HTTPBadRequest(text=json.dumps({"error": f"n_results must be between 1 and {MAX_N_RESULTS}"}),
+                                 content_type='application/json')
+    # Spotřeba tokenů se eviduje po session jako v UI; klient bez vlastní session sdílí session "api".
+    # S rozpočtem session by si ho tak dělili všichni klienti, session_id je proto povinné.
+    if qa.SESSION_TOKEN_BUDGET and 'session_id' not in body:
+        raise web.HTTPBadRequest(text=json.dumps({"error": "session_id is required with a session token budget"}),
+                                 content_type='application/json')
+    session_id = body.get('session_id', 'api')
+    if not isinstance(session_id, str) or not session_id:
+        raise web.HTTPBadRequest(text=json.dumps({"error": "session_id must be a non-empty string"}),
+                                 content_type='application/json')
+    return query.strip(), n_results, session_id, bool(body.get('stream', False))
+
+
+async def handle_query(request):
+    app = request.app
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text=json.dumps({"error": "invalid JSON"}), content_type='application/json')
+    query, n_results, session_id, stream = parse_query_request(body)
+
+    try:
+        async with app[ADMISSION].slot():
+            if stream:
+                return await stream_answer(request, session_id, query, n_results)
+
+            answer, documents, entry = await qa.answer_query_async(
+                app[DB], app[OPENAI], session_id, query, n_results, executor=app[EXECUTOR],
+                retrieve=functools.partial(retrieve, app))
+            return web.json_response({"answer": answer, "sources": sources_of(documents),
+                                      "usage": qa.usage_summary(entry)})
+    except Overloaded:
+        logger.count('api_shed')
+        return web.json_response({"error": "overloaded"}, status=503, headers={"Retry-After": "1"})
+    except qa.BudgetExceeded:
+        return web.json_response({"error": "session token budget exhausted"}, status=429)
+    except ConnectionResetError:
+        raise
+    except Exception as e:
+        # Selhání vyhledávání nebo LLM před začátkem odpovědi vrací JSON, ne HTML stránku aiohttp
+        logger.count('api_errors')
+        logger.log_warning(f"Dotaz selhal: {e!r}", key='api_error')
+        return web.json_response({"error": "query failed"}, status=502)
+
+
+async def stream_answer(request, session_id, query, n_results):
+    # Odpověď jako NDJSON: nejdřív zdroje, pak jednotlivé části textu, nakonec "done" se spotřebou tokenů.
+    # Rozpočet se kontroluje před začátkem odpovědi, spotřeba se zaeviduje po posledním chunku.
+    app = request.app
+    loop = asyncio.get_running_loop()
+    entry, token_budget = await loop.run_in_executor(app[EXECUTOR], qa.begin_query, app[DB], session_id, query)
+    start = time.perf_counter()
+    documents, retrieval = await retrieve(app, query, n_results)
+    retrieval_done = time.perf_counter()
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    await response.write((json.dumps({"type": "sources", "sources": sources_of(documents)}) + "\n").encode('utf-8'))
+    usage = qa.usage_of(None)
+    try:
+        async for delta in qa.stream_openai_response(app[OPENAI], qa.SYSTEM_PROMPT, query, documents, token_budget,
+                                                     usage):
+            line = json.dumps({"type": "delta", "content": delta}, ensure_ascii=False) + "\n"
+            await response.write(line.encode('utf-8'))
+        llm_done = time.perf_counter()
+        entry = await loop.run_in_executor(app[EXECUTOR], qa.finish_query, app[DB], session_id, entry, usage,
+                                           retrieval, token_budget, (retrieval_done - start) * 1000,
+                                           (llm_done - retrieval_done) * 1000)
+        last_line = {"type": "done", "usage": qa.usage_summary(entry)}
+    except ConnectionResetError:
+        # Klient se odpojil, není komu chybu poslat
+        raise
+    except Exception as e:
+        # Hlavička už odešla, chybu proto dostane klient jako poslední řádek streamu místo "done"
+        logger.count('api_errors')
+        logger.log_warning(f"Stream odpovědi selhal: {e!r}", key='api_error')
+        last_line = {"type": "error", "error": "query failed"}
+    await response.write((json.dumps(last_line) + "\n").encode('utf-8'))
+    await response.write_eof()
+    return response
+
+
+async def handle_health(request):
+    return web.json_response({"status": "ok", "waiting": request.app[ADMISSION].waiting})
+
+
+async def handle_metrics(request):
+    return web.Response(text=logger.METRICS.to_prometheus(), content_type='text/plain')
+
+
+async def on_cleanup(app):
+    app[EXECUTOR].shutdown(wait=False)
+    if app[OWNS_DB]:
+        app[DB].close_connection()
+
+
+def create_app(db=None, openai_client=None, admission=None):
+    app = web.Application()
+    app[DB] = db or MongoDB()
+    app[OWNS_DB] = db is None
+    app[OPENAI] = openai_client or AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    app[ADMISSION] = admission or AdmissionControl()
+    app[CACHE] = TTLCache()
+    app[EXECUTOR] = ThreadPoolExecutor(max_workers=DB_THREADS)
+    app.router.add_post('/query', handle_query)
+    app.router.add_get('/health', handle_health)
+    app.router.add_get('/metrics', handle_metrics)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP query service for the RAG client")
+    parser.add_argument("--host", type=str, default=os.getenv("API_HOST", "0.0.0.0"), help="Address to bind")
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8080")), help="Port to bind")
+    args = parser.parse_args()
+
+    logger.setup_logging()
+    web.run_app(create_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from openai import AsyncOpenAI
+
+import logger
+import qa
+from database import MongoDB
+
+# Dávkové zodpovídání otázek z JSONL souboru. Používá stejnou logiku jako UI (qa.py),
+# výsledky zapisuje průběžně a po přerušení pokračuje tam, kde skončil.
+
+
+class RateLimiter:
+    # Token bucket: nejvýše `rate` požadavků za sekundu, krátkodobě až `burst`
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def parse_question(line, line_number):
+    # Vadný řádek nezastaví celou dávku, vrátí se jako záznam s chybou
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        return {"id": str(line_number), "error": f"Invalid JSON: {e}"}
+    if isinstance(record, str):
+        record = {"question": record}
+    if not isinstance(record, dict):
+        return {"id": str(line_number), "error": f"Unsupported record type {type(record).__name__}"}
+    record.setdefault('id', str(line_number))
+    question = record.get('question') or record.get('query')
+    if not isinstance(question, str) or not question.strip():
+        return {"id": record['id'], "error": "Missing question"}
+    return record
+
+
+def read_questions(input_file):
+    with open(input_file, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if line:
+                yield parse_question(line, line_number)
+
+
+def truncate_partial_line(output_file):
+    # Po přerušení může poslední řádek zůstat rozepsaný; zkrátíme soubor na poslední celý řádek,
+    # aby se další výsledek nepřipojil k rozbitému záznamu
+    if not os.path.exists(output_file):
+        return
+    with open(output_file, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            step = min(4096, position)
+            f.seek(position - step)
+            block = f.read(step)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position != end:
+            f.truncate(position)
+
+
+def completed_ids(output_file):
+    # Hotové jsou otázky bez chyby; neúspěšné se při dalším běhu zkusí znovu. Neplatné řádky vstupu
+    # (id a chyba) by skončily stejně, vrací se zvlášť, aby se při pokračování nezapisovaly znovu.
+    done = set()
+    invalid = set()
+    if not os.path.exists(output_file):
+        return done, invalid
+    with open(output_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Poslední řádek mohl zůstat rozepsaný při přerušení
+                continue
+            if record.get('invalid'):
+                invalid.add((str(record['id']), record.get('error')))
+            elif not record.get('error'):
+                done.add(str(record['id']))
+    return done, invalid
+
+
+async def answer_question(db, openai_client, record, n_results, session_id):
+    question = record.get('question') or record.get('query')
+    n_results = record.get('n_results', n_results)
+    result = {"id": record['id'], "question": question}
+
+    # Stejný tok jako v UI včetně rozpočtu a evidence spotřeby session
+    answer, documents, entry = await qa.answer_query_async(db, openai_client, session_id, question, n_results)
+    result.update({
+        "answer": answer,
+        "sources": [doc['metadata']['source'] for doc in documents],
+        "usage": qa.usage_summary(entry),
+        "latency_ms": {
+            "retrieval": entry['retrieval_ms'],
+            "llm": entry['llm_ms'],
+            "total": entry['retrieval_ms'] + entry['llm_ms'],
+        },
+    })
+    return result
+
+
+async def run_batch(db, openai_client, input_file, output_file, concurrency=4, rate=0.0, n_results=1,
+                    session_id='batch'):
+    truncate_partial_line(output_file)
+    done, invalid = completed_ids(output_file)
+    limiter = RateLimiter(rate)
+    # Omezená fronta drží v paměti jen pár otázek dopředu, i když je vstup obrovský
+    pending = asyncio.Queue(maxsize=concurrency * 2)
+    stats = {"answered": 0, "failed": 0, "skipped": 0}
+
+    with open(output_file, 'a', encoding='utf-8') as out:
+        async def worker():
+            while True:
+                record = await pending.get()
+                if record is None:
+                    return
+                await limiter.acquire()
+                try:
+                    result = await answer_question(db, openai_client, record, n_results, session_id)
+                    stats["answered"] += 1
+                except Exception as e:
+                    result = {"id": record['id'], "question": record.get('question') or record.get('query'),
+                              "error": f"{type(e).__name__}: {e}"}
+                    stats["failed"] += 1
+                    logger.log_warning(f"Chyba při zpracování otázky {record['id']}: {e}", key='batch_error')
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            for record in read_questions(input_file):
+                if str(record['id']) in done or (str(record['id']), record.get('error')) in invalid:
+                    stats["skipped"] += 1
+                elif record.get('error'):
+                    stats["failed"] += 1
+                    logger.log_warning(f"Neplatná otázka {record['id']}: {record['error']}", key='batch_error')
+                    out.write(json.dumps(dict(record, invalid=True), ensure_ascii=False) + "\n")
+                    out.flush()
+                else:
+                    await pending.put(record)
+        finally:
+            # Workery se ukončí i při chybě čtení vstupu, jinak by čekaly na frontě navždy
+            for _ in workers:
+                await pending.put(None)
+            await asyncio.gather(*workers)
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer questions from a JSONL file concurrently")
+    parser.add_argument("--input", type=str, required=True,
+                        help='JSONL file with {"id": ..., "question": ..., "n_results": ...} records')
+    parser.add_argument("--output", type=str, default="outputs/answers.jsonl",
+                        help="JSONL file for the answers (appended to, used to resume)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of questions in flight")
+    parser.add_argument("--rate", type=float, default=0.0, help="Maximum questions per second (0 = unlimited)")
+    parser.add_argument("--n-results", type=int, default=1, help="Number of retrieved documents per question")
+    parser.add_argument("--session", type=str, default="batch",
+                        help="Session the token usage is recorded under (SESSION_TOKEN_BUDGET applies to it)")
+    args = parser.parse_args()
+
+    logger.setup_logging()
+    output_folder = os.path.dirname(args.output)
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+
+    db = MongoDB()
+    openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    try:
+        stats = asyncio.run(run_batch(db, openai_client, args.input, args.output,
+                                      args.concurrency, args.rate, args.n_results, args.session))
+    finally:
+        db.close_connection()
+    print(f"Answered {stats['answered']}, failed {stats['failed']}, "
+          f"skipped {stats['skipped']} already answered. Results in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
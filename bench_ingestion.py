@@ -0,0 +1,168 @@
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import benchmark
+import database
+import fill_db
+import logger
+import tokenizer
+
+FORMATS = ['pdf', 'docx', 'xlsx', 'pptx', 'txt']
+
+WORDS = ['smlouva', 'faktura', 'dodavatel', 'odběratel', 'částka', 'splatnost', 'zboží', 'služba', 'objednávka',
+         'reklamace', 'záruka', 'termín', 'platba', 'sklad', 'projekt', 'rozpočet', 'zaměstnanec', 'mzda',
+         'contract', 'invoice', 'supplier', 'customer', 'amount', 'delivery', 'warranty', 'payment', 'report',
+         'Praha', 'Brno', 'Ostrava', 'Novák', 'Svoboda', 'Dvořák', 'Microsoft', 'Google', 'Škoda']
+
+
+def random_sentence(rng, min_words=6, max_words=16):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))]
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + rng.choice(['.', '.', '.', '!', '?'])
+
+
+def random_paragraphs(rng, paragraphs, sentences=5):
+    return [' '.join(random_sentence(rng) for _ in range(sentences)) for _ in range(paragraphs)]
+
+
+def write_pdf(path, paragraphs):
+    import fitz
+
+    document = fitz.open()
+    for start in range(0, len(paragraphs), 10):
+        page = document.new_page()
+        page.insert_textbox(page.rect + (36, 36, -36, -36), '\n\n'.join(paragraphs[start:start + 10]), fontsize=9)
+    document.save(path)
+    document.close()
+
+
+def write_docx(path, paragraphs):
+    from docx import Document
+
+    document = Document()
+    for paragraph in paragraphs:
+        document.add_paragraph(paragraph)
+    document.save(path)
+
+
+def write_xlsx(path, paragraphs):
+    import pandas as pd
+
+    rows = [{"id": i, "text": paragraph, "words": len(paragraph.split())} for i, paragraph in enumerate(paragraphs)]
+    pd.DataFrame(rows).to_excel(path, index=False, engine='openpyxl')
+
+
+def write_pptx(path, paragraphs):
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    presentation = Presentation()
+    for paragraph in paragraphs:
+        slide = presentation.slides.add_slide(presentation.slide_layouts[6])
+        textbox = slide.shapes.add_textbox(Inches(0.5), Inches(0.5), Inches(9), Inches(6))
+        textbox.text_frame.text = paragraph
+    presentation.save(path)
+
+
+def write_txt(path, paragraphs):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n\n'.join(paragraphs))
+
+
+WRITERS = {'pdf': write_pdf, 'docx': write_docx, 'xlsx': write_xlsx, 'pptx': write_pptx, 'txt': write_txt}
+
+
+def generate_corpus(directory, formats=FORMATS, files_per_format=5, paragraphs=20, seed=42):
+    # Stejný seed dává stejný korpus, takže výsledky jsou porovnatelné mezi commity
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    total_bytes = 0
+    for file_format in formats:
+        for i in range(files_per_format):
+            path = os.path.join(directory, f"synthetic_{file_format}_{i:04d}.{file_format}")
+            WRITERS[file_format](path, random_paragraphs(rng, paragraphs))
+            total_bytes += os.path.getsize(path)
+    return total_bytes
+
+
+def run_ingestion(directory):
+    # Časy fází měří spany z logger.py; jsou sečtené přes všechna vlákna,
+    # nejde tedy o podíl z celkového času běhu
+    logger.enable_metrics()
+    logger.METRICS.reset()
+    start = time.perf_counter()
+    asyncio.run(fill_db.load_and_process_documents(directory))
+    wall_time = time.perf_counter() - start
+    snapshot = logger.METRICS.snapshot()
+
+    db = database.MongoDB()
+    chunks = db.get_collection('data').count_documents({})
+    db.close_connection()
+    stages = {name: {"seconds": stage["seconds"], "calls": stage["count"]}
+              for name, stage in snapshot["stages"].items()}
+    return wall_time, chunks, stages, snapshot["counters"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestion benchmark over a synthetic multi-format corpus")
+    parser.add_argument("--formats", type=str, nargs='+', default=FORMATS, choices=FORMATS,
+                        help="File formats to generate")
+    parser.add_argument("--files-per-format", type=int, default=5, help="Number of files per format")
+    parser.add_argument("--paragraphs", type=int, default=20, help="Paragraphs per file (controls file size)")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic corpus")
+    parser.add_argument("--corpus-dir", type=str, default=None,
+                        help="Keep the generated corpus in this directory instead of a temporary one")
+    benchmark.add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    tokenizer.download_nltk_data()
+
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='bench-corpus-')
+    try:
+        corpus_bytes = generate_corpus(corpus_dir, args.formats, args.files_per_format, args.paragraphs, args.seed)
+        files = len(os.listdir(corpus_dir))
+
+        with benchmark.mongo_standin(args.mongo, args.mongod_path) as uri:
+            print(f"Ingesting {files} files ({corpus_bytes / 1024:.0f} KiB) into {uri}...")
+            wall_time, chunks, stages, counters = run_ingestion(corpus_dir)
+    finally:
+        if not args.corpus_dir:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    results = {
+        "config": {
+            "formats": args.formats,
+            "files_per_format": args.files_per_format,
+            "paragraphs": args.paragraphs,
+            "seed": args.seed,
+            "mongo": args.mongo,
+        },
+        "files": files,
+        "corpus_bytes": corpus_bytes,
+        "chunks": chunks,
+        "wall_time_s": wall_time,
+        "files_per_s": files / wall_time if wall_time else 0.0,
+        "chunks_per_s": chunks / wall_time if wall_time else 0.0,
+        "peak_rss_mb": benchmark.peak_rss_mb(),
+        "stages": stages,
+        "counters": counters,
+    }
+    print(f"{files} files, {chunks} chunks in {wall_time:.2f} s "
+          f"({results['files_per_s']:.2f} files/s, {results['chunks_per_s']:.1f} chunks/s), "
+          f"peak RSS {results['peak_rss_mb']:.0f} MiB")
+    for stage, stats in stages.items():
+        print(f"  {stage}: {stats['seconds']:.3f} s in {stats['calls']} calls")
+
+    benchmark.save_results(results, 'ingestion', output_file=args.output)
+    if args.compare:
+        benchmark.compare_results(args.compare, results,
+                                  ['wall_time_s', 'files_per_s', 'chunks_per_s', 'peak_rss_mb'])
+
+
+if __name__ == "__main__":
+    main()
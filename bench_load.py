@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from openai import OpenAI
+
+import bench_retrieval
+import benchmark
+import database
+import logger
+import qa
+
+# Zátěžový test celé cesty dotazu z main.py: lokalizace, souhrn session, historie, vyhledání,
+# sestavení promptu, chat completion a zápis historie. LLM nahrazuje lokální falešný server.
+
+# Klíče, které main.py překládá při každém vykreslení stránky
+LOCALIZATION_KEYS = ("title", "configuration", "num_results", "current_language", "session_history",
+                     "enter_question", "submit", "searching")
+HISTORY_PAGE_SIZE = 5
+STAGES = ('search_documents', 'prompt_assembly', 'llm_completion')
+
+
+class FakeChatServer:
+    # Lokální náhrada /v1/chat/completions s nastavitelnou latencí a chybovostí
+    def __init__(self, latency_ms=500.0, jitter_ms=100.0, error_rate=0.0, seed=42):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.loop = None
+        self.runner = None
+        self.port = None
+        self.thread = None
+
+    async def handle_completion(self, request):
+        body = await request.json()
+        await asyncio.sleep(max(0.0, self.rng.gauss(self.latency_ms, self.jitter_ms)) / 1000)
+        self.requests += 1
+        if self.rng.random() < self.error_rate:
+            return web.json_response({"error": {"message": "fake failure", "type": "server_error"}}, status=500)
+
+        prompt_tokens = sum(len(message['content']) for message in body['messages']) // qa.CHARS_PER_TOKEN
+        return web.json_response({
+            "id": f"chatcmpl-bench-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "Nevím."},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20, "total_tokens": prompt_tokens + 20},
+        })
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.handle_completion)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        self.port = self.runner.addresses[0][1]
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._start())
+        ready.set()
+        self.loop.run_forever()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        return False
+
+
+def user_request(db, openai_client, session_id, query, n_results, language='cs'):
+    # Jedno odeslání dotazu tak, jak ho zpracuje main.py včetně vykreslení stránky
+    for key in LOCALIZATION_KEYS:
+        db.get_translation(key, language)
+    db.get_history(session_id, limit=HISTORY_PAGE_SIZE + 1)
+    qa.submit_query(db, openai_client, session_id, query, n_results, budget=0)
+    # Spotřebu session zobrazuje main.py až po odeslání dotazu
+    db.get_session_usage(session_id)
+
+
+def run_level(db, openai_client, queries, users, duration, n_results, seed):
+    # `users` virtuálních uživatelů posílá dotazy bez pauzy, dokud neuplyne `duration` sekund
+    logger.METRICS.reset()
+    deadline = time.perf_counter() + duration
+
+    def virtual_user(index):
+        rng = random.Random(seed + index)
+        session_id = f"bench-user-{index}"
+        latencies, errors = [], []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                user_request(db, openai_client, session_id, rng.choice(queries), n_results)
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        outcomes = list(executor.map(virtual_user, range(users)))
+    wall_time = time.perf_counter() - start
+
+    latencies = [latency for user_latencies, _ in outcomes for latency in user_latencies]
+    errors = [error for _, user_errors in outcomes for error in user_errors]
+    stages = logger.METRICS.snapshot()['stages']
+    return {
+        "users": users,
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "error_rate": len(errors) / (len(latencies) + len(errors)) if latencies or errors else 0.0,
+        "first_error": errors[0] if errors else None,
+        "throughput_rps": len(latencies) / wall_time if wall_time else 0.0,
+        "latency": benchmark.latency_summary(latencies),
+        "stages_mean_ms": {name: stages[name]['seconds'] / stages[name]['count'] * 1000
+                           for name in STAGES if name in stages and stages[name]['count']},
+    }
+
+
+def saturation_point(levels, min_gain=0.1):
+    # Poslední počet uživatelů, po kterém další uživatelé už nezvýší propustnost aspoň o min_gain
+    for previous, current in zip(levels, levels[1:]):
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 + min_gain):
+            return previous['users']
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the question-answering path with a fake LLM")
+    parser.add_argument("--users", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help="Numbers of concurrent virtual users, one load level each")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per load level")
+    parser.add_argument("--chunks", type=int, default=5000, help="Number of synthetic chunks in the corpus")
+    parser.add_argument("--n-results", type=int, default=5, help="Retrieved documents per question")
+    parser.add_argument("--llm-latency-ms", type=float, default=500.0, help="Mean latency of the fake LLM")
+    parser.add_argument("--llm-jitter-ms", type=float, default=100.0, help="Standard deviation of the latency")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of failing LLM calls (0-1)")
+    parser.add_argument("--saturation-gain", type=float, default=0.1,
+                        help="Throughput gain of the next level below which the service counts as saturated")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the corpus, queries and fake LLM")
+    benchmark.add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    logger.enable_metrics(True)
+    rng = random.Random(args.seed)
+    vocabulary = bench_retrieval.build_vocabulary(rng, 5000)
+    chunks = [bench_retrieval.make_chunk(rng, vocabulary, i, 20) for i in range(args.chunks)]
+    levels = []
+
+    with benchmark.mongo_standin(args.mongo, args.mongod_path) as uri, \
+            FakeChatServer(args.llm_latency_ms, args.llm_jitter_ms, args.llm_error_rate, args.seed) as llm:
+        db = database.MongoDB()
+        db.reload_localization()
+        print(f"Seeding {args.chunks} chunks into {uri}...")
+        bench_retrieval.seed_collection(db, chunks)
+        if uri.startswith('mongomock'):
+            # mongomock neumí $text ani capped kolekce: dotazy jdou přes _id a historie do běžné kolekce
+            print("mongomock does not implement $text, queries are chunk ids (the _id lookup path). "
+                  "Install mongod or pass --mongod-path for text search under load.")
+            db.db.create_collection(database.HISTORY_COLLECTION)
+            queries = [chunk['_id'] for chunk in rng.sample(chunks, min(200, len(chunks)))]
+        else:
+            queries = [query['query'] for query in bench_retrieval.generate_queries(rng, chunks, 200, 3)]
+
+        openai_client = OpenAI(api_key="bench", base_url=llm.base_url, max_retries=0)
+        for users in args.users:
+            level = run_level(db, openai_client, queries, users, args.duration, args.n_results, args.seed)
+            levels.append(level)
+            print(f"  users={users}: {level['throughput_rps']:.1f} req/s, p50 {level['latency']['p50_ms']:.0f} ms, "
+                  f"p95 {level['latency']['p95_ms']:.0f} ms, p99 {level['latency']['p99_ms']:.0f} ms, "
+                  f"errors {level['error_rate'] * 100:.1f} %")
+            if level['first_error']:
+                print(f"    {level['first_error']}")
+        db.close_connection()
+
+    saturation = saturation_point(levels, args.saturation_gain)
+    if saturation is None:
+        print("No saturation within the tested levels")
+    else:
+        print(f"Throughput saturates at {saturation} users")
+
+    results = {
+        "config": {
+            "chunks": args.chunks,
+            "n_results": args.n_results,
+            "duration": args.duration,
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_jitter_ms": args.llm_jitter_ms,
+            "llm_error_rate": args.llm_error_rate,
+            "seed": args.seed,
+            "mongo": args.mongo,
+        },
+        "saturation_users": saturation,
+        "levels": levels,
+    }
+    benchmark.save_results(results, 'load', output_file=args.output)
+    if args.compare:
+        benchmark.compare_levels(args.compare, levels)
+
+
+if __name__ == "__main__":
+    main()
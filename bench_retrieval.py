@@ -0,0 +1,177 @@
+import argparse
+import hashlib
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import benchmark
+import database
+import qa
+from normalization import normalize_search_text
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'pra', 'vo', 'sta', 'tr', 'ko', 'da', 'zu', 'ře', 'ší', 'bel', 'dor', 'mas',
+             'tel', 'vin', 'hor', 'lis', 'pok', 'ran', 'sed', 'ján']
+
+
+def build_vocabulary(rng, size):
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(vocabulary)
+
+
+def make_chunk(rng, vocabulary, index, words_per_chunk):
+    tokens = [rng.choice(vocabulary) for _ in range(words_per_chunk)]
+    content = ' '.join(tokens)
+    return {
+        "_id": hashlib.md5(f"{index}:{content}".encode('utf-8')).hexdigest(),
+        "content": content,
+        "search_text": normalize_search_text(content),
+        "metadata": {
+            "tokens": tokens,
+            "pos_tags": [[token, 'NN'] for token in tokens],
+            "named_entities": [[token, 'NN'] for token in tokens],
+            "source": f"data/synthetic_{index // 50:05d}.txt",
+            "page": 0,
+            "file_hash": str(uuid.uuid4()),
+        },
+    }
+
+
+def seed_collection(db, chunks, batch_size=1000):
+    collection = db.get_collection('data')
+    collection.delete_many({})
+    for start in range(0, len(chunks), batch_size):
+        collection.insert_many(chunks[start:start + batch_size])
+    db.ensure_search_index('data')
+
+
+def generate_queries(rng, chunks, n_queries, terms_per_query):
+    token_sets = [set(chunk['metadata']['tokens']) for chunk in chunks]
+    queries = []
+    for target in rng.sample(range(len(chunks)), min(n_queries, len(chunks))):
+        terms = rng.sample(sorted(token_sets[target]), min(terms_per_query, len(token_sets[target])))
+        # Relevantní jsou všechny chunky, které obsahují všechny termy dotazu
+        relevant = {chunks[i]['_id'] for i, tokens in enumerate(token_sets) if tokens.issuperset(terms)}
+        queries.append({"query": ' '.join(terms), "relevant": relevant})
+    return queries
+
+
+def search_text(db, query, n_results):
+    return db.search_documents('data', query, n_results)
+
+
+def search_reranked(db, query, n_results):
+    return qa.get_relevant_documents(db, query, n_results, rerank=True)
+
+
+BACKENDS = {
+    'text': search_text,
+    'rerank': search_reranked,
+}
+
+
+def quality(results, relevant, k):
+    ids = [doc['_id'] for doc in results[:k]]
+    recall = len(relevant.intersection(ids)) / len(relevant) if relevant else 0.0
+    reciprocal_rank = next((1 / rank for rank, doc_id in enumerate(ids, start=1) if doc_id in relevant), 0.0)
+    return recall, reciprocal_rank
+
+
+def replay(db, backend, queries, n_results, concurrency):
+    def run(query):
+        start = time.perf_counter()
+        try:
+            results = backend(db, query['query'], n_results)
+            error = None
+        except Exception as e:
+            results, error = [], f"{type(e).__name__}: {e}"
+        return time.perf_counter() - start, results, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(run, queries))
+    wall_time = time.perf_counter() - start
+
+    latencies = [latency for latency, _, error in outcomes if error is None]
+    errors = [error for _, _, error in outcomes if error is not None]
+    scores = [quality(results, query['relevant'], n_results)
+              for query, (_, results, error) in zip(queries, outcomes) if error is None]
+    return {
+        "n_results": n_results,
+        "concurrency": concurrency,
+        "queries": len(queries),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "throughput_qps": len(latencies) / wall_time if wall_time else 0.0,
+        "latency": benchmark.latency_summary(latencies),
+        "histogram": benchmark.latency_histogram(latencies),
+        "recall_at_k": sum(recall for recall, _ in scores) / len(scores) if scores else 0.0,
+        "mrr": sum(rr for _, rr in scores) / len(scores) if scores else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval latency and quality benchmark")
+    parser.add_argument("--chunks", type=int, nargs='+', default=[1000, 10000],
+                        help="Corpus sizes (number of synthetic chunks) to benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries per run")
+    parser.add_argument("--terms", type=int, default=3, help="Terms per generated query")
+    parser.add_argument("--words-per-chunk", type=int, default=20, help="Words per synthetic chunk")
+    parser.add_argument("--vocabulary", type=int, default=5000, help="Size of the synthetic vocabulary")
+    parser.add_argument("--n-results", type=int, nargs='+', default=[1, 5, 10], help="Values of n_results")
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[1, 8], help="Concurrent query workers")
+    parser.add_argument("--backends", type=str, nargs='+', default=list(BACKENDS), choices=list(BACKENDS),
+                        help="Retrieval backends to benchmark")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic corpus and queries")
+    benchmark.add_standin_arguments(parser)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = build_vocabulary(rng, args.vocabulary)
+    runs = []
+
+    with benchmark.mongo_standin(args.mongo, args.mongod_path) as uri:
+        if uri.startswith('mongomock'):
+            print("mongomock does not implement $text, text-search backends will report errors. "
+                  "Install mongod or pass --mongod-path to benchmark them offline.")
+        db = database.MongoDB()
+        for size in args.chunks:
+            chunks = [make_chunk(rng, vocabulary, i, args.words_per_chunk) for i in range(size)]
+            print(f"Seeding {size} chunks into {uri}...")
+            seed_collection(db, chunks)
+            queries = generate_queries(rng, chunks, args.queries, args.terms)
+
+            for backend_name in args.backends:
+                for n_results in args.n_results:
+                    for concurrency in args.concurrency:
+                        run = replay(db, BACKENDS[backend_name], queries, n_results, concurrency)
+                        run.update({"backend": backend_name, "chunks": size})
+                        runs.append(run)
+                        print(f"  {backend_name} chunks={size} k={n_results} c={concurrency}: "
+                              f"p50 {run['latency']['p50_ms']:.2f} ms, p95 {run['latency']['p95_ms']:.2f} ms, "
+                              f"p99 {run['latency']['p99_ms']:.2f} ms, {run['throughput_qps']:.0f} q/s, "
+                              f"recall@k {run['recall_at_k']:.3f}, MRR {run['mrr']:.3f}, errors {run['errors']}")
+                        if run['first_error']:
+                            print(f"    {run['first_error']}")
+        db.close_connection()
+
+    results = {
+        "config": {
+            "queries": args.queries,
+            "terms": args.terms,
+            "words_per_chunk": args.words_per_chunk,
+            "vocabulary": args.vocabulary,
+            "seed": args.seed,
+            "mongo": args.mongo,
+        },
+        "runs": runs,
+    }
+    benchmark.save_results(results, 'retrieval', output_file=args.output)
+    if args.compare:
+        benchmark.compare_runs(args.compare, runs)
+
+
+if __name__ == "__main__":
+    main()
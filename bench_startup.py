@@ -0,0 +1,101 @@
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+import benchmark
+
+# Moduly ingestion, které nesmí skončit v importním grafu UI
+INGESTION_MODULES = ['fitz', 'pandas', 'lxml', 'docx', 'pptx', 'xlrd', 'olefile', 'magic', 'watchdog', 'nltk',
+                     'langchain_text_splitters', 'fill_db', 'tokenizer']
+
+
+def top_level_imports(script_path):
+    # Importy, které skript provede při startu (importy uvnitř funkcí jsou líné a nepočítají se)
+    with open(script_path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=script_path)
+
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            modules.append(node.module)
+    return list(dict.fromkeys(modules))
+
+
+def parse_importtime(stderr):
+    # Formát -X importtime: "import time: self [us] | cumulative | imported package"
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # Vnořené importy jsou odsazené o dvě mezery na úroveň
+        timings[name.strip()] = {"self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000,
+                                 "top_level": not name[1:].startswith(' ')}
+    return timings
+
+
+def measure_imports(modules):
+    code = (
+        "import sys, json\n"
+        f"for name in {modules!r}:\n"
+        "    __import__(name)\n"
+        "print(json.dumps(sorted(sys.modules)))\n"
+    )
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Import failed:\n{result.stderr[-2000:]}")
+
+    loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return parse_importtime(result.stderr), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start import time of the Streamlit query UI")
+    parser.add_argument("--script", type=str, default="main.py", help="Streamlit script whose imports to measure")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("UI_COLD_START_BUDGET_MS", "2500")),
+                        help="Cold-start budget for the UI imports (fails when exceeded)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of fresh interpreters, the median is used")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest modules to print")
+    parser.add_argument("--output", type=str, default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    modules = top_level_imports(args.script)
+    print(f"Measuring imports of {args.script}: {', '.join(modules)}")
+
+    runs = [measure_imports(modules) for _ in range(args.repeat)]
+    totals = sorted(sum(timing["cumulative_ms"] for timing in timings.values() if timing["top_level"])
+                    for timings, _ in runs)
+    total_ms = totals[len(totals) // 2]
+    timings, loaded = runs[len(runs) // 2]
+
+    leaked = sorted(name for name in INGESTION_MODULES if name in loaded)
+    slowest = sorted(timings.items(), key=lambda item: item[1]["cumulative_ms"], reverse=True)[:args.top]
+
+    print(f"UI import time: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    for name, timing in slowest:
+        print(f"  {timing['cumulative_ms']:8.1f} ms  {name}")
+    if leaked:
+        print(f"Ingestion modules imported by the UI: {', '.join(leaked)}")
+
+    results = {
+        "script": args.script,
+        "modules": modules,
+        "total_ms": total_ms,
+        "budget_ms": args.budget_ms,
+        "leaked_ingestion_modules": leaked,
+        "timings": timings,
+    }
+    benchmark.save_results(results, 'startup', output_file=args.output)
+
+    if total_ms > args.budget_ms or leaked:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import contextlib
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from unittest.mock import patch
+
+import database
+
+
+def peak_rss_mb():
+    # ru_maxrss je na Linuxu v KiB, na macOS v bajtech
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def latency_summary(latencies):
+    latencies_ms = [value * 1000 for value in latencies]
+    return {
+        "count": len(latencies_ms),
+        "mean_ms": sum(latencies_ms) / len(latencies_ms) if latencies_ms else 0.0,
+        "p50_ms": percentile(latencies_ms, 50),
+        "p95_ms": percentile(latencies_ms, 95),
+        "p99_ms": percentile(latencies_ms, 99),
+        "max_ms": max(latencies_ms) if latencies_ms else 0.0,
+    }
+
+
+def latency_histogram(latencies, buckets_ms=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)):
+    histogram = {f"le_{bucket}ms": 0 for bucket in buckets_ms}
+    histogram["le_inf"] = 0
+    for latency in latencies:
+        latency_ms = latency * 1000
+        for bucket in buckets_ms:
+            if latency_ms <= bucket:
+                histogram[f"le_{bucket}ms"] += 1
+        histogram["le_inf"] += 1
+    return histogram
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def save_results(results, name, output_folder='outputs/bench', output_file=None):
+    os.makedirs(output_folder, exist_ok=True)
+    if output_file is None:
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output_file = os.path.join(output_folder, f"{name}-{timestamp}.json")
+
+    results = {"benchmark": name, "commit": git_commit(), "timestamp": datetime.now().isoformat(), **results}
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {output_file}")
+    return output_file
+
+
+def compare_results(baseline_file, results, keys):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    print(f"Comparison with {baseline_file} (commit {baseline.get('commit')}):")
+    for key in keys:
+        old, new = baseline.get(key), results.get(key)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"  {key}: {old:.3f} -> {new:.3f} ({change:+.1f} %)")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _local_mongod(mongod_path):
+    db_path = tempfile.mkdtemp(prefix='bench-mongod-')
+    port = _free_port()
+    process = subprocess.Popen(
+        [mongod_path, '--dbpath', db_path, '--port', str(port), '--bind_ip', '127.0.0.1', '--quiet'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    uri = f"mongodb://127.0.0.1:{port}"
+    try:
+        # Počkáme, než mongod začne přijímat spojení
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                break
+            time.sleep(0.2)
+        else:
+            raise RuntimeError(f"mongod at {mongod_path} did not start")
+        with patch.dict(os.environ, {"MONGODB_URI": uri}):
+            yield uri
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        shutil.rmtree(db_path, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def _mongomock():
+    import mongomock
+
+    # Všechny instance MongoDB musí sdílet stejná data, jinak by process_file neviděl vložené dokumenty
+    client = mongomock.MongoClient()
+    with patch.object(database, 'MongoClient', lambda *args, **kwargs: client), \
+            patch.object(client, 'close', lambda: None):
+        yield 'mongomock://'
+
+
+@contextlib.contextmanager
+def mongo_standin(backend='auto', mongod_path=None):
+    # Lokální náhrada MongoDB: spuštěný mongod, mongomock nebo existující MONGODB_URI
+    if backend == 'uri':
+        yield os.getenv("MONGODB_URI")
+        return
+
+    mongod_path = mongod_path or shutil.which('mongod')
+    if backend == 'mongod' or (backend == 'auto' and mongod_path):
+        if not mongod_path:
+            raise RuntimeError("mongod binary not found, use --mongod-path or --mongo mock")
+        with _local_mongod(mongod_path) as uri:
+            yield uri
+    else:
+        with _mongomock() as uri:
+            yield uri
+
+
+def add_standin_arguments(parser):
+    parser.add_argument("--mongo", type=str, default="auto", choices=["auto", "mongod", "mock", "uri"],
+                        help="MongoDB stand-in: local mongod, mongomock or MONGODB_URI")
+    parser.add_argument("--mongod-path", type=str, default=None, help="Path to the mongod binary")
+    parser.add_argument("--output", type=str, default=None, help="JSON file for the results")
+    parser.add_argument("--compare", type=str, default=None, help="Previous results JSON to compare with")
+
+
+def compare_runs(baseline_file, runs, key_fields=('backend', 'chunks', 'n_results', 'concurrency')):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    baseline_runs = {tuple(run.get(field) for field in key_fields): run for run in baseline.get('runs', [])}
+    print(f"Comparison with {baseline_file} (commit {baseline.get('commit')}):")
+    for run in runs:
+        key = tuple(run.get(field) for field in key_fields)
+        old = baseline_runs.get(key)
+        if old is None:
+            continue
+        label = ' '.join(f"{field}={value}" for field, value in zip(key_fields, key))
+        print(f"  {label}: p95 {old['latency']['p95_ms']:.2f} -> {run['latency']['p95_ms']:.2f} ms, "
+              f"recall@k {old['recall_at_k']:.3f} -> {run['recall_at_k']:.3f}, "
+              f"MRR {old['mrr']:.3f} -> {run['mrr']:.3f}")
+
+
+def compare_levels(baseline_file, levels):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+
+    baseline_levels = {level['users']: level for level in baseline.get('levels', [])}
+    print(f"Comparison with {baseline_file} (commit {baseline.get('commit')}):")
+    for level in levels:
+        old = baseline_levels.get(level['users'])
+        if old is None:
+            continue
+        print(f"  users={level['users']}: {old['throughput_rps']:.1f} -> {level['throughput_rps']:.1f} req/s, "
+              f"p95 {old['latency']['p95_ms']:.0f} -> {level['latency']['p95_ms']:.0f} ms, "
+              f"errors {old['error_rate'] * 100:.1f} -> {level['error_rate'] * 100:.1f} %")
@@ -1,22 +1,69 @@
+import functools
 import json
 import os
+import re
 import uuid
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
 import pymongo
 from bson import ObjectId
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import DeleteMany, MongoClient, UpdateMany
+from pymongo.errors import CollectionInvalid
 
 import logger
+from normalization import normalize_search_text
 
 load_dotenv()
 
+# Historie dotazů je v capped kolekci, takže její velikost je shora omezená bez jakékoli údržby
+HISTORY_COLLECTION = 'history'
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_MAX_ENTRIES = int(os.getenv("HISTORY_MAX_ENTRIES", "100000"))
+
+# Pole, která vyhledávání vrací ve výchozím stavu. Velká metadata (tokens, pos_tags, named_entities)
+# se přenáší jen na vyžádání přes fields nebo fetch_metadata.
+SEARCH_FIELDS = ("content", "metadata.source", "metadata.page", "metadata.chunk_index")
+
+# Spotřeba tokenů a latence: jeden záznam na dotaz a souhrn za session (kvůli rozpočtům)
+USAGE_COLLECTION = 'usage'
+SESSION_USAGE_COLLECTION = 'session_usage'
+# Souhrn session (a tím i rozpočet SESSION_TOKEN_BUDGET) se počítá za pevná okna této délky, po uplynutí
+# okna začíná od nuly; 0 = za celou dobu session
+SESSION_USAGE_WINDOW_SECONDS = int(os.getenv("SESSION_USAGE_WINDOW_SECONDS", "0"))
+
+USAGE_TOTALS = ("prompt_tokens", "completion_tokens", "total_tokens", "retrieval_ms", "llm_ms", "cost")
+
+# Záznam o každém dokončeném souboru ingestion; podle něj přerušený běh pokračuje tam, kde skončil
+CHECKPOINT_COLLECTION = 'ingest_checkpoints'
+
+# Jediný textový index kolekce data: nad předem normalizovaným polem search_text, bez stemmingu
+# (jazyk "none"), s menší váhou i nad zdrojem. Staví se v údržbě (ensure_search_index).
+SEARCH_INDEX_NAME = 'search_text_index'
+SEARCH_INDEX_WEIGHTS = {"search_text": 10, "metadata.source": 2}
+# Počet chunků v jednom bulk_write při doplňování search_text
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "1000"))
+
+# _id chunků je MD5 obsahu (32 hex znaků); jen takový vstup má smysl hledat podle _id
+DOCUMENT_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+LOCALIZATION_FILE = 'settings/localization.json'
+
+
+@functools.lru_cache(maxsize=1)
+def default_localization():
+    with open(LOCALIZATION_FILE, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
 
 class MongoDB:
     def __init__(self):
         self.client = MongoClient(os.getenv("MONGODB_URI"))
         self.db = self.client[os.getenv("MONGODB_DB_NAME", "pdf_qa_db")]
         self.ensure_indexes()
+        self.history_ready = False
+        self.usage_ready = False
+        self.transactions = None
 
     def ensure_indexes(self):
         collection = self.db['data']
@@ -26,6 +73,10 @@ class MongoDB:
         if "metadata.file_hash_1" not in indexes:
             collection.create_index([("metadata.file_hash", pymongo.ASCENDING)], unique=True)
             logger.log_info("Index 'metadata.file_hash_1' byl vytvořen.")
+        if "metadata.source_1" not in indexes:
+            # Re-indexace souboru hledá jeho chunky podle zdroje
+            collection.create_index([("metadata.source", pymongo.ASCENDING)])
+            logger.log_info("Index 'metadata.source_1' byl vytvořen.")
 
         # Toto by mělo být prováděno jen výjimečně nebo v údržbě
         # Najdeme duplicity v file_hash
@@ -83,9 +134,15 @@ class MongoDB:
         # Vloží nebo aktualizuje dokument s podmínkou na file_hash
         collection.replace_one({"metadata.file_hash": file_hash}, document, upsert=True)
 
-    def search_document_by_id(self, collection_name, document_id):
+    @staticmethod
+    def projection(fields):
+        if fields is None:
+            return None
+        return {field: 1 for field in fields}
+
+    def search_document_by_id(self, collection_name, document_id, fields=None):
         collection = self.get_collection(collection_name)
-        result = collection.find_one({"_id": document_id})
+        result = collection.find_one({"_id": document_id}, self.projection(fields))
         if result:
             result["_id"] = str(result["_id"])  # Convert ObjectId to string
         return result
@@ -102,19 +159,74 @@ class MongoDB:
         collection = self.get_collection(collection_name)
         collection.create_index([(field_name, "text")])
 
-    def search_documents(self, collection_name, query, n_results=1):
+    def ensure_search_index(self, collection_name, replace=False):
+        # Kolekce smí mít jen jeden textový index, nový tedy nejde postavit vedle starého. Starý index
+        # nad content se proto nahrazuje jen v údržbě (replace=True); ingestion nový index vytvoří,
+        # jen když žádný textový index není, a vyhledávání tak nikdy nezůstane bez indexu.
+        # Když index už existuje, stojí volání jen jedno index_information.
+        collection = self.get_collection(collection_name)
+        indexes = collection.index_information()
+        if SEARCH_INDEX_NAME in indexes:
+            return False
+        text_indexes = [name for name, info in indexes.items() if any(kind == "text" for _, kind in info['key'])]
+        if text_indexes and not replace:
+            logger.log_info(f"Textový index '{text_indexes[0]}' se nahradí až v údržbě (--maintenance).")
+            return False
+        for name in text_indexes:
+            collection.drop_index(name)
+            logger.log_info(f"Textový index '{name}' byl odstraněn.")
+        collection.create_index([(field, "text") for field in SEARCH_INDEX_WEIGHTS], name=SEARCH_INDEX_NAME,
+                                weights=SEARCH_INDEX_WEIGHTS, default_language="none")
+        logger.log_info(f"Index '{SEARCH_INDEX_NAME}' byl vytvořen.")
+        return True
+
+    def backfill_search_text(self, collection_name):
+        # Doplní search_text chunkům uloženým před zavedením normalizovaného pole
+        # po dávkách BACKFILL_BATCH_SIZE jedním bulk_write (UpdateMany nad _id viz commit_file)
+        collection = self.get_collection(collection_name)
+        updated = 0
+        operations = []
+        for doc in collection.find({"search_text": {"$exists": False}}, {"content": 1}):
+            operations.append(UpdateMany({"_id": doc['_id']},
+                                         {"$set": {"search_text": normalize_search_text(doc.get('content', ''))}}))
+            if len(operations) >= BACKFILL_BATCH_SIZE:
+                updated += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+        return updated
+
+    @staticmethod
+    def is_document_id(query):
+        return isinstance(query, ObjectId) or (isinstance(query, str) and bool(DOCUMENT_ID_PATTERN.match(query)))
+
+    def search_documents_by_ids(self, collection_name, ids, fields=SEARCH_FIELDS):
+        # Jeden dotaz $in pro libovolný počet _id; pořadí výsledků odpovídá `ids`
         collection = self.get_collection(collection_name)
+        documents = {str(doc["_id"]): doc for doc in collection.find({"_id": {"$in": list(ids)}},
+                                                                     self.projection(fields))}
+        return [{**documents[str(doc_id)], "_id": str(doc_id)} for doc_id in ids if str(doc_id) in documents]
 
-        # Pokud je query typu ObjectId nebo string, pokusíme se vyhledat podle _id
-        if isinstance(query, str) or isinstance(query, ObjectId):
-            result = self.search_document_by_id(collection_name, query)
+    def search_documents(self, collection_name, query, n_results=1, fields=SEARCH_FIELDS):
+        # fields=None vrátí celé dokumenty včetně všech metadat
+        collection = self.get_collection(collection_name)
+
+        # Seznam _id se vyhledá jedním dávkovým dotazem
+        if isinstance(query, (list, tuple, set)):
+            return self.search_documents_by_ids(collection_name, list(query), fields)
+
+        # Podle _id hledáme jen vstup, který jako _id vypadá; běžné dotazy jdou rovnou do textového indexu
+        if self.is_document_id(query):
+            result = self.search_document_by_id(collection_name, query, fields)
             if result:
                 return [result]
 
-        # Jinak vyhledáváme pomocí textového dotazu
+        # Jinak vyhledáváme pomocí textového dotazu, normalizovaného stejně jako search_text při ingestion.
+        # Každý výsledek nese v poli "score" textScore, podle kterého qa.py ořezává slabé shody.
+        projection = {"score": {"$meta": "textScore"}, **(self.projection(fields) or {})}
         results = collection.find(
-            {"$text": {"$search": query}},
-            {"score": {"$meta": "textScore"}}
+            {"$text": {"$search": normalize_search_text(query)}},
+            projection
         ).sort([("score", {"$meta": "textScore"})]).limit(n_results)
 
         # Convert ObjectId to string
@@ -122,18 +234,134 @@ class MongoDB:
 
         return list(results)
 
+    def ensure_history_collection(self):
+        if self.history_ready:
+            return
+        if HISTORY_COLLECTION not in self.db.list_collection_names():
+            try:
+                self.db.create_collection(HISTORY_COLLECTION, capped=True, size=HISTORY_MAX_BYTES,
+                                          max=HISTORY_MAX_ENTRIES)
+            except CollectionInvalid:
+                # Kolekci mezitím vytvořil jiný proces
+                pass
+        self.db[HISTORY_COLLECTION].create_index([("session_id", pymongo.ASCENDING),
+                                                  ("created_at", pymongo.DESCENDING),
+                                                  ("_id", pymongo.DESCENDING)])
+        self.history_ready = True
+
+    def add_history_entry(self, session_id, entry):
+        self.ensure_history_collection()
+        document = {**entry, "session_id": session_id, "created_at": datetime.now(timezone.utc)}
+        self.db[HISTORY_COLLECTION].insert_one(document)
+        return document
+
+    def get_history(self, session_id, limit=5, skip=0, before=None, after=None):
+        # Nejnovější záznamy první; načítá se vždy jen požadovaná stránka (limit=0 = bez omezení).
+        # before/after je už načtený záznam: stránka starších záznamů, nebo jen záznamy přidané od něj.
+        self.ensure_history_collection()
+        query = {"session_id": session_id}
+        if before is not None:
+            query["$or"] = [{"created_at": {"$lt": before['created_at']}},
+                            {"created_at": before['created_at'], "_id": {"$lt": before['_id']}}]
+        if after is not None:
+            query["$or"] = [{"created_at": {"$gt": after['created_at']}},
+                            {"created_at": after['created_at'], "_id": {"$gt": after['_id']}}]
+        cursor = self.db[HISTORY_COLLECTION].find(query, {"session_id": 0})
+        cursor = cursor.sort([("created_at", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+        return list(cursor.skip(skip).limit(limit))
+
+    def record_usage(self, session_id, entry):
+        # Záznam dotazu a přičtení k souhrnu session; souhrn se aktualizuje atomicky přes $inc
+        now = datetime.now(timezone.utc)
+        if not self.usage_ready:
+            self.db[USAGE_COLLECTION].create_index([("session_id", pymongo.ASCENDING),
+                                                    ("created_at", pymongo.DESCENDING)])
+            self.usage_ready = True
+        self.db[USAGE_COLLECTION].insert_one({**entry, "session_id": session_id, "created_at": now})
+        totals = {key: entry.get(key) or 0 for key in USAGE_TOTALS}
+        refused = bool(entry.get('refused'))
+        self.db[SESSION_USAGE_COLLECTION].update_one(
+            {"_id": self.session_usage_id(session_id, now)},
+            {"$inc": {**totals, "queries": int(not refused), "refused": int(refused)},
+             "$set": {"session_id": session_id, "updated_at": now}},
+            upsert=True)
+
+    @staticmethod
+    def session_usage_id(session_id, now):
+        # Souhrn za aktuální okno má vlastní dokument, nové okno proto začíná od nuly bez jakéhokoli mazání
+        if not SESSION_USAGE_WINDOW_SECONDS:
+            return session_id
+        return f"{session_id}@{int(now.timestamp()) // SESSION_USAGE_WINDOW_SECONDS}"
+
+    def get_session_usage(self, session_id):
+        usage_id = self.session_usage_id(session_id, datetime.now(timezone.utc))
+        usage = self.db[SESSION_USAGE_COLLECTION].find_one({"_id": usage_id}) or {}
+        return {key: usage.get(key, 0) for key in USAGE_TOTALS + ("queries", "refused")}
+
+    def fetch_metadata(self, collection_name, ids, fields=None):
+        # Doplní metadata (např. tokens) k vybraným výsledkům vyhledávání
+        return self.search_documents_by_ids(collection_name, ids, fields or ["metadata"])
+
+    def supports_transactions(self):
+        # Transakce jsou jen na replica setu nebo shardovaném clusteru, ne na samostatném mongod
+        if self.transactions is None:
+            try:
+                hello = self.client.admin.command('hello')
+                self.transactions = 'setName' in hello or hello.get('msg') == 'isdbgrid'
+            except Exception:
+                self.transactions = False
+        return self.transactions
+
+    def get_checkpoints(self):
+        return {doc['_id']: doc for doc in self.db[CHECKPOINT_COLLECTION].find({}, {"file_hash": 1, "chunks": 1})}
+
+    def commit_file(self, collection_name, documents, checkpoint, removed_ids=(), updates=None):
+        # Chunky souboru a jeho checkpoint se zapíší společně. Chunky se vkládají idempotentně podle _id
+        # ($setOnInsert), opakovaný zápis téhož souboru proto nevytvoří duplicity. Při re-indexaci
+        # se navíc smažou chunky, které ze souboru zmizely, a u zbylých se opraví pozice (updates).
+        # Všechny změny chunků jdou jedním bulk_write (jeden round-trip místo update_one na chunk);
+        # _id se v operacích nepřekrývají, pořadí proto není potřeba. UpdateMany s filtrem na _id změní
+        # nejvýš jeden dokument, na rozdíl od UpdateOne ho ale umí i mongomock v testech.
+        operations = []
+        if removed_ids:
+            # Zdroj je součástí _id (u archivu zdroj člena, ne cesta archivu), stačí proto filtr na _id
+            operations.append(DeleteMany({"_id": {"$in": list(removed_ids)}}))
+        for document in documents:
+            if not document['metadata'].get('file_hash'):
+                document['metadata']['file_hash'] = str(uuid.uuid4())
+            fields = {key: value for key, value in document.items() if key != '_id'}
+            operations.append(UpdateMany({"_id": document['_id']}, {"$setOnInsert": fields}, upsert=True))
+        for document_id, changes in (updates or {}).items():
+            operations.append(UpdateMany({"_id": document_id}, {"$set": changes}))
+
+        def write(session=None):
+            if operations:
+                self.get_collection(collection_name).bulk_write(operations, ordered=False, session=session)
+            self.db[CHECKPOINT_COLLECTION].replace_one({"_id": checkpoint['_id']}, checkpoint, upsert=True,
+                                                      session=session)
+
+        if self.supports_transactions():
+            with self.client.start_session() as session:
+                session.with_transaction(write)
+        else:
+            # Bez transakcí se checkpoint zapíše až po všech chunkách; soubor přerušený uprostřed
+            # zápisu nemá checkpoint a při dalším běhu se zpracuje znovu
+            write()
+
     def load_localization(self):
         collection = self.get_collection('localization')
         localization = collection.find_one({})
         if not localization:
-            with open('settings/localization.json', 'r', encoding='utf-8') as f:
-                localization = json.load(f)
+            localization = dict(default_localization())
             collection.insert_one(localization)
         return localization
 
     def get_translation(self, key, lang):
-        localization = self.load_localization()
-        return localization[lang][key]
+        translations = self.load_localization().get(lang, {})
+        if key not in translations:
+            # Klíč přidaný do JSON po posledním reload_localization (nasazení bez nové ingestion)
+            return default_localization()[lang][key]
+        return translations[key]
 
     def update_localization(self, new_localization):
         collection = self.get_collection('localization')
@@ -143,9 +371,8 @@ class MongoDB:
         self.client.close()
 
     def reload_localization(self):
-        with open('settings/localization.json', 'r', encoding='utf-8') as f:
-            localization = json.load(f)
-        self.update_localization(localization)
+        default_localization.cache_clear()
+        self.update_localization(default_localization())
 
     def clear_all_data(self):
         collections = self.db.list_collection_names()
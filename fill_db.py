@@ -1,23 +1,133 @@
+import argparse
 import asyncio
+import contextlib
+import functools
 import hashlib
+import io
 import os
+import re
+import shutil
+import tarfile
+import tempfile
 import time
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict, List, Any
-import fitz
-import magic
-import olefile
-import pandas as pd
-from docx import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from lxml import etree
-from pptx import Presentation
+import zipfile
+from datetime import datetime, timezone
+from typing import Dict, List, Any, BinaryIO, Union
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 import logger
 import tokenizer
 import utils
 from database import MongoDB
+from normalization import normalize_search_text
+
+class ExtractionError(Exception):
+    pass
+
+
+# Knihovny extraktorů (PyMuPDF, pandas, python-docx, ...) jsou drahé na import. Importují se proto
+# až uvnitř extraktorů, při prvním zpracování souboru daného typu.
+
+# Archivy (ZIP, TAR) se nerozbalují na disk: členy se čtou proudově do bufferů a jdou rovnou do extraktorů.
+# Zdroj chunku je pak "archiv::cesta/v/archivu".
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+ARCHIVE_SEPARATOR = '::'
+# Kolik členů archivu se zpracovává současně (a zároveň drží v bufferech)
+ARCHIVE_CONCURRENCY = int(os.getenv("ARCHIVE_CONCURRENCY", "4"))
+# Členy do této velikosti zůstávají v paměti, větší se odkládají do dočasného souboru
+ARCHIVE_SPOOL_BYTES = int(os.getenv("ARCHIVE_SPOOL_BYTES", str(16 * 1024 * 1024)))
+
+
+class MemberFile(io.BytesIO):
+    # Obsah člena archivu v paměti; str() vrací jeho zdroj, takže hlášky extraktorů i detekce přípony
+    # fungují jako u cesty. path je None, obsah na disku není.
+    path = None
+
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+
+    def __str__(self):
+        return self.source
+
+
+class SpilledMemberFile(io.FileIO):
+    # Velký člen archivu v pojmenovaném dočasném souboru (smaže se při zavření). Přes path ho knihovny,
+    # které jinak potřebují celý obsah v paměti (PyMuPDF, xlrd), otevřou přímo z disku.
+    def __init__(self, source):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(source)[1])
+        os.close(fd)
+        super().__init__(path, 'w+b')
+        self.source = source
+        self.path = path
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+    def __str__(self):
+        return self.source
+
+
+def _is_path(source):
+    return isinstance(source, (str, os.PathLike))
+
+
+@contextlib.contextmanager
+def _open_binary(source):
+    # Cesta se otevře; souborový objekt (člen archivu) se jen přetočí na začátek a nezavírá se
+    if _is_path(source):
+        with open(source, 'rb') as file:
+            yield file
+    else:
+        source.seek(0)
+        yield source
+
+
+def _read_bytes(source):
+    with _open_binary(source) as file:
+        return file.read()
+
+
+def _disk_path(source):
+    # Cesta k obsahu na disku: soubor sám, nebo velký člen archivu; malý člen v paměti cestu nemá
+    return source if _is_path(source) else source.path
+
+
+def is_archive(file_path):
+    return str(file_path).lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _spool(file_path, name, member, size):
+    # Velikost člena je známá z hlavičky archivu, o umístění bufferu se tak rozhodne předem
+    source = f"{file_path}{ARCHIVE_SEPARATOR}{name}"
+    buffer = SpilledMemberFile(source) if size > ARCHIVE_SPOOL_BYTES else MemberFile(source)
+    try:
+        shutil.copyfileobj(member, buffer)
+        buffer.seek(0)
+    except BaseException:
+        buffer.close()
+        raise
+    return buffer
+
+
+def iter_archive(file_path):
+    # Generátor bufferů se členy v pořadí uložení; TAR (i komprimovaný) se čte jedním průchodem
+    if str(file_path).lower().endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as member:
+                    yield _spool(file_path, info.filename, member, info.file_size)
+    else:
+        with tarfile.open(file_path, 'r|*') as archive:
+            for info in archive:
+                if info.isfile():
+                    yield _spool(file_path, info.name, archive.extractfile(info), info.size)
 
 
 class NewFileHandler(FileSystemEventHandler):
@@ -57,7 +167,9 @@ def convert_metadata(metadata):
     return converted
 
 
+@logger.timed('split_text')
 def split_text(raw_documents):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=100,
         chunk_overlap=20,
@@ -77,16 +189,23 @@ def split_text(raw_documents):
     for text in texts:
         split_texts.extend(text_splitter.split_text(text))
 
-    return [{"page_content": text} for text in split_texts]
+    # Pořadí chunku v dokumentu umožní při sestavování kontextu spojit sousední chunky
+    return [{"page_content": text, "chunk_index": i} for i, text in enumerate(split_texts)]
 
 
+@logger.timed('get_file_type')
 def get_file_type(file_path):
+    import magic
     mime = magic.Magic(mime=True)
-    file_type = mime.from_file(file_path)
+    if _is_path(file_path):
+        file_type = mime.from_file(file_path)
+    else:
+        with _open_binary(file_path) as file:
+            file_type = mime.from_buffer(file.read(2048))
 
     # Fallback na detekci podle přípony
     if file_type == 'application/octet-stream':
-        _, extension = os.path.splitext(file_path)
+        _, extension = os.path.splitext(str(file_path))
         extension = extension.lower()
         if extension == '.pdf':
             return 'application/pdf'
@@ -102,20 +221,25 @@ def get_file_type(file_path):
 
 def extract_text_from_pdf(file_path):
     try:
-        document = fitz.open(file_path)
+        import fitz
+        path = _disk_path(file_path)
+        document = fitz.open(path) if path else fitz.open(stream=_read_bytes(file_path), filetype='pdf')
         text = ""
         for page in document:
             text += page.get_text()
         document.close()
         return [{"page_content": text}]  # Balení textu do slovníku
     except Exception as e:
-        logger.log_warning(f"Error reading {file_path}: {e}")
+        logger.log_warning(f"Error reading {file_path}: {e}", key='extract_error')
         return []
 
 
 def extract_text_from_ole_doc(file_path):
     try:
         # Kontrola, zda je soubor OLE formát
+        import olefile
+        if not _is_path(file_path):
+            file_path.seek(0)
         if olefile.isOleFile(file_path):
             ole = olefile.OleFileIO(file_path)
             # Získáme obsah uložený v OLE souboru
@@ -127,99 +251,215 @@ def extract_text_from_ole_doc(file_path):
                 if text.strip():
                     return [{"page_content": text}]
                 else:
-                    logger.log_warning(f"Extrahovaný text z OLE souboru {file_path} je prázdný.")
+                    logger.log_warning(f"Extrahovaný text z OLE souboru {file_path} je prázdný.",
+                                       key='extract_empty')
                     return []
             else:
-                logger.log_warning(f"OLE soubor {file_path} neobsahuje WordDocument stream.")
+                logger.log_warning(f"OLE soubor {file_path} neobsahuje WordDocument stream.", key='unsupported_file')
                 return []
         else:
-            logger.log_warning(f"Soubor {file_path} není platný OLE formát.")
+            logger.log_warning(f"Soubor {file_path} není platný OLE formát.", key='unsupported_file')
             return []
     except Exception as e:
-        logger.log_warning(f"Chyba při extrakci textu z OLE souboru {file_path}: {str(e)}")
+        logger.log_warning(f"Chyba při extrakci textu z OLE souboru {file_path}: {str(e)}", key='extract_error')
+        return []
+
+
+# XML, HTML a XHTML se parsují proudově přes iterparse, takže ani stovky MB exportu nestaví celý strom
+# v paměti. Blok textu se uzavře na konci elementu, jakmile má aspoň MARKUP_BLOCK_CHARS znaků. Proudové
+# je jen parsování: bloky celého souboru se sbírají do seznamu pro split_text a z nich vzniklé chunky
+# se zapisují najednou s checkpointem souboru, paměť tedy roste s množstvím textu v souboru.
+MARKUP_BLOCK_CHARS = int(os.getenv("MARKUP_BLOCK_CHARS", "4000"))
+MARKUP_TYPES = {'text/xml': False, 'application/xml': False, 'application/xhtml+xml': False, 'text/html': True}
+MARKUP_EXTENSIONS = {'.xml': False, '.xhtml': False, '.html': True, '.htm': True}
+# Za koncem blokových elementů se vkládá nový řádek, text skriptů a stylů se vynechává
+_BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'td', 'th', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'title', 'pre',
+               'blockquote', 'section', 'article', 'header', 'footer', 'dt', 'dd', 'caption', 'table', 'ul', 'ol'}
+_SKIPPED_TAGS = {'script', 'style', 'noscript', 'template'}
+# Řádkové elementy text nerozdělují; na začátku a konci každého jiného elementu se vloží mezera, aby se text
+# sousedních záznamů (<a>x</a><b>y</b>) neslepil. Patří sem i běhy textu Wordu (w:r, w:t), slovo
+# v nich bývá rozdělené do více běhů.
+_INLINE_TAGS = {'a', 'abbr', 'b', 'bdi', 'bdo', 'cite', 'code', 'data', 'dfn', 'em', 'font', 'i', 'kbd', 'mark',
+                'q', 's', 'samp', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'time', 'tt', 'u', 'var',
+                'wbr', 'r', 't'}
+
+
+@functools.lru_cache(maxsize=1024)
+def _local_name(tag):
+    # Značek je v dokumentu málo druhů, jméno bez jmenného prostoru se proto počítá jen jednou
+    return tag.rsplit('}', 1)[-1].lower() if isinstance(tag, str) else ''
+
+
+def iter_markup_blocks(file_path, html=False, block_chars=MARKUP_BLOCK_CHARS):
+    # Text se skládá v pořadí dokumentu: text rodiče je kompletní na začátku prvního potomka, tail
+    # předchozího sourozence na začátku dalšího. Zpracovaný sourozenec se hned odstraní, v paměti
+    # zůstává jen aktuální větev stromu.
+    parts, size = [], 0
+    # Mezera na hranici elementu se vloží až před další text, a jen když tam ještě žádná mezera není
+    separate = False
+    # Počet otevřených přeskakovaných elementů (script, style...); uvnitř nich se text nepřidává ani
+    # z vnořených elementů (např. <template><p>...</p></template>)
+    skipped = 0
+
+    def add(text):
+        nonlocal size, separate
+        if text and not skipped:
+            if separate and parts and not parts[-1][-1].isspace() and not text[0].isspace():
+                parts.append(' ')
+                size += 1
+            separate = False
+            parts.append(text)
+            size += len(text)
+
+    with _open_binary(file_path) as file:
+        from lxml import etree
+        events = etree.iterparse(file, events=('start', 'end'), html=html, recover=html, huge_tree=True,
+                                          resolve_entities=False, remove_comments=True, remove_pis=True)
+        for event, element in events:
+            parent = element.getparent()
+            if event == 'start':
+                if parent is not None:
+                    previous = element.getprevious()
+                    if previous is None:
+                        add(parent.text)
+                        parent.text = None
+                    else:
+                        add(previous.tail)
+                        parent.remove(previous)
+                name = _local_name(element.tag)
+                if name in _SKIPPED_TAGS:
+                    skipped += 1
+                # Text před elementem a v něm se odděluje stejně jako za jeho koncem
+                if name not in _INLINE_TAGS:
+                    separate = True
+                continue
+
+            name = _local_name(element.tag)
+            if len(element):
+                add(element[-1].tail)
+                element.remove(element[-1])
+            else:
+                add(element.text)
+            element.text = None
+            if name in _SKIPPED_TAGS:
+                skipped -= 1
+            if name in _BLOCK_TAGS:
+                add('\n')
+            elif name not in _INLINE_TAGS:
+                separate = True
+            if size >= block_chars:
+                yield ''.join(parts)
+                parts, size = [], 0
+
+    text = ''.join(parts)
+    if text.strip():
+        yield text
+
+
+def extract_text_from_markup(file_path, html=False):
+    # Bloky se sbírají do seznamu pro split_text, viz poznámka o paměti u MARKUP_BLOCK_CHARS
+    try:
+        blocks = [{"page_content": block} for block in iter_markup_blocks(file_path, html)]
+        if not blocks:
+            logger.log_warning(f"Extrahovaný text z {file_path} je prázdný.", key='extract_empty')
+        return blocks
+    except Exception as e:
+        logger.log_warning(f"Chyba při extrakci textu z {file_path}: {str(e)}", key='extract_error')
         return []
 
 
 def extract_text_from_docx(file_path):
     try:
         # Zkusíme nejprve načíst jako Word dokument
+        if not _is_path(file_path):
+            file_path.seek(0)
+        from docx import Document
         doc = Document(file_path)
         text = '\n'.join([para.text for para in doc.paragraphs])
         if not text.strip():
-            logger.log_warning(f"Extrahovaný text z dokumentu {file_path} je prázdný.")
+            logger.log_warning(f"Extrahovaný text z dokumentu {file_path} je prázdný.", key='extract_empty')
             return []
         return [{"page_content": text}]
     except Exception as e:
-        logger.log_warning(f"Chyba při extrakci textu z dokumentu {file_path}: {str(e)}")
+        logger.log_warning(f"Chyba při extrakci textu z dokumentu {file_path}: {str(e)}", key='extract_error')
         logger.log_info(f"Pokusíme se{file_path} načíst jako XML...")
         # Fallback - kontrola, zda není soubor XML
         try:
-            with open(file_path, 'rb') as file:
+            with _open_binary(file_path) as file:
                 header = file.read(1024).decode('utf-8', 'ignore')
-                if not header.strip().startswith('<?xml'):
-                    logger.log_warning(f"Soubor {file_path} není platný XML formát.")
-                    return []
+            if not header.strip().startswith('<?xml'):
+                logger.log_warning(f"Soubor {file_path} není platný XML formát.", key='unsupported_file')
+                return []
 
-                # Zkusíme načíst jako XML, pokud hlavička souboru naznačuje XML
-                file.seek(0)  # Vrátíme čtecí hlavu na začátek souboru
-                tree = etree.parse(file)
-                text = ''.join(tree.xpath('//text()'))
-                if text.strip():
-                    return [{"page_content": text}]
-                else:
-                    logger.log_warning(f"Extrahovaný text z XML {file_path} je prázdný.")
+            # Zkusíme načíst jako XML, pokud hlavička souboru naznačuje XML; parsuje se proudově
+            blocks = [{"page_content": block} for block in iter_markup_blocks(file_path)]
+            if blocks:
+                return blocks
+            logger.log_warning(f"Extrahovaný text z XML {file_path} je prázdný.", key='extract_empty')
         except Exception as xml_error:
-            logger.log_warning(f"Chyba při extrakci textu z XML {file_path}: {str(xml_error)}")
+            logger.log_warning(f"Chyba při extrakci textu z XML {file_path}: {str(xml_error)}", key='extract_error')
 
         return []
 
 
-import xlrd
+def _open_workbook(file_path, **kwargs):
+    import xlrd
+    path = _disk_path(file_path)
+    if path:
+        return xlrd.open_workbook(path, **kwargs)
+    return xlrd.open_workbook(file_contents=_read_bytes(file_path), **kwargs)
 
 
 def extract_text_from_xls(file_path):
     try:
         # Otevření souboru ve starším formátu Excelu
-        workbook = xlrd.open_workbook(file_path)
+        workbook = _open_workbook(file_path)
         sheet = workbook.sheet_by_index(0)  # První list
         # Načteme všechny řádky a sloupce jako text
         text = '\n'.join([str(sheet.row_values(row)) for row in range(sheet.nrows)])
         if text.strip():
             return [{"page_content": text}]
         else:
-            logger.log_warning(f"Extrahovaný text z Excelu {file_path} je prázdný.")
+            logger.log_warning(f"Extrahovaný text z Excelu {file_path} je prázdný.", key='extract_empty')
             return []
     except Exception as e:
-        logger.log_warning(f"Chyba při extrakci textu z Excel {file_path}: {str(e)}")
+        logger.log_warning(f"Chyba při extrakci textu z Excel {file_path}: {str(e)}", key='extract_error')
         return []
 
 
 def extract_text_from_xlsx(file_path):
     try:
         # Primárně načítáme pomocí pandas
+        if not _is_path(file_path):
+            file_path.seek(0)
+        import pandas as pd
         df = pd.read_excel(file_path, engine='openpyxl')
         text = df.to_string(index=False)
         return [{"page_content": text}]
     except Exception as e:
-        logger.log_warning(f"Chyba při extrakci textu z Excel {file_path}: {str(e)}")
+        logger.log_warning(f"Chyba při extrakci textu z Excel {file_path}: {str(e)}", key='extract_error')
         logger.log_info(f"Pokusíme se{file_path} načíst jako starý formát pomocí xlrd...")
         # Fallback - pokusíme se načíst jako starý formát pomocí xlrd
         try:
-            workbook = xlrd.open_workbook(file_path, on_demand=True)
+            workbook = _open_workbook(file_path, on_demand=True)
             sheet = workbook.sheet_by_index(0)
             text = '\n'.join([str(sheet.row_values(row)) for row in range(sheet.nrows)])
             if text.strip():
                 return [{"page_content": text}]
             else:
-                logger.log_warning(f"Extrahovaný text z Excelu {file_path} je prázdný.")
+                logger.log_warning(f"Extrahovaný text z Excelu {file_path} je prázdný.", key='extract_empty')
         except Exception as xlrd_error:
-            logger.log_warning(f"Chyba při extrakci textu ze starého Excel {file_path}: {str(xlrd_error)}")
+            logger.log_warning(f"Chyba při extrakci textu ze starého Excel {file_path}: {str(xlrd_error)}",
+                               key='extract_error')
 
         return []
 
 
 def extract_text_from_pptx(file_path):
     try:
+        if not _is_path(file_path):
+            file_path.seek(0)
+        from pptx import Presentation
         prs = Presentation(file_path)
         text = []
         for slide in prs.slides:
@@ -230,75 +470,100 @@ def extract_text_from_pptx(file_path):
             return [{"page_content": ""}]
         return [{"page_content": '\n'.join(text)}]
     except Exception as e:
-        logger.log_warning(f"Chyba při extrakci textu z prezentace {file_path}: {str(e)}")
+        logger.log_warning(f"Chyba při extrakci textu z prezentace {file_path}: {str(e)}", key='extract_error')
         return []
 
 
-def extract_text_from_txt(file_path: str) -> List[Dict[str, str]]:
+def extract_text_from_txt(file_path: Union[str, BinaryIO]) -> List[Dict[str, str]]:
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
+        content = _read_bytes(file_path).decode('utf-8')
         return [{"page_content": content}]
     except Exception as e:
-        logger.log_warning(f"Error reading text file {file_path}: {str(e)}")
+        logger.log_warning(f"Error reading text file {file_path}: {str(e)}", key='extract_error')
         return []
 
 
+@logger.timed('extract')
 def process_file(file_path: str, file_type: str) -> List[Dict[str, Any]]:
     if not os.path.exists(file_path):
         logger.log_warning(f"File not found: {file_path}")
         return []
 
+    # Nezměněné soubory přeskakuje už plan_ingestion podle checkpointu (hash souboru)
     try:
-        # Kontrola duplicit
-        file_hash = utils.calculate_file_hash(file_path)
+        return extract_file(file_path, file_type)
 
-        # Kontrola, zda dokument s tímto file_hash již existuje
-        db = MongoDB()
-        existing_doc = db.query_documents("data", {"metadata.file_hash": file_hash})
-        if existing_doc:
-            logger.log_info(f"Document {file_path} with hash {file_hash} already exists, skipping insertion.")
-            return []
+    except Exception as e:
+        logger.log_warning(f"Error processing file {file_path}: {str(e)}", key='extract_error')
+        return []
 
-        # Zpracování PDF souborů
-        if 'pdf' in file_type:
-            return extract_text_from_pdf(file_path)
 
-        # Zpracování souborů Word ve formátu DOCX
-        elif 'wordprocessingml.document' in file_type or file_path.endswith('.docx'):
-            return extract_text_from_docx(file_path)
+def extractor_for(file_path: Union[str, BinaryIO], file_type: str):
+    # Extraktor a jeho další argumenty podle typu souboru; None pro nepodporovaný typ.
+    # file_path může být i buffer člena archivu; přípona se bere z jeho zdroje.
+    name = str(file_path)
+    # Zpracování PDF souborů
+    if 'pdf' in file_type:
+        return extract_text_from_pdf, ()
 
-        # Zpracování souborů Word ve starším formátu DOC (OLE)
-        elif 'msword' in file_type or file_path.endswith('.doc'):
-            return extract_text_from_ole_doc(file_path)
+    # Zpracování souborů Word ve formátu DOCX
+    elif 'wordprocessingml.document' in file_type or name.endswith('.docx'):
+        return extract_text_from_docx, ()
 
-        # Zpracování souborů Excel ve formátu XLSX
-        elif 'spreadsheetml.sheet' in file_type or file_path.endswith('.xlsx'):
-            return extract_text_from_xlsx(file_path)
+    # Zpracování souborů Word ve starším formátu DOC (OLE)
+    elif 'msword' in file_type or name.endswith('.doc'):
+        return extract_text_from_ole_doc, ()
 
-        # Zpracování souborů  ve starším formátu XLS
-        elif 'ms-excel' in file_type or file_path.endswith('.xls'):
-            return extract_text_from_xls(file_path)
+    # Zpracování souborů Excel ve formátu XLSX
+    elif 'spreadsheetml.sheet' in file_type or name.endswith('.xlsx'):
+        return extract_text_from_xlsx, ()
 
-        # Zpracování souborů PowerPoint
-        elif 'ms-powerpoint' in file_type or 'presentationml.presentation' in file_type or file_path.endswith(
-                ('.ppt', '.pptx')):
-            return extract_text_from_pptx(file_path)
+    # Zpracování souborů  ve starším formátu XLS
+    elif 'ms-excel' in file_type or name.endswith('.xls'):
+        return extract_text_from_xls, ()
 
-        # Zpracování prostého textu
-        elif 'text/plain' in file_type:
-            return extract_text_from_txt(file_path)
+    # Zpracování souborů PowerPoint
+    elif 'ms-powerpoint' in file_type or 'presentationml.presentation' in file_type or name.endswith(
+            ('.ppt', '.pptx')):
+        return extract_text_from_pptx, ()
 
-        # Nepodporovaný typ souboru
-        else:
-            logger.log_warning(f"Unsupported file type: {file_type} for file: {file_path}")
-            return []
+    # Zpracování XML, HTML a XHTML (proudové parsování)
+    elif file_type in MARKUP_TYPES:
+        return extract_text_from_markup, (MARKUP_TYPES[file_type],)
+    elif name.lower().endswith(tuple(MARKUP_EXTENSIONS)):
+        return extract_text_from_markup, (MARKUP_EXTENSIONS[os.path.splitext(name.lower())[1]],)
 
-    except Exception as e:
-        logger.log_warning(f"Error processing file {file_path}: {str(e)}")
+    # Zpracování prostého textu
+    elif 'text/plain' in file_type:
+        return extract_text_from_txt, ()
+
+    # Nepodporovaný typ souboru
+    return None
+
+
+def extract_file(file_path: Union[str, BinaryIO], file_type: str) -> List[Dict[str, Any]]:
+    # Výběr extraktoru podle typu souboru, bez kontroly duplicit (používá ji i re-indexace)
+    extractor = extractor_for(file_path, file_type)
+    if extractor is None:
+        logger.log_warning(f"Unsupported file type: {file_type} for file: {file_path}", key='unsupported_file')
         return []
+    function, args = extractor
+    return function(file_path, *args)
+
+
+def chunk_id(source, content):
+    # Id chunku je MD5 zdroje a obsahu; stejný odstavec ve dvou souborech (nebo členech archivu)
+    # tak má dva záznamy a re-indexace jednoho souboru nesmaže chunk jiného
+    return hashlib.md5(f"{source}\n{content}".encode('utf-8')).hexdigest()
 
 
+def check_extracted(file_path, file_type, raw_documents):
+    # Prázdná extrakce je v pořádku jen u nepodporovaného typu nebo prázdného souboru, jinak selhala
+    if not raw_documents and extractor_for(file_path, file_type) is not None and os.path.getsize(file_path) > 0:
+        raise ExtractionError(f"Žádný obsah nebyl extrahován z {file_path}")
+
+
+@logger.timed('process_paragraph')
 def process_paragraph(paragraph, file_path):
     page_content = paragraph['page_content']
     tokens = tokenizer.tokenize_text(page_content)
@@ -312,68 +577,297 @@ def process_paragraph(paragraph, file_path):
         "source": file_path,
         "page": paragraph.get("page", 0)
     }
+    if "chunk_index" in paragraph:
+        metadata["chunk_index"] = paragraph["chunk_index"]
 
     converted_metadata = convert_metadata(metadata)
 
-    # Vytvoření hash z obsahu dokumentu
-    content_hash = hashlib.md5(page_content.encode('utf-8')).hexdigest()
-
     return {
-        "_id": content_hash,
+        "_id": chunk_id(file_path, page_content),
         "content": page_content,
+        "search_text": normalize_search_text(page_content),
         "metadata": converted_metadata
     }
 
 
-async def process_document(file_path: str) -> List[Dict[str, Any]]:
+async def enrich_documents(raw_documents, source):
     loop = asyncio.get_event_loop()
-    file_type = await loop.run_in_executor(None, get_file_type, file_path)
-    raw_documents = await loop.run_in_executor(None, process_file, file_path, file_type)
+    paragraphs = await loop.run_in_executor(None, split_text, raw_documents)
+    return await asyncio.gather(
+        *[loop.run_in_executor(None, process_paragraph, paragraph, source) for paragraph in paragraphs])
+
+
+async def process_member(member):
+    # Jeden člen archivu: stejné extraktory jako u souborů, jen nad bufferem
+    loop = asyncio.get_event_loop()
+    try:
+        file_type = await loop.run_in_executor(None, get_file_type, member)
+    except Exception as e:
+        # Nerozpoznaný člen nesmí shodit zpracování celého archivu
+        logger.log_warning(f"Nelze určit typ {member}: {e}", key='extract_error')
+        return []
+    raw_documents = await loop.run_in_executor(None, extract_file, member, file_type)
+    logger.count('archive_members')
     if not raw_documents:
-        logger.log_warning(f"Žádný obsah nebyl extrahován z {file_path}")
+        logger.log_warning(f"Žádný obsah nebyl extrahován z {member}", key='extract_empty')
         return []
+    return await enrich_documents(raw_documents, str(member))
 
-    paragraphs = await loop.run_in_executor(None, split_text, raw_documents)
-    documents = await asyncio.gather(
-        *[loop.run_in_executor(None, process_paragraph, paragraph, file_path) for paragraph in paragraphs])
-    return documents
 
+async def process_archive(file_path: str) -> List[Dict[str, Any]]:
+    # Členy se čtou postupně (TAR jinak číst nejde), zpracovávají se souběžně. Semafor omezuje
+    # počet rozpracovaných členů, a tedy i bufferů v paměti.
+    loop = asyncio.get_event_loop()
+    members = iter_archive(file_path)
+    slots = asyncio.Semaphore(ARCHIVE_CONCURRENCY)
 
-# Funkce pro načtení a zpracování dokumentů ve složce "data"
-async def load_and_process_documents():
-    logger.log_info("Zpracování dokumentů ve složce 'data'...")
-    db = MongoDB()  # Připojení k MongoDB
-    db.reload_localization()  # Načtení lokalizací
+    async def process(member):
+        try:
+            return await process_member(member)
+        finally:
+            member.close()
+            slots.release()
+
+    tasks = []
+    try:
+        while True:
+            await slots.acquire()
+            member = await loop.run_in_executor(None, next, members, None)
+            if member is None:
+                break
+            tasks.append(asyncio.ensure_future(process(member)))
+    finally:
+        # I při poškozeném archivu se doběhnou a uvolní už rozpracované členy
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        members.close()
 
     documents = []
-    file_paths = []
-    for root, _, files in os.walk('data'):
-        for file in files:
-            file_paths.append(os.path.join(root, file))
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+        documents.extend(result)
+    return documents
+
 
+async def process_document(file_path: str) -> List[Dict[str, Any]]:
+    # Prázdný seznam znamená soubor, o kterém víme, že nic k indexování nemá (nepodporovaný typ, prázdný
+    # soubor nebo jen prázdný text) a smí dostat checkpoint. Neúspěšná extrakce vyvolá ExtractionError,
+    # soubor checkpoint nedostane a zpracuje se znovu při dalším běhu.
     loop = asyncio.get_event_loop()
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        tasks = [process_document(file_path) for file_path in file_paths]
-        for future in asyncio.as_completed(tasks):
+    if is_archive(file_path):
+        with logger.span('extract_archive'):
+            documents = await process_archive(file_path)
+        if not documents:
+            raise ExtractionError(f"Žádný obsah nebyl extrahován z archivu {file_path}")
+    else:
+        file_type = await loop.run_in_executor(None, get_file_type, file_path)
+        raw_documents = await loop.run_in_executor(None, process_file, file_path, file_type)
+        if not raw_documents:
+            check_extracted(file_path, file_type, raw_documents)
+            logger.log_warning(f"Soubor {file_path} nemá obsah k indexování", key='extract_empty')
+            logger.count('files_empty')
+            return []
+        documents = await enrich_documents(raw_documents, file_path)
+
+    logger.count('files_processed')
+    logger.count('chunks_created', len(documents))
+    return documents
+
+
+def pending_files(db, directory):
+    # Soubory bez checkpointu nebo změněné od posledního zpracování (changed=True); ostatní se přeskočí
+    checkpoints = db.get_checkpoints()
+    files, done = [], []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            file_path = os.path.join(root, name)
+            file_hash = utils.calculate_file_hash(file_path)
+            checkpoint = checkpoints.get(file_path)
+            if checkpoint and checkpoint.get('file_hash') == file_hash:
+                done.append(file_path)
+            else:
+                files.append((file_path, file_hash, checkpoint is not None))
+    return files, done
+
+
+def plan_ingestion(directory='data'):
+    # Dry-run: kolik práce zbývá, bez zpracování a zápisu
+    db = MongoDB()
+    try:
+        files, done = pending_files(db, directory)
+    finally:
+        db.close_connection()
+    return {
+        "files": len(files) + len(done),
+        "done": len(done),
+        "remaining": len(files),
+        "changed": sum(1 for _, _, changed in files if changed),
+        "remaining_bytes": sum(os.path.getsize(file_path) for file_path, _, _ in files),
+    }
+
+
+@logger.timed('commit_file')
+def commit_file(db, file_path, file_hash, documents):
+    checkpoint = {"_id": file_path, "file_hash": file_hash, "chunks": len(documents),
+                  "finished_at": datetime.now(timezone.utc)}
+    db.commit_file('data', documents, checkpoint)
+
+
+def extract_sources(file_path):
+    # Dvojice (metadata.source, extrahovaný text) souboru, u archivu po jednotlivých členech.
+    # Chybějící soubor nebo neúspěšná extrakce vyvolá výjimku, re-indexace pak nic nesmaže.
+    # Chyba jednoho člena archivu neshodí ostatní; takový člen má místo textu None.
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(file_path)
+    if not is_archive(file_path):
+        file_type = get_file_type(file_path)
+        raw_documents = extract_file(file_path, file_type)
+        check_extracted(file_path, file_type, raw_documents)
+        return [(file_path, raw_documents)]
+    sources = []
+    for member in iter_archive(file_path):
+        with member:
             try:
-                result = await future
-                documents.extend(result)
+                raw_documents = extract_file(member, get_file_type(member))
             except Exception as e:
-                logger.log_warning(f"Chyba při zpracování souboru: {str(e)}")
+                logger.log_warning(f"Chyba při extrakci {member}: {e}", key='extract_error')
+                raw_documents = None
+            sources.append((str(member), raw_documents))
+    if not any(raw_documents for _, raw_documents in sources):
+        raise ExtractionError(f"Žádný obsah nebyl extrahován z archivu {file_path}")
+    return sources
+
+
+def source_filter(file_path):
+    # Chunky souboru, u archivu všech jeho členů
+    if is_archive(file_path):
+        return {"metadata.source": {"$regex": f"^{re.escape(file_path + ARCHIVE_SEPARATOR)}"}}
+    return {"metadata.source": file_path}
+
+
+@logger.timed('reindex')
+def reindex_file(db, file_path, file_hash=None):
+    # Přepočítá chunky souboru a porovná je s uloženými chunky stejného metadata.source. NLP obohacení
+    # běží jen pro nové chunky, zmizelé se smažou a nezměněným se nanejvýš opraví chunk_index.
+    paragraphs = {}
+    failed = set()
+    for source, raw_documents in extract_sources(file_path):
+        if raw_documents is None:
+            failed.add(source)
+        for paragraph in split_text(raw_documents) if raw_documents else []:
+            paragraphs.setdefault(chunk_id(source, paragraph['page_content']), (paragraph, source))
+
+    existing = {doc['_id']: doc.get('metadata', {}) for doc in db.get_collection('data').find(
+        source_filter(file_path), {"metadata.source": 1, "metadata.chunk_index": 1})}
+
+    added = [process_paragraph(paragraph, source)
+             for document_id, (paragraph, source) in paragraphs.items() if document_id not in existing]
+    # Chunky člena, jehož extrakce selhala, zůstávají až do další úspěšné re-indexace
+    removed = [document_id for document_id, metadata in existing.items()
+               if document_id not in paragraphs and metadata.get('source') not in failed]
+    # Zdroj je součástí id, nezměněnému chunku se může změnit jen pořadí
+    updates = {}
+    for document_id, metadata in existing.items():
+        if document_id in paragraphs and metadata.get('chunk_index') != paragraphs[document_id][0]['chunk_index']:
+            updates[document_id] = {"metadata.chunk_index": paragraphs[document_id][0]['chunk_index']}
+
+    if file_hash is None:
+        file_hash = utils.calculate_file_hash(file_path)
+    checkpoint = {"_id": file_path, "file_hash": file_hash, "chunks": len(paragraphs),
+                  "finished_at": datetime.now(timezone.utc)}
+    db.commit_file('data', added, checkpoint, removed_ids=removed, updates=updates)
 
-    for document in documents:
+    logger.count('chunks_inserted', len(added))
+    logger.count('chunks_removed', len(removed))
+    return {"added": len(added), "removed": len(removed), "unchanged": len(existing) - len(removed),
+            "moved": len(updates)}
+
+
+async def ingest_file(db, file_path, file_hash):
+    # Chunky se zapíší hned po zpracování souboru, spolu s jeho checkpointem
+    documents = await process_document(file_path)
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, commit_file, db, file_path, file_hash, documents)
+    logger.count('chunks_inserted', len(documents))
+    return len(documents)
+
+
+# Funkce pro načtení a zpracování dokumentů ve složce "data"
+async def load_and_process_documents(directory='data'):
+    logger.log_info(f"Zpracování dokumentů ve složce '{directory}'...")
+    run_start = time.perf_counter()
+    db = MongoDB()  # Připojení k MongoDB
+    db.reload_localization()  # Načtení lokalizací
+
+    loop = asyncio.get_event_loop()
+    # Ingestion nikdy nestahuje modely; chybějící model ukončí běh hned na začátku, ne u každého chunku
+    await loop.run_in_executor(None, tokenizer.ensure_nltk_data, True)
+
+    file_paths, done = pending_files(db, directory)
+    if done:
+        logger.log_info(f"Přeskočeno {len(done)} již zpracovaných souborů, zbývá {len(file_paths)}.")
+    logger.count('files_skipped', len(done))
+
+    # Změněné soubory se re-indexují rozdílově, nové projdou celým zpracováním
+    tasks = [loop.run_in_executor(None, reindex_file, db, file_path, file_hash) if changed
+             else ingest_file(db, file_path, file_hash) for file_path, file_hash, changed in file_paths]
+    for future in asyncio.as_completed(tasks):
         try:
-            await loop.run_in_executor(None, db.insert_document, 'data', document)
+            await future
         except Exception as e:
-            logger.log_warning(f"Chyba při vkládání dokumentu: {str(e)}")
+            # Soubor bez checkpointu se zpracuje při příštím běhu
+            logger.log_warning(f"Chyba při zpracování souboru: {str(e)}", key='file_error')
+            logger.count('files_failed')
 
-    await loop.run_in_executor(None, db.create_text_index, 'data', 'content')
+    # Index se staví jen poprvé (nebo v údržbě přes --maintenance), další běhy ho jen ověří
+    with logger.span('ensure_search_index'):
+        await loop.run_in_executor(None, db.ensure_search_index, 'data')
     db.close_connection()
     logger.log_info("Dokumenty byly zpracovány a uloženy do databáze.")
 
+    # Souhrn metrik za celý běh (JSON) a export pro Prometheus
+    if logger.metrics_enabled():
+        logger.METRICS.observe('ingestion_run', time.perf_counter() - run_start)
+        summary_path = logger.write_metrics_summary('ingestion')
+        logger.log_info(f"Souhrn metrik ingestion uložen do {summary_path}")
+        if os.getenv("RAG_METRICS_FILE"):
+            logger.write_prometheus(os.getenv("RAG_METRICS_FILE"))
+
 
 if __name__ == "__main__":
-    data_directory = 'data'
-    if not os.path.exists(data_directory):
-        os.makedirs(data_directory)
-    monitor_directory(data_directory, load_and_process_documents)
+    parser = argparse.ArgumentParser(description="Ingest documents into MongoDB")
+    parser.add_argument("directory", nargs="?", default="data", help="Directory with documents")
+    parser.add_argument("--dry-run", action="store_true", help="Only report how much work remains")
+    parser.add_argument("--reindex", type=str, help="Re-index a single modified file and exit")
+    parser.add_argument("--maintenance", action="store_true",
+                        help="Backfill the normalized search field and (re)build the text index")
+    args = parser.parse_args()
+
+    if args.maintenance:
+        mongo = MongoDB()
+        try:
+            updated = mongo.backfill_search_text('data')
+            created = mongo.ensure_search_index('data', replace=True)
+            print(f"Backfilled search_text for {updated} chunks, text index {'created' if created else 'present'}")
+        finally:
+            mongo.close_connection()
+    elif args.reindex:
+        mongo = MongoDB()
+        try:
+            print(reindex_file(mongo, args.reindex))
+        finally:
+            mongo.close_connection()
+    elif args.dry_run:
+        plan = plan_ingestion(args.directory)
+        print(f"{plan['done']}/{plan['files']} files done, {plan['remaining']} remaining "
+              f"({plan['changed']} changed, {plan['remaining_bytes'] / 1024 / 1024:.1f} MB)")
+    else:
+        if not os.path.exists(args.directory):
+            os.makedirs(args.directory)
+
+        def ingest():
+            asyncio.run(load_and_process_documents(args.directory))
+
+        # Nejdřív se zpracuje, co už ve složce je, pak se čeká na nové soubory
+        ingest()
+        monitor_directory(args.directory, ingest)
@@ -0,0 +1,250 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+import logger
+from database import MongoDB
+
+# Fronta ingestion jobů v MongoDB. Každý soubor je jeden job; worker si ho pronajme (lease),
+# průběžně prodlužuje heartbeatem a po dokončení označí jako hotový. Job, jehož lease vypršel
+# (worker spadl), si vezme jiný worker; po MAX_ATTEMPTS pokusech skončí jako failed.
+JOBS_COLLECTION = 'ingest_jobs'
+LEASE_SECONDS = float(os.getenv("INGEST_LEASE_SECONDS", "300"))
+MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+ENQUEUE_BATCH = 1000
+
+PENDING, LEASED, DONE, FAILED = 'pending', 'leased', 'done', 'failed'
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+class JobQueue:
+    def __init__(self, db, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.collection = db.get_collection(JOBS_COLLECTION)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.collection.create_index([("status", pymongo.ASCENDING), ("lease_expires", pymongo.ASCENDING)])
+        self.collection.create_index([("status", pymongo.ASCENDING), ("enqueued_at", pymongo.ASCENDING)])
+
+    def enqueue(self, directory):
+        # _id jobu je cesta k souboru; workery na dalších strojích musí vidět stejnou cestu (sdílené úložiště).
+        # Už zařazené soubory se přeskočí, opakované enqueue je proto bezpečné.
+        now = utcnow()
+        paths = [os.path.join(root, file) for root, _, files in os.walk(directory) for file in files]
+        jobs = [{"_id": path, "status": PENDING, "attempts": 0, "enqueued_at": now, "size": os.path.getsize(path)}
+                for path in paths]
+        added = 0
+        for start in range(0, len(jobs), ENQUEUE_BATCH):
+            try:
+                result = self.collection.insert_many(jobs[start:start + ENQUEUE_BATCH], ordered=False)
+                added += len(result.inserted_ids)
+            except BulkWriteError as e:
+                added += e.details.get("nInserted", 0)
+        return added
+
+    def lease(self, worker_id):
+        now = utcnow()
+        # Atomické převzetí: čekající job, nebo job s propadlým lease, který ještě nevyčerpal pokusy
+        return self.collection.find_one_and_update(
+            {"attempts": {"$lt": self.max_attempts},
+             "$or": [{"status": PENDING}, {"status": LEASED, "lease_expires": {"$lt": now}}]},
+            {"$set": {"status": LEASED, "worker": worker_id, "leased_at": now,
+                      "lease_expires": now + timedelta(seconds=self.lease_seconds)},
+             "$inc": {"attempts": 1}},
+            sort=[("enqueued_at", pymongo.ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+    def heartbeat(self, job_id, worker_id):
+        # False znamená, že lease mezitím převzal jiný worker
+        result = self.collection.update_one(
+            {"_id": job_id, "worker": worker_id, "status": LEASED},
+            {"$set": {"lease_expires": utcnow() + timedelta(seconds=self.lease_seconds)}})
+        return result.matched_count == 1
+
+    def complete(self, job_id, worker_id, chunks):
+        result = self.collection.update_one(
+            {"_id": job_id, "worker": worker_id, "status": LEASED},
+            {"$set": {"status": DONE, "chunks": chunks, "finished_at": utcnow()},
+             "$unset": {"lease_expires": ""}})
+        return result.matched_count == 1
+
+    def fail(self, job_id, worker_id, error):
+        job = self.collection.find_one({"_id": job_id, "worker": worker_id, "status": LEASED})
+        if job is None:
+            return False
+        status = FAILED if job["attempts"] >= self.max_attempts else PENDING
+        self.collection.update_one(
+            {"_id": job_id, "worker": worker_id, "status": LEASED},
+            {"$set": {"status": status, "error": error}, "$unset": {"worker": "", "lease_expires": ""}})
+        return True
+
+    def reap_expired(self):
+        # Propadlé leasy bez zbývajících pokusů už nikdo nepřevezme, označíme je jako failed
+        result = self.collection.update_many(
+            {"status": LEASED, "lease_expires": {"$lt": utcnow()}, "attempts": {"$gte": self.max_attempts}},
+            {"$set": {"status": FAILED, "error": "lease expired"}, "$unset": {"worker": "", "lease_expires": ""}})
+        return result.modified_count
+
+    def progress(self):
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        for row in self.collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1},
+                                                          "chunks": {"$sum": "$chunks"}}}]):
+            counts[row["_id"]] = row["count"]
+            if row["_id"] == DONE:
+                counts["chunks"] = row["chunks"]
+        counts["total"] = sum(counts[status] for status in (PENDING, LEASED, DONE, FAILED))
+        return counts
+
+
+class Heartbeat:
+    def __init__(self, queue, job_id, worker_id):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_seconds / 3):
+            if not self.queue.heartbeat(self.job_id, self.worker_id):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+def process_job(db, path, still_leased=lambda: True):
+    # Importuje se až ve workeru, koordinátor ingestion knihovny nepotřebuje
+    import fill_db
+    import utils
+
+    documents = asyncio.run(fill_db.process_document(path))
+    # Job, o který worker během zpracování přišel, nezapisuje; vrací None
+    if not still_leased():
+        return None
+    # Stejný zápis jako lokální ingestion: chunky i checkpoint souboru najednou
+    fill_db.commit_file(db, path, utils.calculate_file_hash(path), documents)
+    return len(documents)
+
+
+def run_worker(db, queue, worker_id=None, stop_when_empty=True, poll_interval=2.0):
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    processed = 0
+    while True:
+        job = queue.lease(worker_id)
+        if job is None:
+            if stop_when_empty:
+                return processed
+            time.sleep(poll_interval)
+            continue
+
+        logger.log_info(f"Worker {worker_id} zpracovává {job['_id']} (pokus {job['attempts']})")
+        try:
+            with Heartbeat(queue, job['_id'], worker_id) as heartbeat:
+                def still_leased():
+                    # Před zápisem se lease ještě jednou prodlouží, tím se zároveň ověří, že job pořád patří nám
+                    return not heartbeat.lost and queue.heartbeat(job['_id'], worker_id)
+
+                chunks = process_job(db, job['_id'], still_leased)
+            if chunks is None:
+                logger.log_warning(f"Lease jobu {job['_id']} převzal jiný worker, výsledek se nezapsal")
+            elif not queue.complete(job['_id'], worker_id, chunks):
+                # Zápis chunků i checkpointu je idempotentní, souběžné zpracování jiným workerem nevadí
+                logger.log_warning(f"Lease jobu {job['_id']} vypršel až po zápisu, job dokončí jiný worker")
+            else:
+                processed += 1
+        except Exception as e:
+            logger.log_warning(f"Chyba při zpracování {job['_id']}: {str(e)}", key='job_error')
+            queue.fail(job['_id'], worker_id, f"{type(e).__name__}: {e}")
+
+
+def _worker_process(log_queue, stop_when_empty):
+    import tokenizer
+
+    logger.setup_worker_logging(log_queue)
+    # Modely se načtou předem a jen z lokálních dat, první job tak běží plnou rychlostí
+    tokenizer.ensure_nltk_data(offline=True)
+    db = MongoDB()
+    try:
+        run_worker(db, JobQueue(db), stop_when_empty=stop_when_empty)
+    finally:
+        db.close_connection()
+
+
+def print_progress(progress):
+    print(f"{progress[DONE]}/{progress['total']} done, {progress[LEASED]} in progress, {progress[PENDING]} pending, "
+          f"{progress[FAILED]} failed, {progress.get('chunks', 0)} chunks")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distributed ingestion through a MongoDB job queue")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add all files of a directory tree to the queue")
+    enqueue_parser.add_argument("directory", type=str, help="Directory to ingest")
+
+    worker_parser = subparsers.add_parser("worker", help="Process jobs from the queue")
+    worker_parser.add_argument("--processes", type=int, default=1, help="Number of local worker processes")
+    worker_parser.add_argument("--wait", action="store_true", help="Keep polling when the queue is empty")
+
+    status_parser = subparsers.add_parser("status", help="Report the progress of the queue")
+    status_parser.add_argument("--watch", type=float, default=0, help="Refresh every N seconds until finished")
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        # Procesy si otevírají vlastní MongoClient; klient vytvořený před forkem by sdílel sokety a zámky
+        log_queue = logger.setup_logging(multiprocess=True)
+        processes = [multiprocessing.Process(target=_worker_process, args=(log_queue, not args.wait))
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    db = MongoDB()
+    queue = JobQueue(db)
+    try:
+        if args.command == "enqueue":
+            added = queue.enqueue(args.directory)
+            print(f"Enqueued {added} new files from {args.directory}")
+            print_progress(queue.progress())
+
+        elif args.command == "worker":
+            # Textový index stačí ověřit jednou na konci, vytvoří se jen poprvé
+            db.ensure_search_index('data')
+            print_progress(queue.progress())
+
+        elif args.command == "status":
+            while True:
+                queue.reap_expired()
+                progress = queue.progress()
+                print_progress(progress)
+                if not args.watch or progress[PENDING] + progress[LEASED] == 0:
+                    break
+                time.sleep(args.watch)
+    finally:
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,15 @@
+import atexit
+import copy
+import functools
+import json
 import logging
+import multiprocessing
+import queue
+import threading
+import time
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import QueueHandler, QueueListener
 import os
 
 # Definujeme novou úroveň logování
@@ -7,45 +17,357 @@ USER = 25
 logging.addLevelName(USER, 'USER')
 
 
-def setup_logging():
-    log_directory = 'logs'
-    if not os.path.exists(log_directory):
-        os.makedirs(log_directory)
+_logger = logging.getLogger('DocumentProcessor')
 
-    # Použij pomlčky místo dvojteček v časovém razítku
-    current_time = datetime.now().strftime("log-%d-%m-%Y-%H-%M-%S")
-    log_file_path = os.path.join(log_directory, f"{current_time}.txt")
+_log_queue = None
+_listener = None
+_setup_lock = threading.Lock()
 
-    # Nastavení formátu logování
-    log_format = '%(asctime)s - %(levelname)s - %(message)s'
-    formatter = logging.Formatter(log_format)
 
-    # Vytvoření logovacího handleru pro zápis do souboru
-    file_handler = logging.FileHandler(log_file_path, mode='w', encoding='utf-8')
-    file_handler.setFormatter(formatter)
+class JsonFormatter(logging.Formatter):
+    # Jeden záznam = jeden řádek JSON (JSON Lines)
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if getattr(record, 'key', None):
+            entry["key"] = record.key
+        if getattr(record, 'suppressed', None):
+            entry["suppressed"] = record.suppressed
+        exception = getattr(record, 'exception', None)
+        if record.exc_info:
+            exception = self.formatException(record.exc_info)
+        if exception:
+            entry["exception"] = exception
+        return json.dumps(entry, ensure_ascii=False)
 
-    # Vytvoření logovacího handleru pro výpis na konzoli
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
 
-    # Konfigurace globálního logování
-    logging.basicConfig(level=logging.INFO, handlers=[file_handler, console_handler])
+class ConsoleFormatter(logging.Formatter):
+    # Traceback, který prošel frontou jako text (viz StructuredQueueHandler), vypíše i na konzoli
+    def format(self, record):
+        message = super().format(record)
+        exception = getattr(record, 'exception', None)
+        return f"{message}\n{exception}" if exception and not record.exc_info else message
 
+
+class StructuredQueueHandler(QueueHandler):
+    # QueueHandler.prepare vloží traceback do textu zprávy a exc_info zahodí (musí jít picklovat do jiného
+    # procesu). Traceback proto předáme jako text ve vlastním atributu pro pole "exception" v JSON.
+    def prepare(self, record):
+        exception = None
+        if record.exc_info:
+            exception = logging.Formatter().formatException(record.exc_info)
+            record = copy.copy(record)
+            record.exc_info = None
+            record.exc_text = None
+        record = super().prepare(record)
+        if exception:
+            record.exception = exception
+        return record
+
+
+def setup_logging(multiprocess=False):
+    # Handlery pro soubor a konzoli běží v jednom vlákně QueueListeneru, pracovní vlákna jen vkládají
+    # záznamy do fronty. Opakované volání (např. rerun Streamlitu) nic nemění.
+    global _log_queue, _listener
+    with _setup_lock:
+        if _listener is not None:
+            return _log_queue
+
+        log_directory = 'logs'
+        if not os.path.exists(log_directory):
+            os.makedirs(log_directory)
+
+        # Použij pomlčky místo dvojteček v časovém razítku
+        current_time = datetime.now().strftime("log-%d-%m-%Y-%H-%M-%S")
+        log_file_path = os.path.join(log_directory, f"{current_time}.jsonl")
+
+        # Vytvoření logovacího handleru pro zápis do souboru
+        file_handler = logging.FileHandler(log_file_path, mode='w', encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter())
+
+        # Vytvoření logovacího handleru pro výpis na konzoli
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ConsoleFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+        # Fronta z multiprocessing je potřeba jen tehdy, když do ní zapisují i procesy z ProcessPoolExecutoru
+        _log_queue = multiprocessing.Queue(-1) if multiprocess else queue.Queue(-1)
+        _listener = QueueListener(_log_queue, file_handler, console_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_logging)
+
+        _install_queue_handler(_log_queue)
+        return _log_queue
+
+
+def _install_queue_handler(log_queue):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(StructuredQueueHandler(log_queue))
     # Ujistěte se, že všechny logy od debug a výše jsou zachyceny
-    # logging.getLogger().setLevel(logging.DEBUG)
-    logging.getLogger().setLevel(logging.INFO)
+    # root.setLevel(logging.DEBUG)
+    root.setLevel(logging.INFO)
+
+
+def setup_worker_logging(log_queue):
+    # Initializer pro ProcessPoolExecutor: proces jen posílá záznamy do fronty hlavního procesu
+    if log_queue is not None:
+        _install_queue_handler(log_queue)
+
+
+def stop_logging():
+    global _listener
+    flush_suppressed(force=True)
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+class RateLimiter:
+    # Propustí nejvýše `limit` zpráv se stejným klíčem za `interval` sekund, zbytek jen počítá (a pamatuje si
+    # poslední potlačenou zprávu jako vzorek). Počty potlačených zpráv z uplynulých oken vrací expired();
+    # procházení oken je amortizované, proběhne nejvýš jednou za `interval`.
+    def __init__(self, limit=10, interval=60.0):
+        self.limit = limit
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.next_sweep = time.monotonic() + interval
+
+    def allow(self, key, message=None):
+        now = time.monotonic()
+        with self.lock:
+            window_start, count, suppressed, sample = self.windows.get(key, (now, 0, 0, None))
+            if now - window_start >= self.interval:
+                self.windows[key] = (now, 1, 0, None)
+                return True, suppressed
+            if count < self.limit:
+                self.windows[key] = (window_start, count + 1, suppressed, sample)
+                return True, 0
+            self.windows[key] = (window_start, count, suppressed + 1, message)
+            return False, 0
+
+    def expired(self, force=False):
+        # Mimo sweep stojí volání jen porovnání času, bez zámku a bez procházení oken
+        now = time.monotonic()
+        if not force and now < self.next_sweep:
+            return []
+        with self.lock:
+            self.next_sweep = now + self.interval
+            expired = [key for key, (window_start, _, _, _) in self.windows.items()
+                       if force or now - window_start >= self.interval]
+            windows = [(key, self.windows.pop(key)) for key in expired]
+        return [(key, suppressed, sample) for key, (_, _, suppressed, sample) in windows if suppressed]
+
+
+_rate_limiter = RateLimiter(int(os.getenv("LOG_RATE_LIMIT", "10")), float(os.getenv("LOG_RATE_INTERVAL", "60")))
 
 
 def log_user(message):
-    logger = logging.getLogger('DocumentProcessor')
-    logger.log(USER, message)
+    _logger.log(USER, message)
+
 
+def flush_suppressed(force=False):
+    # Souhrn potlačených varování za uplynulá okna s poslední potlačenou zprávou jako vzorkem
+    # (při ukončení za všechna okna)
+    for key, suppressed, sample in _rate_limiter.expired(force):
+        _logger.warning(f"Potlačeno {suppressed} varování '{key}', poslední: {sample}",
+                        extra={"key": key, "suppressed": suppressed})
 
-def log_warning(message):
-    logger = logging.getLogger('DocumentProcessor')
-    logger.warning(message)
+
+def log_warning(message, key=None):
+    if key is None:
+        _logger.warning(message)
+        return
+
+    # Limit platí pro celou kategorii (key); zprávy chyb jednotlivých souborů se liší cestou i chybou
+    flush_suppressed()
+    allowed, suppressed = _rate_limiter.allow(key, message)
+    if allowed:
+        _logger.warning(message, extra={"key": key, "suppressed": suppressed})
 
 
 def log_info(message):
-    logger = logging.getLogger('DocumentProcessor')
+    _logger.info(message)
+
+
+# Měření doby trvání jednotlivých fází (ingestion, dotazy). Vypnuté měření nesmí nic stát.
+_metrics_enabled = os.getenv("RAG_METRICS", "0") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "stages": {
+                    name: {
+                        "count": histogram["count"],
+                        "seconds": histogram["sum"],
+                        "mean_ms": histogram["sum"] / histogram["count"] * 1000 if histogram["count"] else 0.0,
+                        "buckets": {str(bound): n for bound, n in zip(self.buckets, histogram["buckets"])},
+                    }
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self):
+        lines = ["# TYPE rag_events_total counter"]
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'rag_events_total{{event="{name}"}} {value}')
+            lines.append("# TYPE rag_stage_duration_seconds histogram")
+            for name, histogram in sorted(self.histograms.items()):
+                for bound, n in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f'rag_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {n}')
+                lines.append(f'rag_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'rag_stage_duration_seconds_sum{{stage="{name}"}} {histogram["sum"]}')
+                lines.append(f'rag_stage_duration_seconds_count{{stage="{name}"}} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        METRICS.observe(self.name, time.perf_counter() - self.start)
+        if exc_type is not None:
+            METRICS.inc(f"{self.name}_errors")
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable_metrics(enabled=True):
+    global _metrics_enabled
+    _metrics_enabled = enabled
+
+
+def metrics_enabled():
+    return _metrics_enabled
+
+
+def span(name):
+    if not _metrics_enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _metrics_enabled:
+                return function(*args, **kwargs)
+            with _Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    if _metrics_enabled:
+        METRICS.inc(name, value)
+
+
+def write_prometheus(file_path):
+    # Zápis přes dočasný soubor, aby node_exporter (textfile collector) nikdy nečetl rozepsaný soubor
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(METRICS.to_prometheus())
+    os.replace(tmp_path, file_path)
+
+
+def write_metrics_summary(name, output_folder='outputs/metrics'):
+    os.makedirs(output_folder, exist_ok=True)
+    file_path = os.path.join(output_folder, f"{name}-{datetime.now().strftime('%d-%m-%Y-%H-%M-%S')}.json")
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(METRICS.snapshot(), f, ensure_ascii=False, indent=2)
+    return file_path
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+
 
+def start_metrics_server(port, host='0.0.0.0'):
+    global _metrics_server
+    if _metrics_server is None:
+        _metrics_server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
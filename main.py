@@ -1,23 +1,31 @@
 import asyncio
+import uuid
 import streamlit as st
+import logger
 from logger import setup_logging
 
 # Inicializace session state pro jazyk a historii
 if 'language' not in st.session_state:
     st.session_state.language = 'cs'  # Výchozí jazyk
 
+# Historie se ukládá do MongoDB; v session state je identifikátor session a už načtené záznamy
+# (nejnovější první), takže další běh skriptu dotahuje jen nové záznamy
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 if 'history' not in st.session_state:
-    st.session_state.history = []  # Inicializace historie jako prázdný seznam
+    st.session_state.history = []
+    st.session_state.has_older_history = False
 
 # Konfigurace stránky - musí být první Streamlit příkaz
 st.set_page_config(page_title="RAG4u", layout="wide")
 
+import qa
 import settings
 import utils
 from openai import OpenAI
 from dotenv import load_dotenv
 import os
-from fill_db import load_and_process_documents
 from utils import get_mongodb_client
 
 
@@ -25,33 +33,50 @@ utils.setup_directories()
 load_dotenv()
 
 async def load_database():
+    # Ingestion (PyMuPDF, pandas, NLTK, ...) se načítá jen při plnění databáze, ne v každém workeru UI
+    from fill_db import load_and_process_documents
     await load_and_process_documents()
 
 db = get_mongodb_client()
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-def get_relevant_documents(query, n_results):
-    results = db.search_documents('data', query, n_results)
-    return results
+# Export metrik pro Prometheus (RAG_METRICS=1, RAG_METRICS_PORT=9108); server se spustí jen jednou
+if logger.metrics_enabled() and os.getenv("RAG_METRICS_PORT"):
+    logger.start_metrics_server(int(os.getenv("RAG_METRICS_PORT")))
+
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "5"))
+
+def refresh_history():
+    # Poprvé se načte jedna stránka (o záznam navíc, abychom věděli, jestli existují starší záznamy),
+    # potom už jen záznamy přidané od nejnovějšího načteného
+    history = st.session_state.history
+    if not history:
+        page = db.get_history(st.session_state.session_id, limit=HISTORY_PAGE_SIZE + 1)
+        st.session_state.has_older_history = len(page) > HISTORY_PAGE_SIZE
+        st.session_state.history = page[:HISTORY_PAGE_SIZE]
+    else:
+        st.session_state.history = db.get_history(st.session_state.session_id, limit=0, after=history[0]) + history
 
-def get_openai_response(system_prompt, user_query, relevant_docs):
-    context = "\n".join([doc['content'] for doc in relevant_docs])
+def load_older_history():
+    # Další stránka starších záznamů; už načtené stránky se znovu nenačítají
+    page = db.get_history(st.session_state.session_id, limit=HISTORY_PAGE_SIZE + 1,
+                          before=st.session_state.history[-1])
+    st.session_state.has_older_history = len(page) > HISTORY_PAGE_SIZE
+    st.session_state.history += page[:HISTORY_PAGE_SIZE]
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {user_query}"}
-    ]
+def show_history_entries(entries):
+    for entry in reversed(entries):
+        st.write(f"**{settings.t('query')}:** {entry['query']}")
+        st.write(f"**{settings.t('ai_response')}:** {entry['response']}")
 
-    response = openai_client.chat.completions.create(
-        model=os.getenv("OPENAI_MODEL", "gpt-4o"),
-        messages=messages
-    )
-    return response.choices[0].message.content, response
+def submit_query(query, n_results):
+    # Vyhledání, odpověď, evidence spotřeby tokenů session (včetně rozpočtu SESSION_TOKEN_BUDGET) a záznam historie
+    return qa.submit_query(db, openai_client, st.session_state.session_id, query, n_results)
 
 st.title(settings.t("title"))
 
 st.sidebar.header(settings.t("configuration"))
-n_results = st.sidebar.slider(settings.t("num_results"), 1, 5, 1)
+n_results = st.sidebar.slider(settings.t("num_results"), 1, 20, 1)
 
 languages = ["en", "cs"]
 selected_language = st.sidebar.selectbox(
@@ -62,12 +87,22 @@ selected_language = st.sidebar.selectbox(
 )
 st.session_state.language = selected_language
 
+# Spotřeba tokenů LLM v této session; vyplní se až na konci skriptu, aby zahrnula i právě odeslaný dotaz
+usage_caption = st.sidebar.empty()
+
 # Zobrazení historie dotazů v session
 st.sidebar.markdown("---")
 st.subheader(settings.t("session_history"))
-for entry in st.session_state.history:
-    st.write(f"**{settings.t('query')}:** {entry['query']}")
-    st.write(f"**{settings.t('ai_response')}:** {entry['response']}")
+refresh_history()
+recent_history = st.session_state.history[:HISTORY_PAGE_SIZE]
+older_history = st.session_state.history[HISTORY_PAGE_SIZE:]
+# Starší záznamy jsou ve sbaleném expanderu a načítají se až na požádání
+if older_history or st.session_state.has_older_history:
+    with st.expander(f"{settings.t('load_older')} ({len(older_history)})", expanded=False):
+        if st.session_state.has_older_history:
+            st.button(settings.t("load_older"), on_click=load_older_history)
+        show_history_entries(older_history)
+show_history_entries(recent_history)
 
 # Uživatelský vstup pro dotaz
 query = st.text_input(settings.t("enter_question"))
@@ -76,31 +111,42 @@ query = st.text_input(settings.t("enter_question"))
 if st.button(settings.t("submit")):
     if query:
         with st.spinner(settings.t("searching")):
-            relevant_docs = get_relevant_documents(query, n_results)
-
-            system_prompt = f"""
-            You are a helpful assistant. You answer questions based only on the knowledge I'm providing you.
-            You don't use your internal knowledge and you don't make things up.
-            If you don't know the answer, you can say "I don't know" or "Nevím". Always answer in Czech.
-            """
-            response_content, response = get_openai_response(system_prompt, query, relevant_docs)
-            st.session_state.history.append({
-                "query": query,
-                "response": response_content,
-                "tokens": [doc['metadata']['tokens'] for doc in relevant_docs],
-                "sources": [doc['metadata']['source'] for doc in relevant_docs]
-            })
-            st.write(response_content)
+            try:
+                response_content, _, _ = submit_query(query, n_results)
+            except qa.BudgetExceeded:
+                st.warning(settings.t("budget_exceeded"))
+            else:
+                st.write(response_content)
     else:
         st.warning(settings.t("warning"))
 
+session_usage = db.get_session_usage(st.session_state.session_id)
+budget_note = f" / {qa.SESSION_TOKEN_BUDGET}" if qa.SESSION_TOKEN_BUDGET else ""
+usage_caption.caption(f"LLM tokens: {session_usage['total_tokens']}{budget_note} ({session_usage['queries']} queries)")
+
 # Tlačítko pro zobrazení odpovědi s tokeny a zdroji
 if st.button(settings.t("show_history")):
-    if st.session_state.history:
-        last_entry = st.session_state.history[-1]
+    last_entries = db.get_history(st.session_state.session_id, limit=1)
+    if last_entries:
+        last_entry = last_entries[0]
         st.write(f"**{settings.t('query')}:** {last_entry['query']}")
         st.write(f"**{settings.t('ai_response')}:** {last_entry['response']}")
-        st.write(f"**Tokens:** {last_entry['tokens']}")
+        # Spotřeba LLM (tokeny promptu a odpovědi) je uložená přímo v záznamu historie
+        usage = last_entry.get('usage')
+        if usage:
+            st.write(f"**LLM tokens:** prompt {usage['prompt_tokens']}, completion {usage['completion_tokens']} "
+                     f"(retrieval {usage['retrieval_ms']:.0f} ms, LLM {usage['llm_ms']:.0f} ms)")
+            # Starší záznamy statistiku ořezu podle skóre nemají
+            if 'trimmed_documents' in usage:
+                st.write(f"**Context:** {usage['documents']} documents, {usage['trimmed_documents']} weak matches "
+                         f"trimmed (~{usage['trimmed_tokens']} tokens)")
+        # NLTK tokeny použitých chunků se načítají z MongoDB až při zobrazení; starší záznamy je mají v 'tokens'
+        if 'tokens' in last_entry:
+            chunk_tokens = last_entry['tokens']
+        else:
+            chunk_tokens = [doc['metadata'].get('tokens') for doc in
+                            db.fetch_metadata('data', last_entry.get('ids', []), fields=['metadata.tokens'])]
+        st.write(f"**Chunk tokens:** {chunk_tokens}")
         st.write(f"**Sources:** {last_entry['sources']}")
     else:
         st.warning(settings.t("no_history"))
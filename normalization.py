@@ -0,0 +1,18 @@
+import re
+import unicodedata
+
+# Normalizace textu pro vyhledávání. Modul nemá závislosti na databázi ani Streamlitu,
+# aby ho mohl používat database.py i ingestion bez cyklických importů.
+
+_WORD = re.compile(r'\w+')
+
+
+def remove_diacritics(input_str):
+    nfkd_form = unicodedata.normalize('NFKD', input_str)
+    return ''.join([c for c in nfkd_form if not unicodedata.combining(c)])
+
+
+def normalize_search_text(text):
+    # Malá písmena, bez diakritiky, slova oddělená mezerou; textový index s jazykem "none" je pak
+    # už jen rozdělí, nestemmuje je ani nevyřazuje stop slova
+    return ' '.join(_WORD.findall(remove_diacritics(text).lower()))
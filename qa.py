@@ -0,0 +1,364 @@
+import asyncio
+import os
+import time
+
+from dotenv import load_dotenv
+
+import logger
+import rerank as rerank_module
+from database import SEARCH_FIELDS
+
+load_dotenv()
+
+# Společná logika dotazů pro Streamlit UI (main.py), HTTP službu (api.py) i dávkové zpracování.
+# Nesmí importovat Streamlit ani ingestion, aby šla použít v lehkých workerech.
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Hrubý odhad pro češtinu i angličtinu; přesný tokenizer by vyžadoval další závislost
+CHARS_PER_TOKEN = 4
+
+# Rozpočet tokenů LLM (prompt + odpověď) na session; 0 = bez omezení
+SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", "0"))
+# Rezerva na odpověď modelu (zároveň max_tokens odpovědi, aby ji model nepřekročil) a nejmenší kontext,
+# se kterým má smysl dotaz vůbec posílat
+COMPLETION_TOKEN_RESERVE = int(os.getenv("COMPLETION_TOKEN_RESERVE", "500"))
+MIN_CONTEXT_TOKENS = int(os.getenv("MIN_CONTEXT_TOKENS", "200"))
+# Ceny za 1000 tokenů pro odhad nákladů; bez nastavení se náklady evidují jako 0
+PROMPT_PRICE_PER_1K = float(os.getenv("OPENAI_PROMPT_PRICE_PER_1K", "0"))
+COMPLETION_PRICE_PER_1K = float(os.getenv("OPENAI_COMPLETION_PRICE_PER_1K", "0"))
+
+# Výběr dokumentů podle skóre: dokument slabší než SCORE_CUTOFF × skóre nejlepšího se do kontextu nepošle.
+# Výchozí 0 ořez vypíná a do kontextu jde vždy n_results dokumentů; zapíná se např. SCORE_CUTOFF=0.5.
+# S ADAPTIVE_K=1 je n_results jen výchozí počet, k roste až do ADAPTIVE_MAX_RESULTS, dokud skóre
+# dalšího dokumentu neklesne pod SCORE_DROP_OFF × skóre předchozího.
+SCORE_CUTOFF = float(os.getenv("SCORE_CUTOFF", "0"))
+ADAPTIVE_K = os.getenv("ADAPTIVE_K", "0") == "1"
+ADAPTIVE_MAX_RESULTS = int(os.getenv("ADAPTIVE_MAX_RESULTS", "10"))
+SCORE_DROP_OFF = float(os.getenv("SCORE_DROP_OFF", "0.5"))
+
+SYSTEM_PROMPT = """
+You are a helpful assistant. You answer questions based only on the knowledge I'm providing you.
+You don't use your internal knowledge and you don't make things up.
+If you don't know the answer, you can say "I don't know" or "Nevím". Always answer in Czech.
+"""
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def openai_model():
+    return os.getenv("OPENAI_MODEL", "gpt-4o")
+
+
+def document_score(doc):
+    # Po přeřazení rozhoduje skóre rerankeru, jinak textScore z MongoDB; shoda podle _id skóre nemá
+    return doc.get('rerank_score', doc.get('score'))
+
+
+def select_by_score(results, n_results, cutoff=SCORE_CUTOFF, adaptive=False, drop_off=SCORE_DROP_OFF):
+    # Výsledky jsou seřazené sestupně podle skóre, první dokument se bere vždy
+    scores = [document_score(doc) for doc in results]
+    limit = len(results) if adaptive else min(n_results, len(results))
+    # Po přeřazení omezeném rozpočtem mají jen první dokumenty skóre rerankeru, škály nejdou porovnat
+    mixed = len({'rerank_score' in doc for doc in results[:limit]}) > 1
+    if not results or mixed or any(score is None for score in scores[:limit]):
+        selected = results[:n_results]
+    else:
+        selected = results[:1]
+        for previous, doc, score in zip(scores, results[1:limit], scores[1:limit]):
+            if score < cutoff * scores[0] or (adaptive and score < drop_off * previous):
+                break
+            selected.append(doc)
+
+    dropped = results[len(selected):min(n_results, len(results))]
+    stats = {
+        "candidates": len(results),
+        "selected": len(selected),
+        "trimmed_documents": len(dropped),
+        "trimmed_tokens": sum(estimate_tokens(doc.get('content', '')) for doc in dropped),
+        "top_score": scores[0] if results else None,
+    }
+    return selected, stats
+
+
+def retrieve_documents(db, query, n_results, rerank=None, adaptive=None):
+    # S přeřazením se z MongoDB bere větší množina kandidátů a lokálně se z ní vybere n_results nejlepších.
+    # Slabé shody se pak oříznou podle skóre; vrací dokumenty a statistiku ořezu.
+    if rerank is None:
+        rerank = rerank_module.RERANK_ENABLED
+    if adaptive is None:
+        adaptive = ADAPTIVE_K
+    k = max(n_results, ADAPTIVE_MAX_RESULTS) if adaptive else n_results
+    limit = max(k, rerank_module.RERANK_CANDIDATES) if rerank else k
+
+    fields = SEARCH_FIELDS + rerank_module.RERANK_FIELDS if rerank else SEARCH_FIELDS
+
+    with logger.span('search_documents'):
+        results = db.search_documents('data', query, limit, fields=fields)
+    if rerank:
+        results = rerank_module.rerank(query, results, k)
+    results, stats = select_by_score(results, n_results, adaptive=adaptive)
+    logger.count('trimmed_documents', stats['trimmed_documents'])
+    return results, stats
+
+
+def get_relevant_documents(db, query, n_results, rerank=None, adaptive=None):
+    return retrieve_documents(db, query, n_results, rerank, adaptive)[0]
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+# Kratší shoda na hranici chunků může být náhodná (např. stejné slovo), nepovažujeme ji za překryv
+MIN_OVERLAP = 8
+
+
+def _overlap(previous, following, max_overlap=200):
+    # Délka nejdelšího konce `previous`, kterým začíná `following` (překryv chunků ze splitteru)
+    for length in range(min(len(previous), len(following), max_overlap), 0, -1):
+        if previous.endswith(following[:length]):
+            return length
+    return 0
+
+
+def _merge_group(documents):
+    # Spojí chunky jednoho zdroje a strany do souvislých bloků bez opakovaného textu.
+    # Sousední chunky (podle metadata.chunk_index nebo textového překryvu) tvoří jeden blok.
+    if all('chunk_index' in doc['metadata'] for doc, _ in documents):
+        documents = sorted(documents, key=lambda item: item[0]['metadata']['chunk_index'])
+
+    blocks = []
+    for doc, rank in documents:
+        text = doc['content']
+        index = doc['metadata'].get('chunk_index')
+        if blocks:
+            block = blocks[-1]
+            if text in block['text']:
+                block['rank'] = min(block['rank'], rank)
+                block['chunks'] += 1
+                continue
+            overlap = _overlap(block['text'], text)
+            if index is not None and block['last_index'] is not None:
+                adjacent = index == block['last_index'] + 1
+            else:
+                adjacent = overlap >= MIN_OVERLAP
+            if adjacent:
+                block['text'] += text[overlap:] if overlap >= MIN_OVERLAP else "\n" + text
+                block['rank'] = min(block['rank'], rank)
+                block['last_index'] = index
+                block['chunks'] += 1
+                continue
+        blocks.append({"text": text, "rank": rank, "last_index": index, "chunks": 1,
+                       "source": doc['metadata'].get('source'), "page": doc['metadata'].get('page', 0)})
+    return blocks
+
+
+def build_context(relevant_docs, token_budget=CONTEXT_TOKEN_BUDGET):
+    groups = {}
+    for rank, doc in enumerate(relevant_docs):
+        key = (doc['metadata'].get('source'), doc['metadata'].get('page', 0))
+        groups.setdefault(key, []).append((doc, rank))
+
+    blocks = sorted((block for group in groups.values() for block in _merge_group(group)),
+                    key=lambda block: block['rank'])
+
+    # Bloky se berou v pořadí relevance, dokud se vejdou do rozpočtu tokenů
+    parts, used_tokens, used_chunks = [], 0, 0
+    for block in blocks:
+        text = f"[Source: {block['source']}, page {block['page']}]\n{block['text'].strip()}"
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens > token_budget:
+            if parts:
+                continue
+            # Ani nejlepší blok se nevejde celý, vezmeme aspoň jeho začátek
+            text = text[:token_budget * CHARS_PER_TOKEN]
+            tokens = estimate_tokens(text)
+        parts.append(text)
+        used_tokens += tokens
+        used_chunks += block['chunks']
+
+    stats = {"documents": len(relevant_docs), "blocks": len(parts), "chunks_used": used_chunks,
+             "tokens": used_tokens}
+    return "\n\n".join(parts), stats
+
+
+def build_messages(system_prompt, user_query, relevant_docs, token_budget=CONTEXT_TOKEN_BUDGET):
+    with logger.span('prompt_assembly'):
+        context, _ = build_context(relevant_docs, token_budget)
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {user_query}"}
+        ]
+    return messages
+
+
+def get_openai_response(openai_client, system_prompt, user_query, relevant_docs,
+                        token_budget=CONTEXT_TOKEN_BUDGET):
+    messages = build_messages(system_prompt, user_query, relevant_docs, token_budget)
+
+    with logger.span('llm_completion'):
+        response = openai_client.chat.completions.create(
+            model=openai_model(),
+            messages=messages,
+            max_tokens=COMPLETION_TOKEN_RESERVE
+        )
+    logger.count('queries')
+    return response.choices[0].message.content, response
+
+
+async def get_openai_response_async(openai_client, system_prompt, user_query, relevant_docs,
+                                    token_budget=CONTEXT_TOKEN_BUDGET):
+    # Stejné jako get_openai_response, jen pro AsyncOpenAI klienta
+    messages = build_messages(system_prompt, user_query, relevant_docs, token_budget)
+
+    with logger.span('llm_completion'):
+        response = await openai_client.chat.completions.create(
+            model=openai_model(),
+            messages=messages,
+            max_tokens=COMPLETION_TOKEN_RESERVE
+        )
+    logger.count('queries')
+    return response.choices[0].message.content, response
+
+
+async def stream_openai_response(openai_client, system_prompt, user_query, relevant_docs,
+                                 token_budget=CONTEXT_TOKEN_BUDGET, usage=None):
+    # Spotřebu pošle API v posledním chunku streamu; když je předán slovník usage, doplní se do něj
+    messages = build_messages(system_prompt, user_query, relevant_docs, token_budget)
+
+    with logger.span('llm_completion'):
+        stream = await openai_client.chat.completions.create(
+            model=openai_model(),
+            messages=messages,
+            max_tokens=COMPLETION_TOKEN_RESERVE,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            if usage is not None and getattr(chunk, 'usage', None) is not None:
+                usage.update(usage_of(chunk))
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    logger.count('queries')
+
+
+def context_budget(session_usage, user_query, budget=SESSION_TOKEN_BUDGET, system_prompt=SYSTEM_PROMPT):
+    # Kolik tokenů kontextu si dotaz může dovolit se zbytkem rozpočtu session. Když nezbývá ani
+    # MIN_CONTEXT_TOKENS, dotaz se odmítne ještě před vyhledáváním a voláním LLM.
+    if not budget:
+        return CONTEXT_TOKEN_BUDGET
+    overhead = estimate_tokens(system_prompt) + estimate_tokens(user_query) + COMPLETION_TOKEN_RESERVE
+    available = budget - session_usage.get('total_tokens', 0) - overhead
+    if available < MIN_CONTEXT_TOKENS:
+        raise BudgetExceeded(f"Session token budget {budget} exhausted ({session_usage.get('total_tokens', 0)} used)")
+    return min(CONTEXT_TOKEN_BUDGET, available)
+
+
+def usage_of(response):
+    usage = getattr(response, 'usage', None)
+    prompt_tokens = getattr(usage, 'prompt_tokens', None) or 0
+    completion_tokens = getattr(usage, 'completion_tokens', None) or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": getattr(usage, 'total_tokens', None) or prompt_tokens + completion_tokens,
+        "cost": (prompt_tokens * PROMPT_PRICE_PER_1K + completion_tokens * COMPLETION_PRICE_PER_1K) / 1000,
+    }
+
+
+def begin_query(db, session_id, user_query, budget=SESSION_TOKEN_BUDGET, system_prompt=SYSTEM_PROMPT):
+    # Kontrola rozpočtu session před vyhledáním; odmítnutý dotaz se zaeviduje a vyvolá BudgetExceeded.
+    # Vrací rozpracovaný záznam spotřeby a rozpočet tokenů pro kontext.
+    entry = {"query": user_query, "model": openai_model()}
+    try:
+        token_budget = context_budget(db.get_session_usage(session_id) if budget else {}, user_query, budget,
+                                      system_prompt)
+    except BudgetExceeded:
+        db.record_usage(session_id, {**entry, "refused": True})
+        logger.count('budget_refused')
+        raise
+    return entry, token_budget
+
+
+def finish_query(db, session_id, entry, usage, retrieval, token_budget, retrieval_ms, llm_ms):
+    # Záznam spotřeby dokončeného dotazu do MongoDB; usage je výsledek usage_of
+    entry.update(usage)
+    entry.update({
+        "retrieval_ms": retrieval_ms,
+        "llm_ms": llm_ms,
+        "context_token_budget": token_budget,
+        "trimmed": token_budget < CONTEXT_TOKEN_BUDGET,
+        "documents": retrieval['selected'],
+        "trimmed_documents": retrieval['trimmed_documents'],
+        "trimmed_tokens": retrieval['trimmed_tokens'],
+    })
+    db.record_usage(session_id, entry)
+    logger.count('prompt_tokens', entry['prompt_tokens'])
+    logger.count('completion_tokens', entry['completion_tokens'])
+    return entry
+
+
+def answer_query(db, openai_client, session_id, user_query, n_results, system_prompt=SYSTEM_PROMPT,
+                 budget=SESSION_TOKEN_BUDGET):
+    # Celý dotaz s evidencí spotřeby: kontrola rozpočtu, vyhledání, odpověď LLM a záznam do MongoDB
+    entry, token_budget = begin_query(db, session_id, user_query, budget, system_prompt)
+
+    start = time.perf_counter()
+    relevant_docs, retrieval = retrieve_documents(db, user_query, n_results)
+    retrieval_done = time.perf_counter()
+    content, response = get_openai_response(openai_client, system_prompt, user_query, relevant_docs, token_budget)
+    llm_done = time.perf_counter()
+
+    entry = finish_query(db, session_id, entry, usage_of(response), retrieval, token_budget,
+                         (retrieval_done - start) * 1000, (llm_done - retrieval_done) * 1000)
+    return content, relevant_docs, entry
+
+
+# Údaje o spotřebě, které se ukládají do záznamu historie (zobrazuje je main.py)
+HISTORY_USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens", "retrieval_ms", "llm_ms", "documents",
+                        "trimmed_documents", "trimmed_tokens")
+
+
+def submit_query(db, openai_client, session_id, user_query, n_results, budget=SESSION_TOKEN_BUDGET):
+    # Odeslání dotazu z UI: odpověď s evidencí spotřeby a záznam do historie session
+    content, relevant_docs, entry = answer_query(db, openai_client, session_id, user_query, n_results, budget=budget)
+    db.add_history_entry(session_id, {
+        "query": user_query,
+        "response": content,
+        "ids": [doc['_id'] for doc in relevant_docs],
+        "sources": [doc['metadata']['source'] for doc in relevant_docs],
+        "usage": {key: entry[key] for key in HISTORY_USAGE_FIELDS},
+    })
+    return content, relevant_docs, entry
+
+
+async def answer_query_async(db, openai_client, session_id, user_query, n_results, executor=None,
+                             retrieve=None, system_prompt=SYSTEM_PROMPT, budget=SESSION_TOKEN_BUDGET):
+    # Stejný tok jako answer_query pro AsyncOpenAI klienta (api.py, batch_qa.py). Blokující volání pymongo
+    # běží v `executor`; `retrieve(query, n_results)` může nahradit vyhledání (např. cache v api.py).
+    loop = asyncio.get_running_loop()
+    entry, token_budget = await loop.run_in_executor(executor, begin_query, db, session_id, user_query, budget,
+                                                     system_prompt)
+
+    start = time.perf_counter()
+    if retrieve is not None:
+        relevant_docs, retrieval = await retrieve(user_query, n_results)
+    else:
+        relevant_docs, retrieval = await loop.run_in_executor(executor, retrieve_documents, db, user_query, n_results)
+    retrieval_done = time.perf_counter()
+    content, response = await get_openai_response_async(openai_client, system_prompt, user_query, relevant_docs,
+                                                        token_budget)
+    llm_done = time.perf_counter()
+
+    entry = await loop.run_in_executor(executor, finish_query, db, session_id, entry, usage_of(response),
+                                       retrieval, token_budget, (retrieval_done - start) * 1000,
+                                       (llm_done - retrieval_done) * 1000)
+    return content, relevant_docs, entry
+
+
+def usage_summary(entry):
+    # Spotřeba tokenů dotazu pro odpověď API a výstup dávky
+    return {key: entry[key] for key in ("prompt_tokens", "completion_tokens", "total_tokens", "cost")}
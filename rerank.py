@@ -0,0 +1,111 @@
+import os
+import re
+import time
+
+import numpy as np
+
+import logger
+
+# Lokální přeřazení kandidátů z textového indexu podle uložených metadata.tokens a named_entities.
+# Běží offline, bez modelů; po vyčerpání časového rozpočtu přeřadí jen kandidáty zpracované do té doby.
+RERANK_ENABLED = os.getenv("RERANK", "0") == "1"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "20"))
+
+# Váhy: skóre textového indexu, pokrytí termů dotazu, shoda s entitami, blízkost termů v textu
+WEIGHTS = np.array([0.4, 0.35, 0.15, 0.1])
+
+# Pole, která přeřazení potřebuje navíc k výchozí projekci vyhledávání
+RERANK_FIELDS = ("metadata.tokens", "metadata.named_entities")
+
+_WORD = re.compile(r'\w+')
+_ENTITY = re.compile(r'\((?:\w+) ([^()]+)\)')
+
+
+def query_terms(query):
+    return list(dict.fromkeys(word for word in _WORD.findall(query.lower()) if len(word) > 1))
+
+
+def _tokens(doc):
+    tokens = doc.get('metadata', {}).get('tokens') or _WORD.findall(doc.get('content', ''))
+    return [str(token).lower() for token in tokens]
+
+
+def entity_words(named_entities):
+    # nltk Tree se do MongoDB uloží jako vnořené seznamy: list [slovo, tag] je běžný token,
+    # seznam takových dvojic je pojmenovaná entita. Starší data mají Tree jako text "(PERSON Jan/NNP)".
+    words = set()
+    if isinstance(named_entities, str):
+        for entity in _ENTITY.findall(named_entities):
+            words.update(part.rsplit('/', 1)[0].lower() for part in entity.split())
+    elif isinstance(named_entities, (list, tuple)):
+        for node in named_entities:
+            if isinstance(node, (list, tuple)) and node and isinstance(node[0], (list, tuple)):
+                words.update(str(leaf[0]).lower() for leaf in node if leaf)
+    return words
+
+
+def _proximity(tokens, terms):
+    # Poměr počtu nalezených termů k délce nejkratšího okna, které je všechny obsahuje
+    positions = [(i, token) for i, token in enumerate(tokens) if token in terms]
+    found = {token for _, token in positions}
+    if len(found) < 2:
+        return 1.0 if found else 0.0
+
+    counts, missing, best, left = {}, len(found), len(tokens), 0
+    for right, (position, token) in enumerate(positions):
+        counts[token] = counts.get(token, 0) + 1
+        if counts[token] == 1:
+            missing -= 1
+        while missing == 0:
+            best = min(best, position - positions[left][0] + 1)
+            left_token = positions[left][1]
+            counts[left_token] -= 1
+            if counts[left_token] == 0:
+                missing += 1
+            left += 1
+    return len(found) / best
+
+
+def rerank(query, candidates, n_results, budget_ms=RERANK_BUDGET_MS, clock=time.perf_counter):
+    if len(candidates) <= 1:
+        return candidates[:n_results]
+
+    start = clock()
+    with logger.span('rerank'):
+        terms = query_terms(query)
+        if not terms:
+            return candidates[:n_results]
+        term_set = set(terms)
+
+        # Příznaky se počítají po kandidátech v pořadí textového skóre (množinové dotazy v Pythonu).
+        # Rozpočet se hlídá před každým kandidátem: po jeho vyčerpání se přeřadí jen už zpracovaní
+        # kandidáti, zbytek zůstane za nimi v pořadí z MongoDB.
+        presence, entities, proximity = [], [], []
+        for doc in candidates:
+            if presence and (clock() - start) * 1000 > budget_ms:
+                logger.count('rerank_budget_exceeded')
+                break
+            tokens = _tokens(doc)
+            token_set = set(tokens)
+            entity_set = entity_words(doc.get('metadata', {}).get('named_entities'))
+            presence.append([term in token_set for term in terms])
+            entities.append([term in entity_set for term in terms])
+            proximity.append(_proximity(tokens, term_set))
+        scored = len(presence)
+
+        text_scores = np.array([doc.get('score', 0.0) for doc in candidates[:scored]], dtype=np.float32)
+        if text_scores.max() > 0:
+            text_scores /= text_scores.max()
+
+        # Vážený součet příznaků všech kandidátů najednou
+        features = np.column_stack([text_scores, np.array(presence, dtype=np.float32).mean(axis=1),
+                                    np.array(entities, dtype=np.float32).mean(axis=1),
+                                    np.array(proximity, dtype=np.float32)])
+        scores = features @ WEIGHTS
+        # Stabilní řazení: při shodě skóre zůstane pořadí z textového indexu
+        order = np.argsort(-scores, kind='stable')[:n_results]
+
+    logger.count('reranked_queries')
+    reranked = [{**candidates[i], "rerank_score": float(scores[i])} for i in order]
+    return reranked + candidates[scored:scored + n_results - len(reranked)]
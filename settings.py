@@ -3,23 +3,25 @@ import os
 import streamlit as st
 from utils import get_mongodb_client
 
-db = get_mongodb_client()
+def _db():
+    # Klient se vytvoří až při prvním dotazu, ne při importu modulu
+    return get_mongodb_client()
 
 def load_translations():
     with open('settings/localization.json', 'r', encoding='utf-8') as f:
         return json.load(f)
 
 def t(key):
-    return db.get_translation(key, st.session_state.language)
+    return _db().get_translation(key, st.session_state.language)
 
 def load_settings():
-    settings = db.query_documents('settings', {"type": "app_settings"}, limit=1)
+    settings = _db().query_documents('settings', {"type": "app_settings"}, limit=1)
     if settings:
         return settings[0]
     return {}
 
 def save_settings(settings):
-    db.update_document('settings', {"type": "app_settings"}, settings)
+    _db().update_document('settings', {"type": "app_settings"}, settings)
 
 def on_language_change():
     st.experimental_rerun()
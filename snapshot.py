@@ -0,0 +1,221 @@
+import argparse
+import hashlib
+import json
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+
+import bson
+from pymongo.errors import BulkWriteError
+
+import logger
+from database import CHECKPOINT_COLLECTION, MongoDB
+
+# Snapshot korpusu pro rychlé nasazení nového prostředí bez opakované extrakce a NLP.
+# Soubor je posloupnost rámců: 4 bajty délka JSON hlavičky, hlavička, data. Datový rámec nese dávku
+# dokumentů jako zlib-komprimované BSON s vlastním SHA-256, poslední rámec je manifest s počty
+# dokumentů a definicemi indexů. Obnova čte rámce postupně, v paměti je vždy jen jedna dávka.
+MAGIC = b"RAGSNAP1"
+SNAPSHOT_COLLECTIONS = ('data', CHECKPOINT_COLLECTION)
+BATCH_SIZE = 1000
+COMPRESSION_LEVEL = 6
+
+# Volby z index_information, které create_index nepřijímá
+_INDEX_INTERNAL_OPTIONS = ('key', 'v', 'ns', 'name', 'textIndexVersion')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _write_frame(f, header, payload=b""):
+    encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+    f.write(struct.pack('>I', len(encoded)))
+    f.write(encoded)
+    f.write(payload)
+
+
+def _read_frames(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError("Not a snapshot file")
+    while True:
+        size = f.read(4)
+        if not size:
+            return
+        if len(size) != 4:
+            raise SnapshotError("Snapshot file is truncated")
+        # Useknutá nebo poškozená hlavička se hlásí stejně jako poškozená data, ne jako chyba JSON
+        try:
+            header = json.loads(f.read(struct.unpack('>I', size)[0]))
+        except ValueError:
+            raise SnapshotError("Snapshot frame header is corrupted") from None
+        if not isinstance(header, dict) or 'type' not in header:
+            raise SnapshotError("Snapshot frame header is corrupted")
+        payload = f.read(header.get('size', 0))
+        if len(payload) != header.get('size', 0):
+            raise SnapshotError("Snapshot file is truncated")
+        yield header, payload
+
+
+def index_definitions(collection):
+    definitions = []
+    for name, info in collection.index_information().items():
+        if name == '_id_':
+            continue
+        keys = [(field, kind) for field, kind in info['key'] if field not in ('_fts', '_ftsx')]
+        if 'weights' in info:
+            # Textový index vrací MongoDB jako _fts/_ftsx, pole jsou jen ve weights
+            keys = [(field, 'text') for field in info['weights']] + keys
+        options = {key: value for key, value in info.items() if key not in _INDEX_INTERNAL_OPTIONS}
+        definitions.append({"name": name, "keys": keys, "options": options})
+    return definitions
+
+
+def export_snapshot(db, path, collections=SNAPSHOT_COLLECTIONS, batch_size=BATCH_SIZE):
+    digest = hashlib.sha256()
+    manifest = {"created_at": datetime.now(timezone.utc).isoformat(), "collections": {}}
+
+    def write_batch(f, collection_name, documents):
+        payload = zlib.compress(b"".join(documents), COMPRESSION_LEVEL)
+        batch_digest = hashlib.sha256(payload).hexdigest()
+        digest.update(batch_digest.encode('ascii'))
+        _write_frame(f, {"type": "batch", "collection": collection_name, "count": len(documents),
+                         "size": len(payload), "sha256": batch_digest}, payload)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        for collection_name in collections:
+            collection = db.get_collection(collection_name)
+            count, batch = 0, []
+            with logger.span('snapshot_export'):
+                for document in collection.find({}).batch_size(batch_size):
+                    batch.append(bson.encode(document))
+                    if len(batch) >= batch_size:
+                        write_batch(f, collection_name, batch)
+                        count += len(batch)
+                        batch = []
+                if batch:
+                    write_batch(f, collection_name, batch)
+                    count += len(batch)
+            manifest["collections"][collection_name] = {"count": count, "indexes": index_definitions(collection)}
+        manifest["sha256"] = digest.hexdigest()
+        _write_frame(f, {"type": "manifest", **manifest})
+    return manifest
+
+
+def read_snapshot(path):
+    # Generátor dávek (kolekce, dokumenty) s ověřením kontrolních součtů; na konci vrátí manifest
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for header, payload in _read_frames(f):
+            if header['type'] == 'manifest':
+                if header['sha256'] != digest.hexdigest():
+                    raise SnapshotError("Snapshot checksum mismatch")
+                return header
+            if hashlib.sha256(payload).hexdigest() != header['sha256']:
+                raise SnapshotError(f"Corrupted batch in collection {header['collection']}")
+            digest.update(header['sha256'].encode('ascii'))
+            documents = bson.decode_all(zlib.decompress(payload))
+            if len(documents) != header['count']:
+                raise SnapshotError(f"Corrupted batch in collection {header['collection']}")
+            yield header['collection'], documents
+    raise SnapshotError("Snapshot file has no manifest (incomplete export)")
+
+
+def verify_snapshot(path):
+    batches = read_snapshot(path)
+    counts = {}
+    try:
+        while True:
+            collection_name, documents = next(batches)
+            counts[collection_name] = counts.get(collection_name, 0) + len(documents)
+    except StopIteration as stop:
+        manifest = stop.value
+    for collection_name, info in manifest['collections'].items():
+        if counts.get(collection_name, 0) != info['count']:
+            raise SnapshotError(f"Collection {collection_name} has {counts.get(collection_name, 0)} documents, "
+                                f"manifest says {info['count']}")
+    return manifest
+
+
+def import_snapshot(db, path, drop=False):
+    # Celý soubor se nejdřív ověří (kontrolní součty i počty proti manifestu) a teprve pak se cokoli smaže
+    # nebo vloží; poškozený snapshot tak cílovou databázi nezmění. Ověření je jedno čtení souboru navíc,
+    # paměť zůstává na jedné dávce.
+    verify_snapshot(path)
+
+    # Data se nahrávají bez sekundárních indexů, indexy se postaví až po načtení všech dávek
+    if drop:
+        for collection_name in SNAPSHOT_COLLECTIONS:
+            db.db.drop_collection(collection_name)
+
+    batches = read_snapshot(path)
+    stats = {"inserted": 0, "skipped": 0}
+    try:
+        while True:
+            collection_name, documents = next(batches)
+            collection = db.get_collection(collection_name)
+            with logger.span('snapshot_import'):
+                try:
+                    stats["inserted"] += len(collection.insert_many(documents, ordered=False).inserted_ids)
+                except BulkWriteError as e:
+                    # Dokumenty, které v cílové kolekci už jsou, se přeskočí
+                    errors = e.details.get('writeErrors', [])
+                    if any(error.get('code') != 11000 for error in errors):
+                        raise
+                    stats["inserted"] += e.details.get('nInserted', 0)
+                    stats["skipped"] += len(errors)
+    except StopIteration as stop:
+        manifest = stop.value
+
+    with logger.span('snapshot_indexes'):
+        for collection_name, info in manifest['collections'].items():
+            collection = db.get_collection(collection_name)
+            existing = collection.index_information()
+            for index in info['indexes']:
+                if index['name'] not in existing:
+                    collection.create_index([tuple(key) for key in index['keys']], name=index['name'],
+                                            **index['options'])
+    return stats, manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or restore a snapshot of the ingested corpus")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="Write the corpus into a snapshot file")
+    export_parser.add_argument("file", type=str, help="Snapshot file")
+    export_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Documents per compressed batch")
+
+    import_parser = subparsers.add_parser("import", help="Restore the corpus from a snapshot file")
+    import_parser.add_argument("file", type=str, help="Snapshot file")
+    import_parser.add_argument("--drop", action="store_true", help="Drop the collections before restoring")
+
+    verify_parser = subparsers.add_parser("verify", help="Check the checksums of a snapshot without restoring it")
+    verify_parser.add_argument("file", type=str, help="Snapshot file")
+    args = parser.parse_args()
+
+    logger.setup_logging()
+    start = time.perf_counter()
+    if args.command == "verify":
+        manifest = verify_snapshot(args.file)
+        print(f"Snapshot OK: {manifest['collections']['data']['count']} chunks")
+        return
+
+    db = MongoDB()
+    try:
+        if args.command == "export":
+            manifest = export_snapshot(db, args.file, batch_size=args.batch_size)
+            print(f"Exported {manifest['collections']['data']['count']} chunks to {args.file} "
+                  f"in {time.perf_counter() - start:.1f} s")
+        else:
+            stats, _ = import_snapshot(db, args.file, drop=args.drop)
+            print(f"Restored {stats['inserted']} documents ({stats['skipped']} already present) "
+                  f"in {time.perf_counter() - start:.1f} s")
+    finally:
+        db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
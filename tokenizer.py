@@ -1,25 +1,143 @@
 import argparse
+import hashlib
 import json
 import ssl
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import nltk
 import os
 
+import logger
+
+# Adresář s NLTK modely (např. rozbalený offline bundle); má přednost před výchozími cestami NLTK
+NLTK_DATA_DIR = os.getenv("NLTK_DATA_DIR")
+# Na hostech bez internetu je chybějící model chyba, nic se nestahuje
+NLTK_OFFLINE = os.getenv("NLTK_OFFLINE", "0") == "1"
+
+# Balíček NLTK -> cesta, pod kterou ho hledá nltk.data.find (taggery a chunkery nejsou v tokenizers/).
+# Jen modely, které NLTK >= 3.9 opravdu načítá (word_tokenize, pos_tag, ne_chunker); starší pickle
+# varianty (punkt, averaged_perceptron_tagger, maxent_ne_chunker) už nepoužívá.
+NLTK_RESOURCES = {
+    'punkt_tab': 'tokenizers/punkt_tab',
+    'averaged_perceptron_tagger_eng': 'taggers/averaged_perceptron_tagger_eng',
+    'maxent_ne_chunker_tab': 'chunkers/maxent_ne_chunker_tab',
+    'words': 'corpora/words',
+}
+BUNDLE_MANIFEST = 'manifest.json'
+
+# nltk.ne_chunk načítá model chunkeru při každém volání, instance se proto drží na úrovni procesu
+_ne_chunker = None
+_warm_up_seconds = None
+
+
+def configure_data_path(data_dir=NLTK_DATA_DIR):
+    if data_dir and data_dir not in nltk.data.path:
+        nltk.data.path.insert(0, data_dir)
+
+
+configure_data_path()
+
 
 def setup_ssl():
     ssl._create_default_https_context = ssl._create_unverified_context
 
 
-def download_nltk_data():
-    resources = ['punkt', 'averaged_perceptron_tagger', 'maxent_ne_chunker', 'words', 'punkt_tab',
-                 'averaged_perceptron_tagger_eng', 'maxent_ne_chunker_tab']
-    for resource in resources:
+def missing_resources():
+    missing = []
+    for resource, path in NLTK_RESOURCES.items():
         try:
-            nltk.data.find(f'tokenizers/{resource}')
+            nltk.data.find(path)
         except LookupError:
-            print(f"Downloading {resource}...")
-            nltk.download(resource, quiet=True)
-        else:
-            print(f"{resource} is already downloaded.")
+            missing.append(resource)
+    return missing
+
+
+def download_nltk_data(offline=None):
+    # Stahuje jen chybějící modely; offline režim místo stahování skončí chybou
+    offline = NLTK_OFFLINE if offline is None else offline
+    missing = missing_resources()
+    if missing and offline:
+        raise LookupError(f"Missing NLTK resources {missing} in {nltk.data.path}. "
+                          f"Build an offline bundle with 'tokenizer.py --build-bundle DIR' and set NLTK_DATA_DIR.")
+    for resource in missing:
+        print(f"Downloading {resource}...")
+        nltk.download(resource, quiet=True, download_dir=NLTK_DATA_DIR)
+    return missing
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_bundle(bundle_dir):
+    # Stáhne všechny modely do bundle_dir a zapíše manifest s kontrolními součty souborů
+    setup_ssl()
+    os.makedirs(bundle_dir, exist_ok=True)
+    for resource in NLTK_RESOURCES:
+        if not nltk.download(resource, download_dir=bundle_dir, quiet=True):
+            raise RuntimeError(f"Download of NLTK resource {resource} failed")
+
+    files = {}
+    for root, _, names in os.walk(bundle_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, bundle_dir)
+            if relative_path != BUNDLE_MANIFEST:
+                files[relative_path] = _file_digest(path)
+    manifest = {"nltk_version": nltk.__version__, "resources": NLTK_RESOURCES, "files": files}
+    with open(os.path.join(bundle_dir, BUNDLE_MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def verify_bundle(bundle_dir):
+    # Vrátí seznam problémů (chybějící nebo poškozené soubory, modely mimo bundle); prázdný seznam = v pořádku
+    manifest_path = os.path.join(bundle_dir, BUNDLE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return [f"missing {BUNDLE_MANIFEST}"]
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    problems = []
+    for relative_path, digest in sorted(manifest['files'].items()):
+        path = os.path.join(bundle_dir, relative_path)
+        if not os.path.exists(path):
+            problems.append(f"missing {relative_path}")
+        elif _file_digest(path) != digest:
+            problems.append(f"checksum mismatch {relative_path}")
+    # Model je v bundlu jako adresář nebo zip přesně s jeho cestou; pouhá shoda prefixu by nechala
+    # např. tokenizers/punkt_tab splnit požadavek na tokenizers/punkt
+    bundled = [path.replace(os.sep, '/') for path in manifest['files']]
+    for resource, resource_path in NLTK_RESOURCES.items():
+        if not any(path == f"{resource_path}.zip" or path.startswith(f"{resource_path}/") for path in bundled):
+            problems.append(f"resource {resource} not in bundle")
+    return problems
+
+
+def warm_up(language='english'):
+    # Načte tokenizer, tagger a NE chunker jednou na proces, aby první chunk nenesl cenu načítání modelů
+    global _warm_up_seconds
+    if _warm_up_seconds is None:
+        start = time.perf_counter()
+        with logger.span('nlp_warm_up'):
+            process_text("Warm up of the NLTK models in Prague.", language)
+        _warm_up_seconds = time.perf_counter() - start
+        logger.log_info(f"NLTK modely načteny za {_warm_up_seconds:.2f} s (proces {os.getpid()})")
+    return _warm_up_seconds
+
+
+def ensure_nltk_data(offline=None, language='english'):
+    # Když jsou modely na místě, proběhne jen warm-up; jinak se stáhnou (nebo v offline režimu chyba)
+    if missing_resources():
+        setup_ssl()
+        download_nltk_data(offline)
+    return warm_up(language)
 
 
 def tokenize_text(text, language='english'):
@@ -33,7 +151,11 @@ def pos_tag(tokens, language='english'):
 
 
 def named_entity_recognition(tagged_tokens):
-    return nltk.ne_chunk(tagged_tokens)
+    global _ne_chunker
+    if _ne_chunker is None:
+        from nltk.chunk import ne_chunker
+        _ne_chunker = ne_chunker()
+    return _ne_chunker.parse(tagged_tokens)
 
 
 def process_text(text, language='english'):
@@ -60,10 +182,79 @@ def save_results(results, output_format='json', output_folder='outputs', output_
     print(f"Results saved to {file_path}")
 
 
-def main():
-    setup_ssl()
-    download_nltk_data()
+def iter_records(input_path):
+    # Adresář: jeden záznam na soubor (text načte až worker); JSONL: {"id": ..., "text": ...} nebo řetězec na řádek.
+    # Vadný řádek JSONL se nepřeskočí, projde dál jako záznam s chybou a ve výstupu dostane řádek s "error".
+    if os.path.isdir(input_path):
+        for root, dirs, files in os.walk(input_path):
+            # Řazení na místě určuje i pořadí, v jakém os.walk projde podadresáře
+            dirs.sort()
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                yield {"id": os.path.relpath(path, input_path), "path": path}
+        return
+
+    with open(input_path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield {"id": line_number, "error": f"{type(e).__name__}: {e}"}
+                continue
+            if isinstance(record, str):
+                record = {"text": record}
+            elif not isinstance(record, dict):
+                yield {"id": line_number, "error": f"Unsupported record: {type(record).__name__}"}
+                continue
+            record.setdefault('id', line_number)
+            yield record
+
+
+def process_record(record, language='english'):
+    if 'error' in record:
+        return record
+    try:
+        text = record.get('text')
+        if text is None:
+            with open(record['path'], 'r', encoding='utf-8') as f:
+                text = f.read()
+        return {"id": record['id'], **process_text(text, language)}
+    except Exception as e:
+        return {"id": record['id'], "error": f"{type(e).__name__}: {e}"}
+
 
+def run_batch(input_path, output_path, language='english', workers=os.cpu_count()):
+    # Výsledky se zapisují průběžně jako JSON Lines ve vstupním pořadí. V běhu je nejvýš
+    # workers * 4 záznamů, paměť tedy nezávisí na velikosti vstupu.
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    stats = {"processed": 0, "failed": 0}
+
+    def write(out, result):
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        stats["failed" if "error" in result else "processed"] += 1
+
+    with open(output_path, 'w', encoding='utf-8') as out:
+        if workers <= 1:
+            for record in iter_records(input_path):
+                write(out, process_record(record, language))
+            return stats
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=warm_up,
+                                 initargs=(language,)) as executor:
+            pending = deque()
+            for record in iter_records(input_path):
+                pending.append(executor.submit(process_record, record, language))
+                if len(pending) >= workers * 4:
+                    write(out, pending.popleft().result())
+            while pending:
+                write(out, pending.popleft().result())
+    return stats
+
+
+def main():
     parser = argparse.ArgumentParser(description="NLP processing with NLTK")
     parser.add_argument("--text", type=str, help="Text to process")
     parser.add_argument("--file", type=str, help="File containing text to process")
@@ -72,8 +263,34 @@ def main():
     parser.add_argument("--output_folder", type=str, default="outputs", help="Output folder for saving results")
     parser.add_argument("--output", type=str, default="output", help="Output file name")
     parser.add_argument("--format", type=str, default="json", choices=["json", "txt"], help="Output format")
+    parser.add_argument("--input", type=str,
+                        help="Batch mode: directory of text files or JSONL file, results are written as JSON Lines")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes in batch mode")
+    parser.add_argument("--build-bundle", type=str, metavar="DIR",
+                        help="Download all NLTK resources into DIR with a checksum manifest for offline hosts")
+    parser.add_argument("--verify-bundle", type=str, metavar="DIR",
+                        help="Verify an offline bundle against its manifest")
     args = parser.parse_args()
 
+    if args.build_bundle:
+        manifest = build_bundle(args.build_bundle)
+        print(f"Bundle with {len(manifest['files'])} files written to {args.build_bundle}")
+        return
+    if args.verify_bundle:
+        problems = verify_bundle(args.verify_bundle)
+        for problem in problems:
+            print(problem)
+        print("Bundle OK" if not problems else f"Bundle has {len(problems)} problems")
+        raise SystemExit(1 if problems else 0)
+
+    print(f"NLTK models ready in {ensure_nltk_data():.2f} s")
+
+    if args.input:
+        output_path = os.path.join(args.output_folder, f"{args.output}.jsonl")
+        stats = run_batch(args.input, output_path, args.language, args.workers)
+        print(f"Processed {stats['processed']} records ({stats['failed']} failed). Results saved to {output_path}")
+        return
+
     if args.text:
         text = args.text
     elif args.file:
@@ -1,13 +1,44 @@
+import json
+import logging
+import os
+import sys
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+from unittest.mock import patch, MagicMock, mock_open, Mock, AsyncMock, ANY
+
+import logger
 from fill_db import (
     convert_metadata, split_text, get_file_type, extract_text_from_pdf, process_file, process_paragraph,
     monitor_directory, extract_text_from_ole_doc, extract_text_from_xls,
     extract_text_from_pptx,
-    NewFileHandler, extract_text_from_docx,
+    NewFileHandler, extract_text_from_docx, load_and_process_documents, plan_ingestion,
 )
 
 
+def mongomock_db(history=False):
+    # MongoDB nad mongomock; mongomock neumí capped kolekce, kolekci historie proto případně založíme předem
+    import mongomock
+    import database
+    with patch('database.MongoClient', mongomock.MongoClient):
+        db = database.MongoDB()
+    if history:
+        db.db.create_collection(database.HISTORY_COLLECTION)
+    return db
+
+
+def openai_client_mock(content="Test answer", usage=None, is_async=False):
+    # Klient OpenAI vracející jednu odpověď; usage je dvojice (prompt_tokens, completion_tokens)
+    completion = MagicMock()
+    completion.choices[0].message.content = content
+    completion.usage = None
+    if usage:
+        completion.usage = Mock(prompt_tokens=usage[0], completion_tokens=usage[1], total_tokens=sum(usage))
+    client = MagicMock()
+    create = AsyncMock if is_async else MagicMock
+    client.chat.completions.create = create(return_value=completion)
+    return client
+
+
 class TestFileFunctions(unittest.TestCase):
 
     def test_convert_metadata(self):
@@ -54,8 +85,8 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_pdf('test.pdf')
         self.assertEqual(result, [{"page_content": 'Test text'}])
 
-    @patch('fill_db.olefile.isOleFile')
-    @patch('fill_db.olefile.OleFileIO')
+    @patch('olefile.isOleFile')
+    @patch('olefile.OleFileIO')
     def test_extract_text_from_ole_doc(self, mock_olefileio, mock_isolefile):
         mock_isolefile.return_value = True
         mock_ole = MagicMock()
@@ -66,8 +97,8 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_ole_doc('test.ole')
         self.assertEqual(result, [{"page_content": "Test OLE text"}])
 
-    @patch('fill_db.olefile.isOleFile')
-    @patch('fill_db.olefile.OleFileIO')
+    @patch('olefile.isOleFile')
+    @patch('olefile.OleFileIO')
     def test_extract_text_from_ole_doc_no_worddocument(self, mock_olefileio, mock_isolefile):
         mock_isolefile.return_value = True
         mock_ole = MagicMock()
@@ -77,7 +108,7 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_ole_doc('test.ole')
         self.assertEqual(result, [])
 
-    @patch('fill_db.Document')
+    @patch('docx.Document')
     def test_extract_text_from_docx(self, mock_document):
         mock_doc = MagicMock()
         mock_paragraph = MagicMock()
@@ -88,7 +119,7 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_docx('test.docx')
         self.assertEqual(result, [{"page_content": 'Test DOCX text'}])
 
-    @patch('fill_db.Document')
+    @patch('docx.Document')
     def test_extract_text_from_docx_empty(self, mock_document):
         mock_doc = MagicMock()
         mock_paragraph = MagicMock()
@@ -99,13 +130,13 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_docx('empty.docx')
         self.assertEqual(result, [])
 
-    @patch('fill_db.Document')
+    @patch('docx.Document')
     def test_extract_text_from_docx_error(self, mock_document):
         mock_document.side_effect = Exception("Error opening file")
         result = extract_text_from_docx('error.docx')
         self.assertEqual(result, [])
 
-    @patch('fill_db.xlrd.open_workbook')
+    @patch('xlrd.open_workbook')
     def test_extract_text_from_xls(self, mock_open_workbook):
         mock_workbook = MagicMock()
         mock_sheet = MagicMock()
@@ -116,7 +147,7 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_xls('test.xls')
         self.assertEqual(result, [{"page_content": "['A', 'B']\n[1, 2]"}])
 
-    @patch('fill_db.xlrd.open_workbook')
+    @patch('xlrd.open_workbook')
     def test_extract_text_from_xls_empty(self, mock_open_workbook):
         mock_workbook = MagicMock()
         mock_sheet = MagicMock()
@@ -126,13 +157,13 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_xls('empty.xls')
         self.assertEqual(result, [])
 
-    @patch('fill_db.xlrd.open_workbook')
+    @patch('xlrd.open_workbook')
     def test_extract_text_from_xls_error(self, mock_open_workbook):
         mock_open_workbook.side_effect = Exception("Error opening file")
         result = extract_text_from_xls('error.xls')
         self.assertEqual(result, [])
 
-    @patch('fill_db.Presentation')
+    @patch('pptx.Presentation')
     def test_extract_text_from_pptx(self, mock_presentation):
         mock_prs = MagicMock()
         mock_slide = MagicMock()
@@ -144,7 +175,7 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_pptx('test.pptx')
         self.assertEqual(result, [{"page_content": 'Test text from PPT/PPTX'}])
 
-    @patch('fill_db.Presentation')
+    @patch('pptx.Presentation')
     def test_extract_text_from_pptx_empty(self, mock_presentation):
         mock_prs = MagicMock()
         mock_prs.slides = []
@@ -152,15 +183,13 @@ class TestFileFunctions(unittest.TestCase):
         result = extract_text_from_pptx('empty.pptx')
         self.assertEqual(result, [{"page_content": ""}])
 
-    @patch('fill_db.Presentation')
+    @patch('pptx.Presentation')
     def test_extract_text_from_pptx_error(self, mock_presentation):
         mock_presentation.side_effect = Exception("Error opening file")
         result = extract_text_from_pptx('error.pptx')
         self.assertEqual(result, [])
 
     @patch('os.path.exists', return_value=True)
-    @patch('utils.calculate_file_hash', return_value='fake_hash')
-    @patch('fill_db.MongoDB')
     @patch('fill_db.extract_text_from_pdf')
     @patch('fill_db.extract_text_from_docx')
     @patch('fill_db.extract_text_from_ole_doc')
@@ -169,13 +198,7 @@ class TestFileFunctions(unittest.TestCase):
     @patch('fill_db.extract_text_from_pptx')
     @patch('fill_db.extract_text_from_txt')
     def test_process_file(self, mock_txt, mock_pptx, mock_xls, mock_xlsx,
-                          mock_ole_doc, mock_docx, mock_pdf, mock_db,
-                          mock_hash, mock_exists):
-        # Setup mock database
-        mock_db_instance = Mock()
-        mock_db_instance.query_documents.return_value = []  # No existing documents
-        mock_db.return_value = mock_db_instance
-
+                          mock_ole_doc, mock_docx, mock_pdf, mock_exists):
         # Setup mocks for each file type
         mock_pdf.return_value = [{"page_content": 'Test PDF'}]
         mock_docx.return_value = [{"page_content": 'Test DOCX'}]
@@ -200,8 +223,6 @@ class TestFileFunctions(unittest.TestCase):
             with self.subTest(file_path=file_path):
                 # Reset all mocks
                 mock_exists.reset_mock()
-                mock_hash.reset_mock()
-                mock_db_instance.query_documents.reset_mock()
                 mock_func.reset_mock()
 
                 # Call the function
@@ -212,8 +233,6 @@ class TestFileFunctions(unittest.TestCase):
 
                 # Verify all mocks were called
                 mock_exists.assert_called_once_with(file_path)
-                mock_hash.assert_called_once_with(file_path)
-                mock_db_instance.query_documents.assert_called_once_with("data", {"metadata.file_hash": 'fake_hash'})
                 mock_func.assert_called_once_with(file_path)
 
         # Test case for unsupported file type
@@ -340,3 +359,1151 @@ class TestFileFunctions(unittest.TestCase):
         ]
 
         mock_get_file_type.side
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.was_enabled = logger.metrics_enabled()
+        logger.METRICS.reset()
+
+    def tearDown(self):
+        logger.enable_metrics(self.was_enabled)
+        logger.METRICS.reset()
+
+    def test_span_disabled_records_nothing(self):
+        logger.enable_metrics(False)
+        with logger.span('stage'):
+            pass
+        logger.count('event')
+        self.assertEqual(logger.METRICS.snapshot(), {"counters": {}, "stages": {}})
+
+    def test_span_and_counter(self):
+        logger.enable_metrics(True)
+        with logger.span('stage'):
+            pass
+        with self.assertRaises(ValueError):
+            with logger.span('stage'):
+                raise ValueError("boom")
+        logger.count('event', 3)
+
+        snapshot = logger.METRICS.snapshot()
+        self.assertEqual(snapshot['stages']['stage']['count'], 2)
+        self.assertEqual(snapshot['counters'], {'event': 3, 'stage_errors': 1})
+
+        prometheus = logger.METRICS.to_prometheus()
+        self.assertIn('rag_events_total{event="event"} 3', prometheus)
+        self.assertIn('rag_stage_duration_seconds_count{stage="stage"} 2', prometheus)
+        self.assertIn('rag_stage_duration_seconds_bucket{stage="stage",le="+Inf"} 2', prometheus)
+
+    def test_timed_decorator(self):
+        logger.enable_metrics(True)
+
+        @logger.timed('decorated')
+        def add(a, b):
+            return a + b
+
+        self.assertEqual(add(1, 2), 3)
+        self.assertEqual(logger.METRICS.snapshot()['stages']['decorated']['count'], 1)
+
+
+class TestLogging(unittest.TestCase):
+
+    def test_log_info_emits(self):
+        with self.assertLogs('DocumentProcessor', level='INFO') as captured:
+            logger.log_info("Test info")
+        self.assertEqual(captured.records[0].getMessage(), "Test info")
+
+    def test_json_formatter(self):
+        record = logging.LogRecord('DocumentProcessor', logging.WARNING, __file__, 1, "Chyba %s", ('x',), None)
+        record.key = 'extract_error'
+        entry = json.loads(logger.JsonFormatter().format(record))
+
+        self.assertEqual(entry['level'], 'WARNING')
+        self.assertEqual(entry['message'], 'Chyba x')
+        self.assertEqual(entry['key'], 'extract_error')
+
+    @patch('logger.time.monotonic')
+    def test_rate_limiter(self, mock_monotonic):
+        mock_monotonic.return_value = 0.0
+        limiter = logger.RateLimiter(limit=2, interval=60.0)
+
+        self.assertEqual(limiter.allow('key'), (True, 0))
+        self.assertEqual(limiter.allow('key'), (True, 0))
+        self.assertEqual(limiter.allow('key'), (False, 0))
+        self.assertEqual(limiter.allow('key'), (False, 0))
+        self.assertEqual(limiter.allow('other'), (True, 0))
+
+        # Po uplynutí okna projde další zpráva s počtem potlačených
+        mock_monotonic.return_value = 61.0
+        self.assertEqual(limiter.allow('key'), (True, 2))
+
+    @patch('logger.time.monotonic', return_value=0.0)
+    @patch('logger._rate_limiter', logger.RateLimiter(limit=1, interval=60.0))
+    def test_log_warning_with_key_is_sampled(self, mock_monotonic):
+        logger._rate_limiter.next_sweep = 60.0
+        with self.assertLogs('DocumentProcessor', level='WARNING') as captured:
+            for i in range(5):
+                logger.log_warning(f"Chyba souboru {i}.pdf", key='extract_error')
+            logger.log_warning("Jiná kategorie", key='batch_error')
+        self.assertEqual([record.getMessage() for record in captured.records],
+                         ["Chyba souboru 0.pdf", "Jiná kategorie"])
+
+        # Před koncem okna se okna neprocházejí
+        mock_monotonic.return_value = 30.0
+        self.assertEqual(logger._rate_limiter.expired(), [])
+
+        # Po uplynutí okna se potlačená varování nahlásí i bez další zprávy se stejným klíčem
+        mock_monotonic.return_value = 61.0
+        with self.assertLogs('DocumentProcessor', level='WARNING') as captured:
+            logger.flush_suppressed()
+        self.assertEqual(captured.records[0].suppressed, 4)
+        self.assertIn("Chyba souboru 4.pdf", captured.records[0].getMessage())
+
+    def test_queue_handler_keeps_exception(self):
+        import queue
+        log_queue = queue.Queue()
+        handler = logger.StructuredQueueHandler(log_queue)
+        try:
+            raise ValueError("rozbitý soubor")
+        except ValueError:
+            record = logging.LogRecord('DocumentProcessor', logging.ERROR, __file__, 1, "Selhalo", None,
+                                       sys.exc_info())
+        handler.handle(record)
+        entry = json.loads(logger.JsonFormatter().format(log_queue.get_nowait()))
+        self.assertEqual(entry['message'], "Selhalo")
+        self.assertIn("ValueError: rozbitý soubor", entry['exception'])
+
+
+class TestStartupImports(unittest.TestCase):
+
+    def test_ui_does_not_import_ingestion_stack(self):
+        import bench_startup
+        _, loaded = bench_startup.measure_imports(bench_startup.top_level_imports('main.py'))
+        leaked = [name for name in bench_startup.INGESTION_MODULES if name in loaded]
+        self.assertEqual(leaked, [])
+
+    def test_extractor_libraries_are_imported_on_demand(self):
+        import bench_startup
+        _, loaded = bench_startup.measure_imports(['fill_db'])
+        self.assertEqual([name for name in ('fitz', 'pandas', 'docx', 'pptx', 'xlrd', 'lxml') if name in loaded], [])
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock_db(history=True)
+
+    def test_history_pages(self):
+        for i in range(7):
+            self.db.add_history_entry('session', {"query": f"q{i}", "response": f"r{i}"})
+        self.db.add_history_entry('other', {"query": "x", "response": "y"})
+
+        latest = self.db.get_history('session', limit=3)
+        self.assertEqual([entry['query'] for entry in latest], ['q6', 'q5', 'q4'])
+        self.assertNotIn('session_id', latest[0])
+
+        older = self.db.get_history('session', limit=3, skip=3)
+        self.assertEqual([entry['query'] for entry in older], ['q3', 'q2', 'q1'])
+        self.assertEqual(len(self.db.get_history('session', limit=100)), 7)
+
+        # Stránkování podle už načteného záznamu: starší stránka a jen nově přidané záznamy
+        older = self.db.get_history('session', limit=3, before=latest[-1])
+        self.assertEqual([entry['query'] for entry in older], ['q3', 'q2', 'q1'])
+        self.db.add_history_entry('session', {"query": "q7", "response": "r7"})
+        newer = self.db.get_history('session', limit=0, after=latest[0])
+        self.assertEqual([entry['query'] for entry in newer], ['q7'])
+
+
+class TestLocalization(unittest.TestCase):
+    def test_missing_key_falls_back_to_json(self):
+        import database
+        db = mongomock_db()
+        # Lokalizace uložená starší verzí aplikace, bez později přidaných klíčů
+        db.update_localization({"cs": {"title": "Starý titulek"}, "en": {"title": "Old title"}})
+
+        self.assertEqual(db.get_translation("title", "cs"), "Starý titulek")
+        self.assertEqual(db.get_translation("load_older", "cs"), database.default_localization()["cs"]["load_older"])
+        with self.assertRaises(KeyError):
+            db.get_translation("no_such_key", "en")
+
+
+class TestQueryApi(unittest.IsolatedAsyncioTestCase):
+
+    def make_client(self, admission=None):
+        import api
+        from aiohttp.test_utils import TestClient, TestServer
+
+        self.db = MagicMock()
+        self.db.search_documents.return_value = [
+            {"_id": "1", "content": "Test content", "metadata": {"source": "data/test.pdf"}}
+        ]
+        self.openai = openai_client_mock(usage=(6, 4), is_async=True)
+        return TestClient(TestServer(api.create_app(self.db, self.openai, admission)))
+
+    async def test_query(self):
+        import qa
+        async with self.make_client() as client:
+            response = await client.post('/query', json={"query": "Test question", "n_results": 2})
+            self.assertEqual(response.status, 200)
+            body = await response.json()
+            self.assertEqual(body['answer'], "Test answer")
+            self.assertEqual(body['sources'], ["data/test.pdf"])
+            self.assertEqual(body['usage'], {"prompt_tokens": 6, "completion_tokens": 4, "total_tokens": 10,
+                                             "cost": 0.0})
+            # Spotřeba se eviduje pod session jako v UI a odpověď je omezená max_tokens
+            self.db.record_usage.assert_called_once_with("api", ANY)
+            self.assertEqual(self.openai.chat.completions.create.call_args.kwargs['max_tokens'],
+                             qa.COMPLETION_TOKEN_RESERVE)
+
+            # Druhý stejný dotaz jde ze sdílené cache
+            await client.post('/query', json={"query": "Test question", "n_results": 2, "session_id": "s1"})
+            self.db.search_documents.assert_called_once_with('data', "Test question", 2, fields=ANY)
+            self.db.record_usage.assert_called_with("s1", ANY)
+
+    async def test_budget_exceeded(self):
+        import qa
+        async with self.make_client() as client:
+            with patch('qa.begin_query', side_effect=qa.BudgetExceeded("exhausted")):
+                response = await client.post('/query', json={"query": "Test question"})
+            self.assertEqual(response.status, 429)
+            self.openai.chat.completions.create.assert_not_called()
+
+    async def test_upstream_errors(self):
+        async def broken_stream():
+            chunk = MagicMock(usage=None)
+            chunk.choices[0].delta.content = "Část"
+            yield chunk
+            raise ConnectionError("LLM stream closed")
+
+        async with self.make_client() as client:
+            # Bez streamu dostane klient JSON s chybou místo HTML stránky
+            self.openai.chat.completions.create.side_effect = ConnectionError("LLM unavailable")
+            response = await client.post('/query', json={"query": "Test question"})
+            self.assertEqual(response.status, 502)
+            self.assertEqual(await response.json(), {"error": "query failed"})
+
+            # Ve streamu končí odpověď řádkem s chybou místo "done"
+            self.openai.chat.completions.create.side_effect = None
+            self.openai.chat.completions.create.return_value = broken_stream()
+            response = await client.post('/query', json={"query": "Test question", "stream": True})
+            lines = [json.loads(line) for line in (await response.text()).splitlines()]
+            self.assertEqual([line['type'] for line in lines], ["sources", "delta", "error"])
+            self.db.record_usage.assert_not_called()
+
+    async def test_query_validation(self):
+        async with self.make_client() as client:
+            for body in ({"query": ""}, [], "text", {"query": "Otázka", "n_results": True}):
+                with self.subTest(body=body):
+                    response = await client.post('/query', json=body)
+                    self.assertEqual(response.status, 400)
+
+            # S rozpočtem session by si klienti bez session_id dělili jeden rozpočet
+            with patch('qa.SESSION_TOKEN_BUDGET', 1000):
+                response = await client.post('/query', json={"query": "Otázka"})
+            self.assertEqual(response.status, 400)
+
+    async def test_load_shedding(self):
+        import api
+        admission = api.AdmissionControl(max_concurrency=1, max_queue=0, queue_timeout=0.1)
+        async with self.make_client(admission) as client:
+            async with admission.slot():
+                response = await client.post('/query', json={"query": "Test question"})
+            self.assertEqual(response.status, 503)
+            self.assertEqual(response.headers['Retry-After'], "1")
+
+            response = await client.post('/query', json={"query": "Test question"})
+            self.assertEqual(response.status, 200)
+
+
+class TestBatchQa(unittest.IsolatedAsyncioTestCase):
+
+    async def test_run_batch_resumes(self):
+        import tempfile
+        import batch_qa
+
+        db = MagicMock()
+        db.search_documents.return_value = [{"_id": "1", "content": "Test", "metadata": {"source": "data/a.txt"}}]
+        openai_client = openai_client_mock(usage=(3, 2), is_async=True)
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = f"{directory}/questions.jsonl"
+            output_file = f"{directory}/answers.jsonl"
+            with open(input_file, 'w', encoding='utf-8') as f:
+                f.write('{"id": "a", "question": "First?"}\n{"id": "b", "question": "Second?"}\n"Third?"\n')
+            # Otázka "a" je hotová z předchozího běhu, "b" tehdy selhala
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write('{"id": "a", "answer": "Old"}\n{"id": "b", "error": "Timeout"}\n')
+
+            stats = await batch_qa.run_batch(db, openai_client, input_file, output_file, concurrency=2)
+
+            self.assertEqual(stats, {"answered": 2, "failed": 0, "skipped": 1})
+            with open(output_file, 'r', encoding='utf-8') as f:
+                results = [json.loads(line) for line in f][2:]
+            self.assertEqual(sorted(result['id'] for result in results), ['3', 'b'])
+            self.assertEqual(results[0]['sources'], ["data/a.txt"])
+            self.assertEqual(results[0]['usage'], {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5,
+                                                   "cost": 0.0})
+            self.assertEqual(set(results[0]['latency_ms']), {"retrieval", "llm", "total"})
+            self.assertEqual(db.record_usage.call_count, 2)
+
+    async def test_run_batch_survives_bad_lines_and_partial_output(self):
+        import batch_qa
+        db = MagicMock()
+        db.search_documents.return_value = [{"_id": "1", "content": "Test", "metadata": {"source": "data/a.txt"}}]
+        openai_client = openai_client_mock(is_async=True)
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_file = f"{directory}/questions.jsonl"
+            output_file = f"{directory}/answers.jsonl"
+            with open(input_file, 'w', encoding='utf-8') as f:
+                f.write('{"id": "a", "question": "First?"}\n{broken\n42\n{"id": "d", "question": "Fourth?"}\n')
+            # Předchozí běh skončil uprostřed zápisu záznamu "d"
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write('{"id": "a", "answer": "Old"}\n{"id": "d", "ans')
+
+            stats = await batch_qa.run_batch(db, openai_client, input_file, output_file, concurrency=2)
+
+            self.assertEqual(stats, {"answered": 1, "failed": 2, "skipped": 1})
+            with open(output_file, 'r', encoding='utf-8') as f:
+                results = [json.loads(line) for line in f]
+            self.assertEqual([result['id'] for result in results], ['a', '2', '3', 'd'])
+            self.assertIn("Invalid JSON", results[1]['error'])
+            self.assertEqual(results[3]['answer'], "Test answer")
+
+            # Při pokračování se neplatné řádky nepřipisují znovu
+            stats = await batch_qa.run_batch(db, openai_client, input_file, output_file, concurrency=2)
+            self.assertEqual(stats, {"answered": 0, "failed": 0, "skipped": 4})
+            with open(output_file, 'r', encoding='utf-8') as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+
+class TestContextBuilder(unittest.TestCase):
+
+    @staticmethod
+    def doc(content, source='data/a.pdf', chunk_index=None, page=0):
+        metadata = {"source": source, "page": page}
+        if chunk_index is not None:
+            metadata["chunk_index"] = chunk_index
+        return {"content": content, "metadata": metadata}
+
+    def test_merges_overlapping_neighbours(self):
+        import qa
+        documents = [
+            self.doc("continues the sentence and ends here.", chunk_index=1),
+            self.doc("Another file entirely.", source='data/b.pdf', chunk_index=7),
+            self.doc("This is the first chunk that continues the sentence", chunk_index=0),
+            self.doc("This is the first chunk that continues the sentence", chunk_index=0),
+        ]
+        context, stats = qa.build_context(documents, token_budget=1000)
+
+        self.assertEqual(context,
+                         "[Source: data/a.pdf, page 0]\n"
+                         "This is the first chunk that continues the sentence and ends here.\n\n"
+                         "[Source: data/b.pdf, page 0]\nAnother file entirely.")
+        self.assertEqual(stats['blocks'], 2)
+        self.assertEqual(stats['chunks_used'], 4)
+
+    def test_merges_by_text_overlap_without_chunk_index(self):
+        import qa
+        documents = [self.doc("Alpha beta gamma delta"), self.doc("gamma delta epsilon")]
+        context, _ = qa.build_context(documents, token_budget=1000)
+        self.assertEqual(context, "[Source: data/a.pdf, page 0]\nAlpha beta gamma delta epsilon")
+
+    def test_respects_token_budget(self):
+        import qa
+        documents = [self.doc("x" * 400, source='data/a.pdf'), self.doc("y" * 400, source='data/b.pdf'),
+                     self.doc("z" * 40, source='data/c.pdf')]
+        context, stats = qa.build_context(documents, token_budget=130)
+
+        self.assertIn("x" * 400, context)
+        self.assertNotIn("y", context)
+        self.assertIn("z" * 40, context)
+        self.assertLessEqual(stats['tokens'], 130)
+
+
+class TestRerank(unittest.TestCase):
+
+    @staticmethod
+    def candidate(doc_id, tokens, score, named_entities=None):
+        return {"_id": doc_id, "content": ' '.join(tokens), "score": score,
+                "metadata": {"tokens": tokens, "named_entities": named_entities or []}}
+
+    def test_rerank_prefers_term_coverage_and_entities(self):
+        import rerank
+        candidates = [
+            self.candidate('a', ['smlouva', 'byla', 'podepsána'], 2.0),
+            self.candidate('b', ['Novák', 'podepsal', 'smlouva', 'Praha'], 1.5,
+                           [['podepsal', 'VBD'], [['Novák', 'NNP']], ['smlouva', 'NN'], [['Praha', 'NNP']]]),
+            self.candidate('c', ['nic', 'společného'], 1.0),
+        ]
+        result = rerank.rerank("Novák smlouva Praha", candidates, 2, budget_ms=1000)
+        self.assertEqual([doc['_id'] for doc in result], ['b', 'a'])
+        self.assertIn('rerank_score', result[0])
+
+    def test_entity_words_from_string_tree(self):
+        import rerank
+        self.assertEqual(rerank.entity_words("(S (PERSON Jan/NNP Novák/NNP) bydlí/VB v/IN (GPE Praha/NNP))"),
+                         {'jan', 'novák', 'praha'})
+
+    def test_rerank_budget_stops_feature_extraction(self):
+        import rerank
+        candidates = [self.candidate('a', ['x'], 3.0), self.candidate('b', ['smlouva'], 2.0),
+                      self.candidate('c', ['smlouva'], 1.0)]
+        # Rozpočet je vyčerpaný po prvním kandidátovi: ostatní se nezpracují a zůstanou v pořadí z MongoDB
+        clock = Mock(side_effect=[0.0, 1.0])
+        with patch('rerank._tokens', wraps=rerank._tokens) as mock_tokens:
+            result = rerank.rerank("smlouva", candidates, 2, budget_ms=5, clock=clock)
+        self.assertEqual([doc['_id'] for doc in result], ['a', 'b'])
+        self.assertEqual(mock_tokens.call_count, 1)
+        self.assertIn('rerank_score', result[0])
+        self.assertNotIn('rerank_score', result[1])
+
+    def test_get_relevant_documents_fetches_candidate_pool(self):
+        import qa
+        db = MagicMock()
+        db.search_documents.return_value = [self.candidate('a', ['x'], 2.0), self.candidate('b', ['smlouva'], 1.0)]
+        result = qa.get_relevant_documents(db, "smlouva", 1, rerank=True)
+
+        db.search_documents.assert_called_once_with('data', "smlouva", qa.rerank_module.RERANK_CANDIDATES,
+                                                    fields=qa.SEARCH_FIELDS + qa.rerank_module.RERANK_FIELDS)
+        self.assertEqual([doc['_id'] for doc in result], ['b'])
+
+    def test_select_by_score_cuts_weak_matches(self):
+        import qa
+        results = [self.candidate(doc_id, ['x'] * 40, score) for doc_id, score in (('a', 4.0), ('b', 3.0), ('c', 1.0))]
+        selected, stats = qa.select_by_score(results, 3, cutoff=0.5)
+        self.assertEqual([doc['_id'] for doc in selected], ['a', 'b'])
+        self.assertEqual((stats['candidates'], stats['trimmed_documents'], stats['top_score']), (3, 1, 4.0))
+        self.assertGreater(stats['trimmed_tokens'], 0)
+
+        # Bez nastaveného SCORE_CUTOFF se neořezává nic
+        selected, stats = qa.select_by_score(results, 3)
+        self.assertEqual(([doc['_id'] for doc in selected], stats['trimmed_documents']), (['a', 'b', 'c'], 0))
+
+        # Dokumenty bez skóre (shoda podle _id) se neořezávají
+        selected, stats = qa.select_by_score([{"_id": "a", "content": "x"}], 1)
+        self.assertEqual((len(selected), stats['trimmed_documents']), (1, 0))
+
+    def test_adaptive_k_stops_at_score_drop(self):
+        import qa
+        scores = (5.0, 4.8, 4.5, 4.2, 1.5, 1.4)
+        db = MagicMock()
+        db.search_documents.return_value = [self.candidate(str(i), ['x'], score) for i, score in enumerate(scores)]
+        with patch('qa.ADAPTIVE_MAX_RESULTS', 6):
+            documents, stats = qa.retrieve_documents(db, "x", 2, rerank=False, adaptive=True)
+
+        db.search_documents.assert_called_once_with('data', "x", 6, fields=qa.SEARCH_FIELDS)
+        self.assertEqual([doc['_id'] for doc in documents], ['0', '1', '2', '3'])
+        self.assertEqual(stats['trimmed_documents'], 0)
+
+
+class TestSearchProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock_db()
+        self.db.get_collection('data').insert_many([
+            {"_id": f"{i:032x}", "content": f"Chunk {i}",
+             "metadata": {"source": "data/a.pdf", "page": 0, "tokens": ["Chunk", str(i)], "pos_tags": [],
+                          "file_hash": str(i)}}
+            for i in range(3)
+        ])
+
+    def test_search_returns_projected_fields(self):
+        result = self.db.search_documents('data', f"{1:032x}")
+        self.assertEqual(result, [{"_id": f"{1:032x}", "content": "Chunk 1",
+                                   "metadata": {"source": "data/a.pdf", "page": 0}}])
+
+        full = self.db.search_documents('data', f"{1:032x}", fields=None)
+        self.assertEqual(full[0]['metadata']['tokens'], ["Chunk", "1"])
+
+    def test_fetch_metadata_keeps_order(self):
+        result = self.db.fetch_metadata('data', [f"{2:032x}", "missing", f"{0:032x}"], fields=['metadata.tokens'])
+        self.assertEqual([doc['metadata'] for doc in result], [{"tokens": ["Chunk", "2"]}, {"tokens": ["Chunk", "0"]}])
+
+    def test_search_by_id_list_uses_one_query(self):
+        ids = [f"{2:032x}", f"{0:032x}"]
+        with patch.object(self.db, 'search_document_by_id') as mock_by_id:
+            result = self.db.search_documents('data', ids)
+        mock_by_id.assert_not_called()
+        self.assertEqual([doc['content'] for doc in result], ["Chunk 2", "Chunk 0"])
+
+    def test_natural_language_query_skips_id_lookup(self):
+        with patch.object(self.db, 'get_collection') as mock_get_collection:
+            collection = mock_get_collection.return_value
+            collection.find.return_value.sort.return_value.limit.return_value = [{"_id": "x", "content": "Chunk"}]
+            result = self.db.search_documents('data', "Jaká je splatnost faktury?")
+
+        collection.find_one.assert_not_called()
+        self.assertEqual(result, [{"_id": "x", "content": "Chunk"}])
+        self.assertTrue(self.db.is_document_id(f"{1:032x}"))
+        self.assertFalse(self.db.is_document_id("0123456789abcdef0123456789abcdeg"))
+
+
+class TestIngestQueue(unittest.TestCase):
+    def setUp(self):
+        import ingest_queue
+        self.db = mongomock_db()
+        self.ingest_queue = ingest_queue
+        self.queue = ingest_queue.JobQueue(self.db, lease_seconds=60, max_attempts=2)
+        self.tmp = tempfile.TemporaryDirectory()
+        for name in ("a.txt", "b.txt"):
+            with open(os.path.join(self.tmp.name, name), 'w', encoding='utf-8') as f:
+                f.write("Obsah")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_enqueue_is_idempotent_and_leases_are_exclusive(self):
+        self.assertEqual(self.queue.enqueue(self.tmp.name), 2)
+        self.assertEqual(self.queue.enqueue(self.tmp.name), 0)
+
+        first = self.queue.lease("w1")
+        second = self.queue.lease("w2")
+        self.assertNotEqual(first['_id'], second['_id'])
+        self.assertIsNone(self.queue.lease("w3"))
+
+        self.assertFalse(self.queue.complete(first['_id'], "w2", 1))
+        self.assertTrue(self.queue.complete(first['_id'], "w1", 3))
+        progress = self.queue.progress()
+        self.assertEqual((progress['done'], progress['leased'], progress['chunks']), (1, 1, 3))
+
+    def test_expired_lease_is_retried_then_failed(self):
+        self.queue.enqueue(self.tmp.name)
+        self.queue.lease("w1")
+        self.queue.lease("w1")
+        collection = self.db.get_collection(self.ingest_queue.JOBS_COLLECTION)
+        expired = self.ingest_queue.utcnow() - self.ingest_queue.timedelta(seconds=1)
+        collection.update_many({}, {"$set": {"lease_expires": expired}})
+
+        job = self.queue.lease("w2")
+        self.assertEqual((job['worker'], job['attempts']), ("w2", 2))
+        self.assertFalse(self.queue.heartbeat(job['_id'], "w1"))
+        self.assertTrue(self.queue.fail(job['_id'], "w2", "boom"))
+        self.assertEqual(collection.find_one({"_id": job['_id']})['status'], 'failed')
+
+        collection.update_many({"status": "leased"}, {"$set": {"attempts": 2, "lease_expires": expired}})
+        self.assertIsNone(self.queue.lease("w3"))
+        self.assertEqual(self.queue.reap_expired(), 1)
+
+    def test_worker_processes_queue_until_empty(self):
+        self.queue.enqueue(self.tmp.name)
+        with patch('ingest_queue.process_job', side_effect=[2, RuntimeError("boom"), 1]) as mock_process:
+            processed = self.ingest_queue.run_worker(self.db, self.queue, worker_id="w1")
+
+        self.assertEqual(processed, 2)
+        self.assertEqual(mock_process.call_count, 3)
+        progress = self.queue.progress()
+        self.assertEqual((progress['done'], progress['failed'], progress['chunks']), (2, 0, 3))
+
+    def test_lost_lease_skips_commit(self):
+        self.queue.enqueue(self.tmp.name)
+        job = self.queue.lease("w1")
+        with patch('fill_db.process_document', new=AsyncMock(return_value=[{"_id": "x"}])), \
+                patch('fill_db.commit_file') as mock_commit:
+            self.assertIsNone(self.ingest_queue.process_job(self.db, job['_id'], lambda: False))
+            mock_commit.assert_not_called()
+            self.assertEqual(self.ingest_queue.process_job(self.db, job['_id']), 1)
+            mock_commit.assert_called_once()
+
+
+class TestCheckpoints(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = mongomock_db()
+        self.db.close_connection = MagicMock()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = []
+        for name in ("a.txt", "b.txt"):
+            path = os.path.join(self.tmp.name, name)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f"Obsah {name}")
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def chunk(file_path):
+        return {"_id": file_path[-5:].rjust(32, '0'), "content": file_path, "metadata": {"source": file_path}}
+
+    async def test_interrupted_run_resumes(self):
+        async def fail_on_b(file_path):
+            if file_path.endswith("b.txt"):
+                raise RuntimeError("killed")
+            return [self.chunk(file_path)]
+
+        with patch('fill_db.MongoDB', return_value=self.db), patch('fill_db.tokenizer.ensure_nltk_data'), \
+                patch('fill_db.process_document', side_effect=fail_on_b) as mock_process:
+            await load_and_process_documents(self.tmp.name)
+            self.assertEqual(set(self.db.get_checkpoints()), {self.files[0]})
+
+            plan = plan_ingestion(self.tmp.name)
+            self.assertEqual((plan['done'], plan['remaining']), (1, 1))
+
+            mock_process.reset_mock(side_effect=True)
+            mock_process.side_effect = lambda file_path: [self.chunk(file_path)]
+            await load_and_process_documents(self.tmp.name)
+
+        mock_process.assert_called_once_with(self.files[1])
+        self.assertEqual(self.db.get_collection('data').count_documents({}), 2)
+        self.assertEqual(self.db.get_checkpoints()[self.files[1]]['chunks'], 1)
+
+    @patch('fill_db.get_file_type', return_value='application/pdf')
+    async def test_failed_extraction_is_not_checkpointed(self, mock_get_file_type):
+        from fill_db import ExtractionError, process_document
+        empty = os.path.join(self.tmp.name, "empty.pdf")
+        open(empty, 'wb').close()
+        with patch('fill_db.MongoDB', return_value=self.db), patch('fill_db.tokenizer.ensure_nltk_data'), \
+                patch('fill_db.extract_text_from_pdf', return_value=[]):
+            with self.assertRaises(ExtractionError):
+                await process_document(self.files[0])
+            # Prázdný soubor nemá co extrahovat, checkpoint dostat smí
+            self.assertEqual(await process_document(empty), [])
+
+            await load_and_process_documents(self.tmp.name)
+        self.assertEqual(set(self.db.get_checkpoints()), {empty})
+
+    def test_commit_file_is_idempotent(self):
+        documents = [self.chunk(self.files[0])]
+        checkpoint = {"_id": self.files[0], "file_hash": "x", "chunks": 1}
+        self.db.commit_file('data', documents, checkpoint)
+        self.db.commit_file('data', documents, checkpoint)
+        self.assertEqual(self.db.get_collection('data').count_documents({}), 1)
+        self.assertFalse(self.db.supports_transactions())
+
+
+class TestReindex(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock_db()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "doc.txt")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, paragraphs):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write("\n\n".join(paragraphs))
+
+    @staticmethod
+    def split_paragraphs(raw_documents):
+        texts = raw_documents[0]['page_content'].split("\n\n")
+        return [{"page_content": text, "chunk_index": i} for i, text in enumerate(texts)]
+
+    @patch('fill_db.get_file_type', return_value='text/plain')
+    @patch('fill_db.tokenizer')
+    def test_reindex_enriches_only_changed_chunks(self, mock_tokenizer, mock_get_file_type):
+        from fill_db import reindex_file
+        self.enterContext(patch('fill_db.split_text', side_effect=self.split_paragraphs))
+        mock_tokenizer.tokenize_text.side_effect = str.split
+        mock_tokenizer.pos_tag.return_value = []
+        mock_tokenizer.named_entity_recognition.return_value = []
+        paragraphs = ["Prvni odstavec dokumentu.", "Druhy odstavec dokumentu.", "Treti odstavec dokumentu."]
+
+        self.write(paragraphs)
+        self.assertEqual(reindex_file(self.db, self.path)['added'], 3)
+
+        self.write([paragraphs[0], "Upraveny druhy odstavec.", paragraphs[2]])
+        mock_tokenizer.tokenize_text.reset_mock()
+        stats = reindex_file(self.db, self.path)
+
+        self.assertEqual(stats, {"added": 1, "removed": 1, "unchanged": 2, "moved": 0})
+        mock_tokenizer.tokenize_text.assert_called_once_with("Upraveny druhy odstavec.")
+        contents = [doc['content'] for doc in self.db.get_collection('data').find(
+            {"metadata.source": self.path}).sort("metadata.chunk_index", 1)]
+        self.assertEqual(contents, [paragraphs[0], "Upraveny druhy odstavec.", paragraphs[2]])
+
+        self.write(paragraphs[1:])
+        self.assertEqual(reindex_file(self.db, self.path), {"added": 1, "removed": 2, "unchanged": 1, "moved": 1})
+        self.assertIn("metadata.source_1", self.db.get_collection('data').index_information())
+
+    @patch('fill_db.get_file_type', return_value='text/plain')
+    @patch('fill_db.tokenizer')
+    def test_reindex_keeps_chunks_when_extraction_fails(self, mock_tokenizer, mock_get_file_type):
+        from fill_db import ExtractionError, reindex_file
+        mock_tokenizer.tokenize_text.side_effect = str.split
+        mock_tokenizer.pos_tag.return_value = []
+        mock_tokenizer.named_entity_recognition.return_value = []
+        other = os.path.join(self.tmp.name, "copy.txt")
+        with open(other, 'w', encoding='utf-8') as f:
+            f.write("Spolecny odstavec.")
+        self.write(["Spolecny odstavec."])
+        reindex_file(self.db, self.path)
+        reindex_file(self.db, other)
+        checkpoint = self.db.get_checkpoints()[self.path]
+
+        with patch('fill_db.extract_text_from_txt', return_value=[]), self.assertRaises(ExtractionError):
+            reindex_file(self.db, self.path)
+        os.remove(other)
+        with self.assertRaises(FileNotFoundError):
+            reindex_file(self.db, other)
+
+        # Stejný odstavec ve dvou souborech má dva chunky a žádný se nesmazal ani nepřepsal checkpoint
+        self.assertEqual(self.db.get_collection('data').count_documents({"content": "Spolecny odstavec."}), 2)
+        self.assertEqual(self.db.get_checkpoints()[self.path], checkpoint)
+
+
+class TestArchiveIngestion(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        import io
+        import tarfile
+        import zipfile
+        self.tmp = tempfile.TemporaryDirectory()
+        self.members = {"a.txt": "První soubor.".encode('utf-8'), "sub/b.txt": b"Second file."}
+        self.zip_path = os.path.join(self.tmp.name, "dump.zip")
+        with zipfile.ZipFile(self.zip_path, 'w') as archive:
+            for name, content in self.members.items():
+                archive.writestr(name, content)
+        self.tar_path = os.path.join(self.tmp.name, "dump.tar.gz")
+        with tarfile.open(self.tar_path, 'w:gz') as archive:
+            for name, content in self.members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @patch('fill_db.process_paragraph', side_effect=lambda paragraph, source: {
+        "content": paragraph['page_content'], "metadata": {"source": source}})
+    async def test_members_are_extracted_from_buffers(self, mock_process_paragraph):
+        from fill_db import process_document, is_archive
+        self.assertFalse(is_archive("report.docx"))
+        for path in (self.zip_path, self.tar_path):
+            documents = await process_document(path)
+            self.assertEqual({doc['metadata']['source']: doc['content'] for doc in documents},
+                             {f"{path}::a.txt": "První soubor.", f"{path}::sub/b.txt": "Second file."})
+        # Nic se nerozbalilo na disk
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ["dump.tar.gz", "dump.zip"])
+
+    @patch('fill_db.process_paragraph', side_effect=lambda paragraph, source: {
+        "content": paragraph['page_content'], "metadata": {"source": source}})
+    async def test_large_pdf_member_is_opened_from_disk(self, mock_process_paragraph):
+        import zipfile
+        from fill_db import process_document
+        path = os.path.join(self.tmp.name, "reports.zip")
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr("big.pdf", b"%PDF-1.4" + b"0" * 100)
+            archive.writestr("a.txt", "Text.")
+        opened = []
+
+        def fake_open(file_path=None, **kwargs):
+            # Velký člen se předá jako cesta k dočasnému souboru, ne jako bajty v paměti
+            self.assertNotIn('stream', kwargs)
+            opened.append(file_path)
+            self.assertTrue(os.path.exists(file_path))
+            page = MagicMock()
+            page.get_text.return_value = "Text PDF."
+            return MagicMock(__iter__=Mock(return_value=iter([page])))
+
+        real_get_file_type = get_file_type
+
+        def failing_get_file_type(member):
+            if str(member).endswith("a.txt"):
+                raise OSError("magic failed")
+            return real_get_file_type(member)
+
+        with patch('fill_db.ARCHIVE_SPOOL_BYTES', 10), patch('fitz.open', side_effect=fake_open), \
+                patch('fill_db.get_file_type', side_effect=failing_get_file_type):
+            documents = await process_document(path)
+
+        # Člen s chybou detekce typu se přeskočí, zbytek archivu se zpracuje
+        self.assertEqual([doc['content'] for doc in documents], ["Text PDF."])
+        self.assertEqual(len(opened), 1)
+        self.assertFalse(os.path.exists(opened[0]))
+
+    @patch('fill_db.tokenizer')
+    async def test_reindex_archive_by_member_source(self, mock_tokenizer):
+        from fill_db import reindex_file
+        mock_tokenizer.tokenize_text.side_effect = str.split
+        mock_tokenizer.pos_tag.return_value = []
+        mock_tokenizer.named_entity_recognition.return_value = []
+        db = mongomock_db()
+
+        self.assertEqual(reindex_file(db, self.zip_path)['added'], 2)
+        self.assertEqual(reindex_file(db, self.zip_path), {"added": 0, "removed": 0, "unchanged": 2, "moved": 0})
+        self.assertEqual(db.get_collection('data').count_documents({"metadata.source": f"{self.zip_path}::a.txt"}), 1)
+
+        # Upravený člen a odebraný člen: staré chunky obou zmizí
+        import zipfile
+        with zipfile.ZipFile(self.zip_path, 'w') as archive:
+            archive.writestr("a.txt", "Upravený soubor.")
+        self.assertEqual(reindex_file(db, self.zip_path), {"added": 1, "removed": 2, "unchanged": 0, "moved": 0})
+        self.assertEqual([doc['content'] for doc in db.get_collection('data').find()], ["Upravený soubor."])
+
+    @patch('fill_db.tokenizer')
+    async def test_reindex_isolates_member_errors(self, mock_tokenizer):
+        import fill_db
+        mock_tokenizer.tokenize_text.side_effect = str.split
+        mock_tokenizer.pos_tag.return_value = []
+        mock_tokenizer.named_entity_recognition.return_value = []
+        db = mongomock_db()
+        fill_db.reindex_file(db, self.zip_path)
+
+        # Člen, u kterého selže určení typu, ostatní členy nezastaví a jeho uložené chunky zůstanou
+        get_file_type = fill_db.get_file_type
+
+        def broken_member(member):
+            if str(member).endswith("a.txt"):
+                raise OSError("corrupt member")
+            return get_file_type(member)
+
+        with patch('fill_db.get_file_type', side_effect=broken_member):
+            sources = dict(fill_db.extract_sources(self.zip_path))
+            stats = fill_db.reindex_file(db, self.zip_path)
+        self.assertIsNone(sources[f"{self.zip_path}::a.txt"])
+        self.assertTrue(sources[f"{self.zip_path}::sub/b.txt"])
+        self.assertEqual(stats, {"added": 0, "removed": 0, "unchanged": 2, "moved": 0})
+        self.assertEqual(db.get_collection('data').count_documents({}), 2)
+
+
+class TestMarkupExtraction(unittest.TestCase):
+    def test_text_keeps_document_order(self):
+        import io
+        from fill_db import iter_markup_blocks
+        xml = b'<?xml version="1.0"?><root>Intro <a>one <b>two</b> three</a> tail <c/>more<d>four</d> end</root>'
+        self.assertEqual(list(iter_markup_blocks(io.BytesIO(xml))), ["Intro one two three tail more four end"])
+        # Text sourozeneckých elementů se neslepí, řádkové elementy a běhy Wordu slova nerozdělí
+        xml = b'<root><name>Jan</name><city>Praha</city><w:r xmlns:w="urn:w"><w:t>Po</w:t><w:t>ndeli</w:t></w:r></root>'
+        self.assertEqual(list(iter_markup_blocks(io.BytesIO(xml))), ["Jan Praha Pondeli"])
+
+        html = (b'<html><head><title>T</title><script>var a = 1;</script></head>'
+                b'<body><p>Hello <b>world</b></p><!-- x --><div>Second</div></body></html>')
+        self.assertEqual(list(iter_markup_blocks(io.BytesIO(html), html=True)), ["T\nHello world\nSecond\n"])
+
+        # Ani vnořené elementy přeskakovaných značek text nepřidají, text za nimi ano
+        html = (b'<html><body><noscript><p>Enable <b>JS</b></p></noscript><template><div>Tpl</div></template>'
+                b'<p>Visible</p></body></html>')
+        self.assertEqual(list(iter_markup_blocks(io.BytesIO(html), html=True)), ["Visible\n"])
+
+    def test_blocks_are_bounded_at_element_boundaries(self):
+        import io
+        from fill_db import iter_markup_blocks
+        records = ''.join(f"<record>zaznam {i:03d}</record>" for i in range(100))
+        blocks = list(iter_markup_blocks(io.BytesIO(f"<export>{records}</export>".encode()), block_chars=50))
+        self.assertGreater(len(blocks), 10)
+        self.assertTrue(all(len(block) < 50 + len("zaznam 000") for block in blocks))
+        self.assertEqual(' '.join(blocks), ' '.join(f"zaznam {i:03d}" for i in range(100)))
+
+    @patch('docx.Document', side_effect=Exception("Not a zip file"))
+    def test_docx_xml_fallback_reads_blocks(self, mock_document):
+        with tempfile.NamedTemporaryFile('w', suffix='.docx', delete=False, encoding='utf-8') as f:
+            f.write('<?xml version="1.0"?><w:document xmlns:w="urn:w"><w:p><w:r><w:t>Odstavec</w:t></w:r>'
+                    '</w:p></w:document>')
+        self.addCleanup(os.remove, f.name)
+        self.assertEqual(extract_text_from_docx(f.name), [{"page_content": "Odstavec\n"}])
+
+    @patch('fill_db.extract_text_from_markup', return_value=[{"page_content": "x"}])
+    def test_extract_file_routes_markup(self, mock_markup):
+        from fill_db import extract_file
+        extract_file('page.html', 'text/html')
+        extract_file('export.xml', 'text/plain')
+        extract_file('page.xhtml', 'application/xhtml+xml')
+        self.assertEqual([call.args for call in mock_markup.call_args_list],
+                         [('page.html', True), ('export.xml', False), ('page.xhtml', False)])
+
+
+class TestSearchNormalization(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock_db()
+
+    def test_normalize_search_text(self):
+        from normalization import normalize_search_text
+        self.assertEqual(normalize_search_text("Žluťoučký kůň, ÚČTENKA č. 5!"), "zlutoucky kun uctenka c 5")
+
+    def test_search_index_replaces_content_index_once(self):
+        import database
+        collection = self.db.get_collection('data')
+        collection.insert_many([{"_id": name, "content": f"Řešení {name}",
+                                 "metadata": {"source": "a.txt", "file_hash": name}} for name in "abc"])
+        self.db.create_text_index('data', 'content')
+
+        with patch('database.BACKFILL_BATCH_SIZE', 2):
+            self.assertEqual(self.db.backfill_search_text('data'), 3)
+        self.assertEqual(collection.find_one({"_id": "a"})['search_text'], "reseni a")
+        self.assertEqual(self.db.backfill_search_text('data'), 0)
+        # Ingestion starý index nechá, nahradí ho až údržba
+        self.assertFalse(self.db.ensure_search_index('data'))
+        self.assertIn("content_text", collection.index_information())
+        self.assertTrue(self.db.ensure_search_index('data', replace=True))
+        self.assertFalse(self.db.ensure_search_index('data', replace=True))
+
+        text_indexes = [name for name, info in collection.index_information().items()
+                        if any(kind == "text" for _, kind in info['key'])]
+        self.assertEqual(text_indexes, [database.SEARCH_INDEX_NAME])
+
+    def test_query_is_normalized(self):
+        with patch.object(self.db, 'get_collection') as mock_get_collection:
+            collection = mock_get_collection.return_value
+            collection.find.return_value.sort.return_value.limit.return_value = []
+            self.db.search_documents('data', "Jaká je SPLATNOST?")
+
+        self.assertEqual(collection.find.call_args[0][0], {"$text": {"$search": "jaka je splatnost"}})
+
+
+class TestTokenizerBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def fake_process_text(text, language='english'):
+        if not text:
+            raise ValueError("empty")
+        return {"tokens": text.split(), "pos_tags": [], "named_entities": ""}
+
+    def read_output(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f]
+
+    @patch('tokenizer.process_text')
+    def test_jsonl_batch_streams_results_in_order(self, mock_process_text):
+        import tokenizer
+        mock_process_text.side_effect = self.fake_process_text
+        input_path = os.path.join(self.tmp.name, "input.jsonl")
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.write('"prvni text"\n\n{"id": "x", "text": "druhy"}\n{"text": ""}\n{"text": \n[1]\n"treti"\n')
+        output_path = os.path.join(self.tmp.name, "out", "result.jsonl")
+
+        # Se dvěma workery běží záznamy v ProcessPoolExecutoru (fork zdědí mock process_text)
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                stats = tokenizer.run_batch(input_path, output_path, workers=workers)
+
+                self.assertEqual(stats, {"processed": 3, "failed": 3})
+                results = self.read_output(output_path)
+                self.assertEqual([result['id'] for result in results], [1, "x", 4, 5, 6, 7])
+                self.assertEqual(results[0]['tokens'], ["prvni", "text"])
+                self.assertEqual(results[2]['error'], "ValueError: empty")
+                self.assertTrue(results[3]['error'].startswith("JSONDecodeError"))
+                self.assertEqual(results[4]['error'], "Unsupported record: list")
+                self.assertEqual(results[5]['tokens'], ["treti"])
+
+    @patch('tokenizer.process_text')
+    def test_directory_batch_reads_files(self, mock_process_text):
+        import tokenizer
+        mock_process_text.side_effect = self.fake_process_text
+        os.makedirs(os.path.join(self.tmp.name, "docs", "sub"))
+        for name, text in (("b.txt", "bbb"), ("a.txt", "aaa"), (os.path.join("sub", "c.txt"), "ccc")):
+            with open(os.path.join(self.tmp.name, "docs", name), 'w', encoding='utf-8') as f:
+                f.write(text)
+        output_path = os.path.join(self.tmp.name, "result.jsonl")
+
+        tokenizer.run_batch(os.path.join(self.tmp.name, "docs"), output_path, workers=1)
+
+        results = self.read_output(output_path)
+        self.assertEqual([(result['id'], result['tokens']) for result in results],
+                         [("a.txt", ["aaa"]), ("b.txt", ["bbb"]), (os.path.join("sub", "c.txt"), ["ccc"])])
+
+
+class TestNltkResources(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @patch('tokenizer.nltk.download')
+    @patch('tokenizer.nltk.data.find', side_effect=LookupError)
+    def test_offline_never_downloads(self, mock_find, mock_download):
+        import tokenizer
+        with self.assertRaises(LookupError):
+            tokenizer.download_nltk_data(offline=True)
+
+        mock_download.assert_not_called()
+        searched = {call.args[0] for call in mock_find.call_args_list}
+        self.assertEqual(searched, {'tokenizers/punkt_tab', 'taggers/averaged_perceptron_tagger_eng',
+                                    'chunkers/maxent_ne_chunker_tab', 'corpora/words'})
+
+    def test_bundle_manifest_detects_corruption(self):
+        import tokenizer
+
+        def fake_download(resource, download_dir, quiet):
+            path = os.path.join(download_dir, *tokenizer.NLTK_RESOURCES[resource].split('/'), 'model.bin')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(resource.encode('utf-8'))
+            return True
+
+        with patch('tokenizer.nltk.download', side_effect=fake_download):
+            tokenizer.build_bundle(self.tmp.name)
+        self.assertEqual(tokenizer.verify_bundle(self.tmp.name), [])
+
+        tampered = os.path.join(self.tmp.name, 'corpora', 'words', 'model.bin')
+        with open(tampered, 'wb') as f:
+            f.write(b'broken')
+        self.assertEqual(tokenizer.verify_bundle(self.tmp.name),
+                         [f"checksum mismatch {os.path.join('corpora', 'words', 'model.bin')}"])
+
+        # corpora/word je jen prefixem corpora/words, takový model v bundlu není
+        with patch.dict(tokenizer.NLTK_RESOURCES, {'word': 'corpora/word'}):
+            self.assertIn("resource word not in bundle", tokenizer.verify_bundle(self.tmp.name))
+
+    @patch('tokenizer.process_text')
+    def test_warm_up_runs_once_per_process(self, mock_process_text):
+        import tokenizer
+        with patch('tokenizer._warm_up_seconds', None):
+            first = tokenizer.warm_up()
+            second = tokenizer.warm_up()
+        mock_process_text.assert_called_once()
+        self.assertEqual(first, second)
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        import mongomock
+        import database
+        with patch('database.MongoClient', mongomock.MongoClient):
+            self.source = database.MongoDB()
+        with patch('database.MongoClient', return_value=mongomock.MongoClient()):
+            self.target = database.MongoDB()
+        self.source.get_collection('data').insert_many([
+            {"_id": f"{i:032x}", "content": f"Chunk {i}", "search_text": f"chunk {i}",
+             "metadata": {"source": "a.txt", "chunk_index": i, "file_hash": str(i)}}
+            for i in range(25)
+        ])
+        self.source.ensure_search_index('data')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "corpus.snap")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip_restores_documents_and_indexes(self):
+        import snapshot
+        manifest = snapshot.export_snapshot(self.source, self.path, batch_size=10)
+        self.assertEqual(manifest['collections']['data']['count'], 25)
+        self.assertEqual(snapshot.verify_snapshot(self.path)['sha256'], manifest['sha256'])
+
+        stats, _ = snapshot.import_snapshot(self.target, self.path, drop=True)
+
+        self.assertEqual(stats, {"inserted": 25, "skipped": 0})
+        self.assertEqual(list(self.target.get_collection('data').find().sort('_id', 1)),
+                         list(self.source.get_collection('data').find().sort('_id', 1)))
+        self.assertEqual(set(self.target.get_collection('data').index_information()),
+                         set(self.source.get_collection('data').index_information()))
+
+        stats, _ = snapshot.import_snapshot(self.target, self.path)
+        self.assertEqual(stats, {"inserted": 0, "skipped": 25})
+
+    def test_corrupted_batch_is_rejected(self):
+        import snapshot
+        snapshot.export_snapshot(self.source, self.path, batch_size=10)
+        with open(self.path, 'r+b') as f:
+            f.seek(200)
+            byte = f.read(1)
+            f.seek(200)
+            f.write(bytes([byte[0] ^ 0xFF]))
+
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.verify_snapshot(self.path)
+        # Poškozený snapshot se odmítne dřív, než se cokoli vloží
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.import_snapshot(self.target, self.path)
+        self.assertEqual(self.target.get_collection('data').count_documents({}), 0)
+
+    def test_truncated_header_is_rejected(self):
+        import snapshot
+        snapshot.export_snapshot(self.source, self.path, batch_size=10)
+        with open(self.path, 'rb') as f:
+            content = f.read()
+        # Useknutí uvnitř délky hlavičky a uvnitř hlavičky samotné
+        for size in (len(snapshot.MAGIC) + 2, len(snapshot.MAGIC) + 10):
+            with self.subTest(size=size):
+                with open(self.path, 'wb') as f:
+                    f.write(content[:size])
+                with self.assertRaises(snapshot.SnapshotError):
+                    snapshot.verify_snapshot(self.path)
+
+
+class TestUsageAccounting(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock_db()
+        self.openai_client = openai_client_mock("Odpověď", usage=(900, 100))
+        self.documents = [{"_id": "1", "content": "Text " * 400, "metadata": {"source": "a.txt", "page": 0}}]
+        self.retrieval = {"candidates": 2, "selected": 1, "trimmed_documents": 1, "trimmed_tokens": 50,
+                          "top_score": 3.0}
+
+    @patch('qa.retrieve_documents')
+    def test_usage_is_recorded_per_query_and_session(self, mock_retrieve_documents):
+        import qa
+        mock_retrieve_documents.return_value = (self.documents, self.retrieval)
+        with patch('qa.PROMPT_PRICE_PER_1K', 1.0), patch('qa.COMPLETION_PRICE_PER_1K', 2.0):
+            content, documents, entry = qa.answer_query(self.db, self.openai_client, "s1", "Otázka?", 1, budget=0)
+            qa.answer_query(self.db, self.openai_client, "s1", "Další?", 1, budget=0)
+
+        self.assertEqual((content, documents), ("Odpověď", self.documents))
+        self.assertEqual((entry['prompt_tokens'], entry['completion_tokens'], entry['cost']), (900, 100, 1.1))
+        self.assertFalse(entry['trimmed'])
+        self.assertEqual((entry['documents'], entry['trimmed_documents'], entry['trimmed_tokens']), (1, 1, 50))
+        usage = self.db.get_session_usage("s1")
+        self.assertEqual((usage['queries'], usage['total_tokens'], usage['refused']), (2, 2000, 0))
+        self.assertAlmostEqual(usage['cost'], 2.2)
+        self.assertEqual(self.db.get_collection('usage').count_documents({"session_id": "s1"}), 2)
+
+    def test_session_usage_resets_each_window(self):
+        from datetime import datetime, timezone
+        with patch('database.SESSION_USAGE_WINDOW_SECONDS', 3600), patch('database.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime(2026, 1, 1, 10, 30, tzinfo=timezone.utc)
+            self.db.record_usage("s1", {"total_tokens": 100})
+            self.db.record_usage("s1", {"total_tokens": 50})
+            self.assertEqual(self.db.get_session_usage("s1")['total_tokens'], 150)
+
+            # V další hodině se rozpočet počítá znovu od nuly
+            mock_datetime.now.return_value = datetime(2026, 1, 1, 11, 5, tzinfo=timezone.utc)
+            self.assertEqual(self.db.get_session_usage("s1")['total_tokens'], 0)
+
+    @patch('qa.retrieve_documents')
+    def test_submit_query_writes_history(self, mock_retrieve_documents):
+        import database
+        import qa
+        mock_retrieve_documents.return_value = (self.documents, self.retrieval)
+        self.db.db.create_collection(database.HISTORY_COLLECTION)
+        qa.submit_query(self.db, self.openai_client, "s3", "Otázka?", 1, budget=0)
+
+        entry = self.db.get_history("s3", limit=1)[0]
+        self.assertEqual((entry['query'], entry['response'], entry['sources']), ("Otázka?", "Odpověď", ["a.txt"]))
+        self.assertEqual(set(entry['usage']), set(qa.HISTORY_USAGE_FIELDS))
+
+    @patch('qa.retrieve_documents')
+    def test_budget_trims_context_then_refuses(self, mock_retrieve_documents):
+        import qa
+        mock_retrieve_documents.return_value = (self.documents, self.retrieval)
+
+        _, _, entry = qa.answer_query(self.db, self.openai_client, "s2", "Otázka?", 1, budget=1500)
+        self.assertTrue(entry['trimmed'])
+        prompt = self.openai_client.chat.completions.create.call_args.kwargs['messages'][1]['content']
+        self.assertLessEqual(qa.estimate_tokens(prompt), entry['context_token_budget'] + 20)
+
+        self.openai_client.chat.completions.create.reset_mock()
+        with self.assertRaises(qa.BudgetExceeded):
+            qa.answer_query(self.db, self.openai_client, "s2", "Otázka?", 1, budget=1500)
+        self.openai_client.chat.completions.create.assert_not_called()
+        self.assertEqual(self.db.get_session_usage("s2")['refused'], 1)
+
+
+class TestLoadBenchmark(unittest.TestCase):
+    def test_fake_chat_server_answers_and_fails(self):
+        from openai import OpenAI, InternalServerError
+        from bench_load import FakeChatServer
+
+        with FakeChatServer(latency_ms=1, jitter_ms=0) as llm:
+            client = OpenAI(api_key="test", base_url=llm.base_url, max_retries=0)
+            response = client.chat.completions.create(model="gpt-4o-mini",
+                                                      messages=[{"role": "user", "content": "x" * 400}])
+        self.assertEqual(response.choices[0].message.content, "Nevím.")
+        self.assertEqual(response.usage.completion_tokens, 20)
+        self.assertGreater(response.usage.prompt_tokens, 0)
+
+        with FakeChatServer(latency_ms=1, jitter_ms=0, error_rate=1.0) as llm:
+            client = OpenAI(api_key="test", base_url=llm.base_url, max_retries=0)
+            with self.assertRaises(InternalServerError):
+                client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "x"}])
+
+    def test_saturation_point(self):
+        from bench_load import saturation_point
+        levels = [{"users": users, "throughput_rps": rps} for users, rps in ((1, 10), (2, 19), (4, 20), (8, 20.5))]
+        self.assertEqual(saturation_point(levels), 2)
+        self.assertIsNone(saturation_point(levels[:2]))
@@ -1,8 +1,8 @@
 import hashlib
 
 from database import MongoDB
+from normalization import remove_diacritics
 import streamlit as st
-import unicodedata
 import re
 import os
 
@@ -10,10 +10,6 @@ import os
 def get_mongodb_client():
     return MongoDB()
 
-def remove_diacritics(input_str):
-    nfkd_form = unicodedata.normalize('NFKD', input_str)
-    return ''.join([c for c in nfkd_form if not unicodedata.combining(c)])
-
 def normalize_spaces(input_str):
     return re.sub(r'\s+', '_', input_str).strip()
 